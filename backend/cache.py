@@ -0,0 +1,185 @@
+# cache.py
+"""
+Small in-process caches shared by the query path (embeddings, tokenization, retrieval).
+"""
+
+import re
+import time
+import sqlite3
+import threading
+import unicodedata
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+ZERO_WIDTH_RE = re.compile("[\u200b\u200c\u200d\u2060\ufeff]")
+WHITESPACE_RE = re.compile(r"\s+")
+LATIN_RE = re.compile("[A-Za-z\u00c0-\u024f]+")
+
+
+def normalize_query(text: str) -> str:
+    """
+    Canonical form of a user query for cache keys:
+    Unicode NFC, zero-width characters removed, whitespace collapsed, Latin letters lowercased.
+    Thai text is otherwise left untouched.
+    """
+    text = unicodedata.normalize("NFC", text)
+    text = ZERO_WIDTH_RE.sub("", text)
+    text = WHITESPACE_RE.sub(" ", text).strip()
+    return LATIN_RE.sub(lambda m: m.group(0).lower(), text)
+
+
+class LRUCache:
+    def __init__(self, capacity: int, ttl: Optional[float] = None, name: str = "cache"):
+        """
+        Bounded, thread-safe LRU cache with optional per-entry TTL (seconds).
+        A capacity of 0 disables the cache.
+        """
+        self.capacity = capacity
+        self.ttl = ttl if ttl and ttl > 0 else None
+        self.name = name
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Returns the cached value, or None on a miss or expired entry."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, value = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._data),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class DiskCache:
+    def __init__(self, path: str, ttl: Optional[float] = None, name: str = "disk_cache",
+                 max_rows: int = 100_000, prune_every: int = 1000):
+        """
+        Persistent key -> bytes store backed by SQLite, shared by all workers on the host.
+        Used as a second tier so a restarted worker starts warm.
+        Every `prune_every` writes, expired rows are deleted and the oldest rows beyond
+        `max_rows` are evicted (0 = no row cap), so the file does not grow without bound.
+        """
+        self.path = path
+        self.ttl = ttl if ttl and ttl > 0 else None
+        self.name = name
+        self.max_rows = max_rows
+        self.prune_every = max(1, prune_every)
+        self._local = threading.local()
+        self._writes_lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.pruned = 0
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, stored_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_stored_at ON cache (stored_at)")
+        self.prune()  # Whatever expired while no worker was running
+
+    def _connect(self) -> sqlite3.Connection:
+        # SQLite connections cannot be shared across threads, so keep one per executor thread.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            row = self._connect().execute("SELECT value, stored_at FROM cache WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"{self.name}: read failed: {e}")
+            return None
+        if row is None or (self.ttl is not None and time.time() - row[1] > self.ttl):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def set(self, key: str, value: bytes) -> None:
+        try:
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO cache (key, value, stored_at) VALUES (?, ?, ?)", (key, value, time.time()))
+        except sqlite3.Error as e:
+            logger.warning(f"{self.name}: write failed: {e}")
+            return
+        with self._writes_lock:
+            self._writes += 1
+            due = self._writes % self.prune_every == 0
+        if due:
+            self.prune()
+
+    def prune(self) -> int:
+        """Deletes expired rows, then the oldest rows beyond max_rows. Returns the number of rows removed."""
+        removed = 0
+        try:
+            with self._connect() as conn:
+                if self.ttl is not None:
+                    removed += conn.execute("DELETE FROM cache WHERE stored_at < ?", (time.time() - self.ttl,)).rowcount
+                if self.max_rows > 0:
+                    excess = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_rows
+                    if excess > 0:
+                        removed += conn.execute(
+                            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY stored_at LIMIT ?)", (excess,)
+                        ).rowcount
+        except sqlite3.Error as e:
+            logger.warning(f"{self.name}: prune failed: {e}")
+        self.pruned += removed
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "path": self.path,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "max_rows": self.max_rows,
+            "pruned": self.pruned,
+        }
@@ -0,0 +1,151 @@
+# contextpacker.py
+"""
+Packs retrieved chunks into the RAG prompt under a token budget.
+
+Chunks arrive in fused-rank order. Each one is kept unless it is a near
+duplicate of a chunk already packed (MinHash estimate of the Jaccard similarity
+of character shingles; Thai has no spaces, so word shingles do not work), and
+packing stops at the first chunk that would exceed the budget. Q&A chunks
+produced by preprocess/transform.py often repeat the same answer text, so this
+removes most of the redundant context before generation.
+"""
+
+import os
+import zlib
+import threading
+import logging
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from cache import normalize_query
+from systemprompt import estimate_tokens
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000")) # 0 disables the budget
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8")) # Estimated Jaccard at or above this is a duplicate; > 1 disables
+CONTEXT_SHINGLE_SIZE = int(os.getenv("CONTEXT_SHINGLE_SIZE", "5")) # Characters per shingle
+CONTEXT_MINHASH_PERMUTATIONS = 64
+CONTEXT_SEPARATOR = "\n-------\n"
+
+_PRIME = np.uint64(4294967311)  # Smallest prime above 2**32
+_rng = np.random.default_rng(66)
+_A = _rng.integers(1, 2**32, size=CONTEXT_MINHASH_PERMUTATIONS, dtype=np.uint64)
+_B = _rng.integers(0, 2**32, size=CONTEXT_MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+
+def minhash_signature(text: str, shingle_size: int = CONTEXT_SHINGLE_SIZE) -> np.ndarray:
+    """MinHash signature of the text's character shingles (after whitespace/case normalization)."""
+    text = normalize_query(text)
+    if len(text) <= shingle_size:
+        shingles = {text}
+    else:
+        shingles = {text[i:i + shingle_size] for i in range(len(text) - shingle_size + 1)}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    # (a * h + b) mod p for every permutation at once; a, b, h < 2**32 so the product fits in uint64.
+    return ((np.outer(hashes, _A) + _B) % _PRIME).min(axis=0)
+
+
+def estimated_jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.mean(a == b))
+
+
+class PackStats:
+    def __init__(self):
+        """Process-wide totals, reported under /stats."""
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.chunks_in = 0
+        self.packed = 0
+        self.duplicates = 0
+        self.over_budget = 0
+        self.tokens_in = 0
+        self.tokens_packed = 0
+
+    def record(self, report: Dict[str, Any]) -> None:
+        with self._lock:
+            self.requests += 1
+            self.chunks_in += report["chunks"]
+            self.packed += report["packed"]
+            self.duplicates += report["dropped_duplicate"]
+            self.over_budget += report["dropped_budget"]
+            self.tokens_in += report["tokens_in"]
+            self.tokens_packed += report["tokens_packed"]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "budget": CONTEXT_TOKEN_BUDGET,
+                "dedup_threshold": CONTEXT_DEDUP_THRESHOLD,
+                "requests": self.requests,
+                "chunks_in": self.chunks_in,
+                "packed": self.packed,
+                "dropped_duplicate": self.duplicates,
+                "dropped_budget": self.over_budget,
+                "token_reduction": round(1 - self.tokens_packed / self.tokens_in, 4) if self.tokens_in else 0.0,
+            }
+
+
+PACK_STATS = PackStats()
+
+
+def pack_context(chunks: List[str], budget: int = CONTEXT_TOKEN_BUDGET, threshold: float = CONTEXT_DEDUP_THRESHOLD,
+                 separator: str = CONTEXT_SEPARATOR) -> Tuple[str, Dict[str, Any]]:
+    """
+    Returns (joined context, report). The report lists every input chunk with its
+    rank, estimated tokens and status: "packed", "duplicate" (with the rank it
+    duplicates) or "over_budget".
+    """
+    separator_tokens = estimate_tokens(separator)
+    packed: List[str] = []
+    signatures: List[Tuple[int, np.ndarray]] = []
+    items: List[Dict[str, Any]] = []
+    used = 0
+    budget_reached = False
+
+    for rank, chunk in enumerate(chunks):
+        tokens = estimate_tokens(chunk)
+        item: Dict[str, Any] = {"rank": rank, "tokens": tokens}
+        items.append(item)
+        if budget_reached:
+            item["status"] = "over_budget"
+            continue
+
+        if threshold <= 1.0:
+            signature = minhash_signature(chunk)
+            duplicate_of = next((r for r, s in signatures if estimated_jaccard(signature, s) >= threshold), None)
+            if duplicate_of is not None:
+                item.update(status="duplicate", duplicate_of=duplicate_of)
+                continue
+        else:
+            signature = None
+
+        cost = tokens + (separator_tokens if packed else 0)
+        # Always keep the top-ranked chunk, even if it alone exceeds the budget.
+        if budget > 0 and packed and used + cost > budget:
+            item["status"] = "over_budget"
+            budget_reached = True
+            continue
+        packed.append(chunk)
+        if signature is not None:
+            signatures.append((rank, signature))
+        used += cost
+        item["status"] = "packed"
+
+    statuses = [item["status"] for item in items]
+    report = {
+        "chunks": len(chunks),
+        "packed": statuses.count("packed"),
+        "dropped_duplicate": statuses.count("duplicate"),
+        "dropped_budget": statuses.count("over_budget"),
+        "tokens_in": sum(item["tokens"] for item in items) + separator_tokens * max(0, len(chunks) - 1),
+        "tokens_packed": used,
+        "budget": budget,
+        "items": items,
+    }
+    PACK_STATS.record(report)
+    return separator.join(packed), report
@@ -0,0 +1,35 @@
+# download_model.py
+"""
+Downloads the embedding model snapshot to a local directory (used by the Dockerfile).
+
+Only the files SentenceTransformer needs are fetched: the configs, the
+tokenizer, the pooling module and one copy of the weights (safetensors when the
+repo has them). The repo's ONNX export and BGE-m3's sparse/ColBERT heads are
+skipped. Point EMBED_MODEL_PATH at the result and the app never contacts the hub.
+
+Usage: python download_model.py [target_dir] [repo_id]
+"""
+
+import os
+import sys
+import time
+
+from huggingface_hub import HfApi, snapshot_download
+
+DEFAULT_REPO = "BAAI/bge-m3"
+DEFAULT_TARGET = os.getenv("EMBED_MODEL_PATH", "/models/bge-m3")
+
+
+def download(target: str = DEFAULT_TARGET, repo_id: str = DEFAULT_REPO) -> str:
+    files = HfApi().list_repo_files(repo_id)
+    weights = ["model.safetensors"] if "model.safetensors" in files else ["pytorch_model.bin"]
+    patterns = ["*.json", "sentencepiece.bpe.model", "1_Pooling/*"] + weights
+    start = time.perf_counter()
+    path = snapshot_download(repo_id, local_dir=target, allow_patterns=patterns, ignore_patterns=["onnx/*", "imgs/*"])
+    size = sum(os.path.getsize(os.path.join(root, f)) for root, _, names in os.walk(path) for f in names)
+    print(f"Downloaded {repo_id} ({size / 2**30:.2f} GiB, weights: {weights[0]}) to {path} in {time.perf_counter() - start:.0f} s")
+    return path
+
+
+if __name__ == "__main__":
+    download(*(sys.argv[1:3]))
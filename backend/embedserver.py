@@ -0,0 +1,281 @@
+# embedserver.py
+"""
+Shared embedding server for multi-worker deployments.
+
+`uvicorn main:app --workers N` would otherwise hold N copies of BGE-m3. Here one
+process owns EMBED_SERVER_REPLICAS model replicas and serves every API worker
+over a Unix domain socket; requests from all workers are merged into the same
+micro-batches (models.EmbeddingBatcher), so memory scales with the replicas, not
+with the workers.
+
+    python embedserver.py                      # serves on EMBED_SERVER_SOCKET
+    EMBED_SERVER_SOCKET=/tmp/rabbit-embed.sock uvicorn main:app --workers 4
+
+Wire format, both directions: a 4-byte big-endian length, a JSON header of that
+length, then the header's "bytes" of payload (row-major float32 vectors for
+embed responses). Requests carry an "id" so one connection can pipeline many.
+
+With EMBED_SERVER_SOCKET set, models.Embedder uses EmbedClient; if the server
+cannot be reached it falls back to the in-process model (EMBED_SERVER_FALLBACK)
+and retries the server after EMBED_SERVER_RETRY_SECONDS.
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import struct
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+EMBED_SERVER_SOCKET = os.getenv("EMBED_SERVER_SOCKET", "") # Unix socket path; empty keeps the model in-process
+EMBED_SERVER_REPLICAS = int(os.getenv("EMBED_SERVER_REPLICAS", "1")) # Model copies in the server, each encodes one batch at a time
+EMBED_SERVER_TIMEOUT = float(os.getenv("EMBED_SERVER_TIMEOUT", "10")) # Seconds per request, including queueing in the server
+EMBED_SERVER_FALLBACK = os.getenv("EMBED_SERVER_FALLBACK", "true").lower() == "true" # Load the model in-process when the server is down
+EMBED_SERVER_RETRY_SECONDS = float(os.getenv("EMBED_SERVER_RETRY_SECONDS", "5")) # After a failure, skip the server for this long
+EMBED_SERVER_WAIT_SECONDS = float(os.getenv("EMBED_SERVER_WAIT_SECONDS", "300")) # How long an API worker waits for the server at startup
+
+_LENGTH = struct.Struct(">I")
+
+
+class EmbedServerUnavailable(Exception):
+    pass
+
+
+async def write_frame(writer: asyncio.StreamWriter, header: Dict[str, Any], payload: bytes = b"") -> None:
+    header = {**header, "bytes": len(payload)}
+    data = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    writer.write(_LENGTH.pack(len(data)) + data + payload)
+    await writer.drain()
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[Dict[str, Any], bytes]:
+    (length,) = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+    header = json.loads(await reader.readexactly(length))
+    payload = await reader.readexactly(header.get("bytes", 0)) if header.get("bytes") else b""
+    return header, payload
+
+
+class EmbedClient:
+    def __init__(self, path: str = EMBED_SERVER_SOCKET, timeout: float = EMBED_SERVER_TIMEOUT):
+        """Async client for one API worker; a single pipelined connection, reopened on demand."""
+        self.path = path
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._read_task: Optional[asyncio.Task] = None
+        self._connect_lock: Optional[asyncio.Lock] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_id = 0
+        self._down_until = 0.0
+        self.requests = 0
+        self.texts = 0
+        self.errors = 0
+        self.fallbacks = 0
+        self.latency_ms = 0.0
+
+    @property
+    def available(self) -> bool:
+        """False for EMBED_SERVER_RETRY_SECONDS after a failure, so callers fall back without waiting on timeouts."""
+        return time.monotonic() >= self._down_until
+
+    async def _connect(self) -> asyncio.StreamWriter:
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+            self._write_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer is None or self._writer.is_closing():
+                self._reader, self._writer = await asyncio.wait_for(asyncio.open_unix_connection(self.path), self.timeout)
+                self._read_task = asyncio.get_running_loop().create_task(self._read_loop(self._reader))
+            return self._writer
+
+    async def _read_loop(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                header, payload = await read_frame(reader)
+                future = self._pending.pop(header.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result((header, payload))
+        except Exception as e:
+            error = EmbedServerUnavailable(f"Connection to the embedding server lost: {e!r}")
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self._pending.clear()
+            if self._writer is not None:
+                self._writer.close()
+            self._writer = None
+
+    async def request(self, op: str, **fields: Any) -> Tuple[Dict[str, Any], bytes]:
+        try:
+            writer = await self._connect()
+            self._next_id += 1
+            request_id = self._next_id
+            future = asyncio.get_running_loop().create_future()
+            self._pending[request_id] = future
+            async with self._write_lock:
+                await write_frame(writer, {"op": op, "id": request_id, **fields})
+            header, payload = await asyncio.wait_for(future, self.timeout)
+        except EmbedServerUnavailable:
+            self.errors += 1
+            self._down_until = time.monotonic() + EMBED_SERVER_RETRY_SECONDS
+            raise
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            self.errors += 1
+            self._down_until = time.monotonic() + EMBED_SERVER_RETRY_SECONDS
+            raise EmbedServerUnavailable(f"Embedding server at {self.path} unavailable: {e!r}") from e
+        finally:
+            if "request_id" in locals():
+                self._pending.pop(request_id, None)
+        self._down_until = 0.0
+        if header.get("error"):
+            raise RuntimeError(f"Embedding server error: {header['error']}")
+        return header, payload
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        start = time.perf_counter()
+        header, payload = await self.request("embed", texts=texts)
+        self.requests += 1
+        self.texts += len(texts)
+        self.latency_ms += (time.perf_counter() - start) * 1000
+        return np.frombuffer(payload, dtype=np.float32).reshape(header["shape"])
+
+    async def ping(self) -> Dict[str, Any]:
+        header, _ = await self.request("ping")
+        return header
+
+    async def wait_ready(self, timeout: float = EMBED_SERVER_WAIT_SECONDS) -> Dict[str, Any]:
+        """Pings until the server answers; it only listens once its replicas are loaded and warm."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return await self.ping()
+            except EmbedServerUnavailable:
+                if time.monotonic() >= deadline:
+                    raise
+                await asyncio.sleep(0.5)
+
+    async def server_stats(self) -> Dict[str, Any]:
+        header, _ = await self.request("stats")
+        return header.get("stats", {})
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "socket": self.path,
+            "available": self.available,
+            "requests": self.requests,
+            "texts": self.texts,
+            "errors": self.errors,
+            "fallbacks": self.fallbacks,
+            "avg_latency_ms": round(self.latency_ms / self.requests, 2) if self.requests else 0.0,
+        }
+
+
+class EmbedServer:
+    def __init__(self, path: str = EMBED_SERVER_SOCKET, replicas: int = EMBED_SERVER_REPLICAS):
+        """Owns the model replicas; one shared batcher feeds whichever replica is free."""
+        from models import BGE, EMBEDDING_BACKEND, EmbeddingModel, EmbeddingBatcher
+        from onnxembed import OnnxEmbeddingModel
+
+        self.path = path
+        self.replicas = max(1, replicas)
+        self.backend = EMBEDDING_BACKEND
+        make = OnnxEmbeddingModel if EMBEDDING_BACKEND == "onnx" else EmbeddingModel
+        self.models = [BGE] + [make() for _ in range(self.replicas - 1)]
+        self._free: "queue.Queue" = queue.Queue()
+        for model in self.models:
+            self._free.put(model)
+        self.executor = ThreadPoolExecutor(max_workers=self.replicas, thread_name_prefix="embed-server")
+        self.batcher = EmbeddingBatcher(self._encode, self.executor, max_concurrent_batches=self.replicas)
+        self.connections = 0
+        self.started_at = time.monotonic()
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        model = self._free.get()
+        try:
+            return np.asarray(model.encode(texts, batch_size=len(texts)), dtype=np.float32)
+        finally:
+            self._free.put(model)
+
+    def load(self) -> None:
+        for i, model in enumerate(self.models):
+            model.load()
+            model.warmup()
+            logger.info(f"Replica {i + 1}/{self.replicas} ready ({self.backend}, load {model.load_ms:.0f} ms, warm-up {model.warmup_ms:.0f} ms).")
+
+    async def _embed(self, writer: asyncio.StreamWriter, write_lock: asyncio.Lock, header: Dict[str, Any]) -> None:
+        try:
+            vectors = await asyncio.gather(*(self.batcher.submit(text) for text in header["texts"]))
+            matrix = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1) if vectors else np.zeros((0, 0), dtype=np.float32)
+            response, payload = {"id": header["id"], "shape": list(matrix.shape)}, matrix.tobytes()
+        except Exception as e:
+            logger.error(f"Embedding request failed: {e}", exc_info=True)
+            response, payload = {"id": header["id"], "error": str(e)}, b""
+        async with write_lock:
+            await write_frame(writer, response, payload)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                header, _ = await read_frame(reader)
+                op = header.get("op")
+                if op == "embed":
+                    task = asyncio.get_running_loop().create_task(self._embed(writer, write_lock, header))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    continue
+                if op == "ping":
+                    response = {"id": header.get("id"), "ok": True, "backend": self.backend, "replicas": self.replicas}
+                elif op == "stats":
+                    response = {"id": header.get("id"), "stats": self.stats()}
+                else:
+                    response = {"id": header.get("id"), "error": f"unknown op {op!r}"}
+                async with write_lock:
+                    await write_frame(writer, response)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections -= 1
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "replicas": self.replicas,
+            "connections": self.connections,
+            "uptime_s": round(time.monotonic() - self.started_at, 1),
+            "batcher": self.batcher.stats(),
+        }
+
+    async def serve(self) -> None:
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # Stale socket from a previous run
+        server = await asyncio.start_unix_server(self._handle, path=self.path)
+        os.chmod(self.path, 0o660)
+        logger.info(f"Embedding server listening on {self.path} ({self.replicas} replica(s), {self.backend}).")
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    path = sys.argv[1] if len(sys.argv) > 1 else (EMBED_SERVER_SOCKET or "/tmp/rabbit-embed.sock")
+    embed_server = EmbedServer(path)
+    embed_server.load()
+    asyncio.run(embed_server.serve())
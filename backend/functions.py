@@ -3,10 +3,20 @@ import os
 import logging
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient # IMPORT AsyncMongoClient
-from pythainlp.tokenize import word_tokenize # Moved import here
 import models # Keep standard import
+from bson import ObjectId
+from cache import LRUCache, normalize_query
 import asyncio
-from typing import Optional, Dict
+import time
+from vectorindex import LocalVectorIndex
+from keywordindex import BM25Index
+from tokenizer import ThaiTokenizer
+import fusion
+import numpy as np
+from quantization import EMBEDDING_STORAGE, atlas_int8, decode_vector
+from bson.binary import Binary, BinaryVectorDtype
+from typing import Optional, Dict, Any, Awaitable
+from metrics import record_cache, time_stage
 # import time # No longer needed for reranker
 # import numpy as np # No longer needed for reranker
 # import onnxruntime as ort # No longer needed for reranker
@@ -25,61 +35,353 @@ DATABASE_URL = os.getenv("MONGO_URL")
 DB_NAME = "rabbit-reward"
 DEFAULT_VECTOR_INDEX = "default" # Example: Make configurable
 DEFAULT_KEYWORD_INDEX = "default" # Example: Make configurable
+VECTOR_SEARCH_BACKEND = os.getenv("VECTOR_SEARCH_BACKEND", "atlas") # "atlas" ($vectorSearch) or "local" (in-process index)
+KEYWORD_SEARCH_BACKEND = os.getenv("KEYWORD_SEARCH_BACKEND", "atlas") # "atlas" ($search) or "local" (in-process BM25)
+VECTOR_BRANCH_TIMEOUT = float(os.getenv("VECTOR_BRANCH_TIMEOUT", "5.0")) # Seconds, includes query embedding
+KEYWORD_BRANCH_TIMEOUT = float(os.getenv("KEYWORD_BRANCH_TIMEOUT", "3.0")) # Seconds, includes tokenization
+KB_META_COLLECTION = "kb_meta" # Holds the version stamp written by preprocess/todb.py at ingestion time
+KB_VERSION_REFRESH = float(os.getenv("KB_VERSION_REFRESH", "30")) # Seconds between version stamp reads
+ATLAS_RESCORE = int(os.getenv("ATLAS_RESCORE", "4")) # With int8 storage, fetch top_k * this from Atlas and rescore on embedding_full
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "1024")) # Subqueries kept in the retrieval cache, 0 disables it
+
+async def run_retrieval_branches(branches: Dict[str, Awaitable[list]], timeouts: Dict[str, float]) -> tuple[Dict[str, list], Dict[str, Dict[str, Any]]]:
+    """
+    Runs retrieval branches concurrently, each under its own deadline.
+    A branch that times out or raises is dropped instead of failing the whole search.
+    Returns (results of successful branches, per-branch report of status/count/elapsed_ms).
+    """
+    async def _run(name: str, branch: Awaitable[list]):
+        start = time.perf_counter()
+        try:
+            docs = await asyncio.wait_for(branch, timeout=timeouts.get(name))
+            status = "ok"
+        except asyncio.TimeoutError:
+            logger.warning(f"Retrieval branch '{name}' exceeded its {timeouts.get(name)}s deadline.")
+            docs, status = None, "timeout"
+        except Exception as e:
+            logger.error(f"Retrieval branch '{name}' failed: {e}", exc_info=True)
+            docs, status = None, "error"
+        elapsed_ms = round((time.perf_counter() - start) * 1000, 1)
+        return name, docs, {"status": status, "count": len(docs or []), "elapsed_ms": elapsed_ms}
+
+    outcomes = await asyncio.gather(*(_run(name, branch) for name, branch in branches.items()))
+    results = {name: docs for name, docs, _ in outcomes if docs is not None}
+    report = {name: info for name, _, info in outcomes}
+    return results, report
 
 class MongoHybridSearch:
-    def __init__(self, database_name=DB_NAME, mongo_uri=DATABASE_URL):
+    def __init__(self, database_name=DB_NAME, mongo_uri=DATABASE_URL, llm_analyzer: Optional[models.LLMFinanceAnalyzer] = None):
         """
         Initialize MongoDB connection and embedder.
+        Pass the application's llm_analyzer to share it instead of constructing a second one.
         """
         try:
+            # Start the tokenizer pool before opening Mongo connections so forked workers inherit none.
+            self.tokenizer = ThaiTokenizer()
             self.client = AsyncIOMotorClient(mongo_uri)
             self.database = self.client[database_name]
             # Consider making collection name configurable
             self.collection = self.database["rabbit-reward"]
             # self.collection_fact = self.database["SCG_financial_report_jai"]
-            self.llm_analyzer = models.LLMFinanceAnalyzer()
+            self.llm_analyzer = llm_analyzer or models.LLMFinanceAnalyzer()
             self.embedder = models.Embedder() # Instantiate Embedder class from models
-            logger.info("MongoHybridSearch initialized successfully.")
+            self.vector_index = LocalVectorIndex() if VECTOR_SEARCH_BACKEND == "local" else None
+            self._vector_index_lock = asyncio.Lock()
+            self._vector_build_task: Optional[asyncio.Task] = None
+            self.keyword_index = BM25Index() if KEYWORD_SEARCH_BACKEND == "local" else None
+            self._keyword_index_lock = asyncio.Lock()
+            self._kb_version: Optional[str] = None
+            self._kb_version_checked_at = 0.0
+            # (kb_version, normalized subquery) -> fused document ids
+            self.retrieval_cache = LRUCache(RETRIEVAL_CACHE_SIZE, name="retrieval")
+            logger.info(f"MongoHybridSearch initialized successfully (vector backend: {VECTOR_SEARCH_BACKEND}, keyword backend: {KEYWORD_SEARCH_BACKEND}).")
         except Exception as e:
             logger.error(f"Failed to initialize MongoHybridSearch: {e}")
             raise # Re-raise exception to prevent app from starting with bad config
 
-    async def search_documents(self, query: str) -> list[str]:
+    async def search_documents(self, query: str, report: Optional[Dict[str, Any]] = None) -> list[str]:
         """
         Find relevant data for each (subquery, original_query, quarter, year).
         Args:
             query_list (list): List of tuples (subquery, original_query, quarter, year).
+            report (dict, optional): Filled with per-branch retrieval status, the branches that contributed
+                and `complete` (every branch returned, so the result is as good as a cached one).
         Returns:
             list: List of lists, where each inner list contains relevant document content strings.
                   Returns empty list if an error occurs during the overall search process.
         """
         try:
-            all_docs_content = []
-            
+            # Fused results are deterministic for a subquery until the collection is re-ingested,
+            # so cache the ids under the current knowledge-base version.
+            kb_version = await self.get_kb_version()
+            cache_key = (kb_version, normalize_query(query))
+            cached = self.retrieval_cache.get(cache_key)
+            if cached is not None:
+                contents = await self._fetch_contents(cached["ids"])
+                if len(contents) == len(cached["ids"]):
+                    record_cache("retrieval", True)
+                    logger.info(f"Retrieval cache hit for query: '{query}'")
+                    if report is not None:
+                        report["cache"] = "hit"
+                        report["contributed"] = cached["contributed"]
+                        report["complete"] = True
+                    return contents
+                logger.warning("Cached retrieval ids no longer resolve, searching again.")
+
             # for subquery, subkeyword, quarter, year in query_list: # Unpack the tuple
                 # Pass configured index names
-            result_content = await self.atlas_hybrid_search(collection_name = self.collection,
+            record_cache("retrieval", False)
+            report = report if report is not None else {}
+            fused_documents = await self.hybrid_search_documents(collection_name = self.collection,
                 query=query,
-                
                 top_k=100, # Consider making configurable
                 exact_top_k=17, # Consider making configurable
                 vector_index_name=DEFAULT_VECTOR_INDEX,
                 keyword_index_name=DEFAULT_KEYWORD_INDEX,
-                
+                report=report,
             )
-            all_docs_content.append(result_content)
-            return result_content
+            report["cache"] = "miss"
+            # Only complete results are cached: the cache is invalidated by re-ingestion alone, so a
+            # branch that timed out or failed once would otherwise be missing for this query until then.
+            branches = report.get("branches", {})
+            report["complete"] = bool(branches) and all(info["status"] == "ok" for info in branches.values())
+            if fused_documents and report["complete"]:
+                self.retrieval_cache.set(cache_key, {
+                    "ids": [doc["_id"] for doc in fused_documents],
+                    "contributed": report.get("contributed", []),
+                })
+            return [doc["content"] for doc in fused_documents]
         except Exception as e:
             logger.error(f"Error in search_documents: {e}")
             return [] # Return empty list on failure
 
+    async def get_kb_version(self) -> str:
+        """
+        Returns the knowledge-base version stamp written at ingestion time.
+        The stamp is re-read at most every KB_VERSION_REFRESH seconds.
+        """
+        now = time.monotonic()
+        if self._kb_version is not None and now - self._kb_version_checked_at < KB_VERSION_REFRESH:
+            return self._kb_version
+        try:
+            meta = await self.database[KB_META_COLLECTION].find_one({"_id": self.collection.name})
+            self._kb_version = str(meta["version"]) if meta and meta.get("version") else "unversioned"
+        except Exception as e:
+            logger.error(f"Failed to read knowledge base version: {e}")
+            if self._kb_version is None:
+                self._kb_version = "unversioned"
+        self._kb_version_checked_at = now
+        return self._kb_version
+
+    async def _fetch_contents(self, ids: list[str]) -> list[str]:
+        """Returns document contents for the given ids, in the same order. Missing ids are skipped."""
+        object_ids = [ObjectId(i) if ObjectId.is_valid(i) else i for i in ids]
+        cursor = self.collection.find({"_id": {"$in": object_ids}}, {"_id": 1, "content": 1})
+        by_id = {str(doc["_id"]): str(doc.get("content", "")) for doc in await cursor.to_list(length=len(ids))}
+        return [by_id[i] for i in ids if i in by_id]
+
+    async def _ensure_vector_index(self) -> bool:
+        """
+        Loads the local vector index from disk when a newer build matches the knowledge-base version.
+        Never builds on the request path (a build does not fit the branch deadline): a missing build
+        is started in the background and the caller falls back to Atlas until it is published.
+        """
+        kb_version = await self.get_kb_version()
+        if self.vector_index.is_loaded and self.vector_index.kb_version == kb_version:
+            return True
+        if self._vector_index_lock.locked():
+            return False  # Build in progress
+        if self.vector_index.load() and self.vector_index.kb_version == kb_version:
+            return True
+        if self._vector_build_task is None or self._vector_build_task.done():
+            logger.info(f"No local vector index build for knowledge base version {kb_version}, building in the background.")
+            self._vector_build_task = asyncio.get_running_loop().create_task(self.build_vector_index(kb_version))
+        return False
+
+    async def build_vector_index(self, kb_version: str) -> bool:
+        """Builds (or picks up another worker's build of) the local vector index for kb_version."""
+        async with self._vector_index_lock:
+            if self.vector_index.is_loaded and self.vector_index.kb_version == kb_version:
+                return True
+            try:
+                return await self.vector_index.build_from_collection(self.collection, kb_version)
+            except Exception as e:
+                logger.error(f"Building the local vector index failed: {e}", exc_info=True)
+                return False
+
+    async def prepare_indexes(self) -> Dict[str, Any]:
+        """
+        Loads or builds the local indexes before the worker takes traffic, so the first
+        queries do not pay for it. Returns per-index status and timing for /stats.
+        """
+        report: Dict[str, Any] = {}
+        kb_version = await self.get_kb_version()
+        if self.vector_index is not None:
+            start = time.perf_counter()
+            ready = (self.vector_index.load() and self.vector_index.kb_version == kb_version) or await self.build_vector_index(kb_version)
+            report["vector"] = {"ready": ready, "build_id": self.vector_index.build_id, "ms": round((time.perf_counter() - start) * 1000, 1)}
+        if self.keyword_index is not None:
+            start = time.perf_counter()
+            ready = await self._ensure_keyword_index()
+            report["keyword"] = {"ready": ready, "ms": round((time.perf_counter() - start) * 1000, 1)}
+        return report
+
+    async def vector_search(self, query_vector: list[float], top_k: int, vector_index_name: str) -> list[dict]:
+        """
+        Dense retrieval. Uses the in-process index when VECTOR_SEARCH_BACKEND is "local",
+        falling back to Atlas $vectorSearch if the local index is unavailable.
+        Returns a list of {_id, content, score} dicts, best first.
+        """
+        if self.vector_index is not None:
+            try:
+                if await self._ensure_vector_index():
+                    return self.vector_index.search(query_vector, top_k)
+                logger.warning("Local vector index unavailable, falling back to Atlas $vectorSearch.")
+            except Exception as e:
+                logger.error(f"Local vector search failed, falling back to Atlas $vectorSearch: {e}", exc_info=True)
+
+        # With int8 storage the Atlas index holds int8 codes: query with codes of the same scale,
+        # over-fetch, and rescore the candidates against the stored float32 vectors.
+        quantized = EMBEDDING_STORAGE == "int8"
+        limit = top_k * ATLAS_RESCORE if quantized else top_k
+        atlas_query = Binary.from_vector(atlas_int8(query_vector).tolist(), BinaryVectorDtype.INT8) if quantized else query_vector
+        projection = {"_id": 1, "content": 1, "score": {"$meta": "vectorSearchScore"}}
+        if quantized:
+            projection["embedding_full"] = 1
+        vector_pipeline = [
+            {
+                "$vectorSearch": {
+                    "queryVector": atlas_query,
+                    "path": "embedding", # Ensure 'embedding' is the correct field name
+                    "numCandidates": max(10000, limit), # Consider making configurable
+                    "limit": limit,
+                    "index": vector_index_name,
+                    # "filter": {
+                    #     "$and": [
+                    #         {"quarter": {"$in": quarter_str}},
+                    #         {"year": {"$in": year_str}}
+                    #     ]
+                    # }
+                }
+            },
+            {"$project": projection}
+        ]
+        vector_results_cursor = self.collection.aggregate(vector_pipeline)
+        vector_results = await vector_results_cursor.to_list(length=limit)
+        if quantized:
+            vector_results = self._rescore_full_precision(query_vector, vector_results, top_k)
+        return vector_results
+
+    @staticmethod
+    def _rescore_full_precision(query_vector: list[float], docs: list[dict], top_k: int) -> list[dict]:
+        """Re-ranks Atlas int8 candidates by exact cosine on `embedding_full`, using the (1 + cos) / 2 score scale."""
+        rescorable = [doc for doc in docs if doc.get("embedding_full") is not None]
+        if not rescorable:
+            return docs[:top_k]
+        query = np.asarray(query_vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        matrix = np.vstack([decode_vector(doc.pop("embedding_full")) for doc in rescorable])
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        scores = matrix @ query
+        order = np.argsort(-scores, kind="stable")[:top_k]
+        return [{**rescorable[i], "score": float((1.0 + scores[i]) / 2.0)} for i in order.tolist()]
+
+    async def _ensure_keyword_index(self) -> bool:
+        """Builds the local BM25 index from the collection on first use and after re-ingestion."""
+        kb_version = await self.get_kb_version()
+        if self.keyword_index.is_loaded and self.keyword_index.kb_version == kb_version:
+            return True
+        async with self._keyword_index_lock:
+            if self.keyword_index.is_loaded and self.keyword_index.kb_version == kb_version:
+                return True
+            logger.info(f"Building local BM25 keyword index for knowledge base version {kb_version}.")
+            return await self.keyword_index.build_from_collection(self.collection, kb_version)
+
+    async def keyword_search(self, query_tokens: list[str], top_k: int, keyword_index_name: str) -> list[dict]:
+        """
+        Lexical retrieval over `content_tokenized`. Uses the in-process BM25 index when
+        KEYWORD_SEARCH_BACKEND is "local", falling back to Atlas $search if it cannot be built.
+        Returns a list of {_id, content, score} dicts, best first.
+        """
+        if self.keyword_index is not None:
+            try:
+                if await self._ensure_keyword_index():
+                    return self.keyword_index.search(query_tokens, top_k)
+                logger.warning("Local keyword index unavailable, falling back to Atlas $search.")
+            except Exception as e:
+                logger.error(f"Local keyword search failed, falling back to Atlas $search: {e}", exc_info=True)
+
+        keyword_pipeline = [
+            {
+                "$search": {
+                    "index": keyword_index_name,
+                    "text": {
+                        "query": query_tokens,
+                        "path": "content_tokenized" 
+                        }
+                }
+            },
+            # {
+            #     "$match": {
+            #         "$and": [
+            #             {"quarter": {"$in": quarter_str}},
+            #             {"year": {"$in": year_str}}
+            #         ]
+            #     }
+            # },
+            {
+                "$project": {
+                    "_id": 1,
+                    "content": 1,
+                    "score": {"$meta": "searchScore"}
+                }
+            },
+            {"$limit": top_k}
+        ]
+        keyword_results_cursor = self.collection.aggregate(keyword_pipeline)
+        keyword_results = await keyword_results_cursor.to_list(length=top_k) # Using length for explicit limit from cursor
+        return keyword_results
+
+    async def _vector_branch(self, query: str, top_k: int, vector_index_name: str) -> list[dict]:
+        """Dense branch: embed the query, then run vector search."""
+        query_vector = await self.embedder.embed(query, "query")
+        if not query_vector:
+            raise RuntimeError(f"Failed to get embedding for query: {query}")
+        with time_stage("vector_search"):
+            vector_results = await self.vector_search(query_vector, top_k, vector_index_name)
+        logger.info(f"Vector search found {len(vector_results)} results for query: '{query}'")
+        return vector_results
+
+    async def _keyword_branch(self, query: str, top_k: int, keyword_index_name: str) -> list[dict]:
+        """Lexical branch: tokenize the query in the tokenizer pool, then run keyword search."""
+        query_tokens = await self.tokenizer.tokenize(query)
+        logger.info(f"Keyword search tokens: {query_tokens}")
+        with time_stage("keyword_search"):
+            keyword_results = await self.keyword_search(query_tokens, top_k, keyword_index_name)
+        logger.info(f"Keyword search found {len(keyword_results)} results for query: '{query}'")
+        return keyword_results
+
     async def atlas_hybrid_search(self, collection_name :str, query: str, top_k: int, exact_top_k: int,
                             vector_index_name: str, keyword_index_name: str,
+                            report: Optional[Dict[str, Any]] = None,
                             ) -> list[str]:
         """
-        Perform hybrid search using Atlas Vector Search & Keyword Search.
+        Perform hybrid search using Vector Search & Keyword Search.
         Returns a list of document content strings.
         """
+        fused_documents = await self.hybrid_search_documents(collection_name, query, top_k, exact_top_k,
+                                                             vector_index_name, keyword_index_name, report)
+        return [e["content"] for e in fused_documents]
+
+    async def hybrid_search_documents(self, collection_name :str, query: str, top_k: int, exact_top_k: int,
+                            vector_index_name: str, keyword_index_name: str,
+                            report: Optional[Dict[str, Any]] = None,
+                            ) -> list[dict]:
+        """
+        Perform hybrid search using Vector Search & Keyword Search.
+        Both branches run concurrently with their own deadlines; fusion uses whichever branches return.
+        Returns the fused documents as {_id, content} dicts, best first.
+        """
         try:
             # Ensure quarter and year are strings for MongoDB query
             # quarter_str = [str(quarter)]
@@ -93,90 +395,40 @@ class MongoHybridSearch:
             # else:
             #     pass
 
-            query_vector = await self.embedder.embed(query, "query")
-            print(len(query_vector))
-            # query_vector = query_vector[0]
-            if not query_vector:
-                 logger.error(f"Failed to get embedding for query: {query}")
-                 return []
-            
-            # Perform vector search
-            vector_pipeline = [
+            branch_results, branch_report = await run_retrieval_branches(
                 {
-                    "$vectorSearch": {
-                        "queryVector": query_vector,
-                        "path": "embedding", # Ensure 'embedding' is the correct field name
-                        "numCandidates": 10000, # Consider making configurable
-                        "limit": top_k,
-                        "index": vector_index_name,
-                        # "filter": {
-                        #     "$and": [
-                        #         {"quarter": {"$in": quarter_str}},
-                        #         {"year": {"$in": year_str}}
-                        #     ]
-                        # }
-                    }
+                    "vector": self._vector_branch(query, top_k, vector_index_name),
+                    "keyword": self._keyword_branch(query, top_k, keyword_index_name),
                 },
-                {"$project": {"_id": 1, "content": 1, "score": {"$meta": "vectorSearchScore"}}}
-            ]
-            vector_results_cursor = self.collection.aggregate(vector_pipeline)
-            vector_results = await vector_results_cursor.to_list(length=top_k)
-            logger.info(f"Vector search found {len(vector_results)} results for query: '{query}'")
-
-
-            # Tokenize query for keyword search using PyThaiNLP
-            query_tokens = word_tokenize(query, engine="newmm", keep_whitespace=False)
-            logger.info(f"Keyword search tokens: {query_tokens}")
-
-            # Perform keyword search (Atlas Search)
-            keyword_pipeline = [
-                {
-                    "$search": {
-                        "index": keyword_index_name,
-                        "text": {
-                            "query": query_tokens,
-                            "path": "content_tokenized" 
-                            }
-                    }
-                },
-                # {
-                #     "$match": {
-                #         "$and": [
-                #             {"quarter": {"$in": quarter_str}},
-                #             {"year": {"$in": year_str}}
-                #         ]
-                #     }
-                # },
-                {
-                    "$project": {
-                        "_id": 1,
-                        "content": 1,
-                        "score": {"$meta": "searchScore"}
-                    }
-                },
-                {"$limit": top_k}
-            ]
-            keyword_results_cursor = self.collection.aggregate(keyword_pipeline)
-            keyword_results = await keyword_results_cursor.to_list(length=top_k) # Using length for explicit limit from cursor
-            logger.info(f"Keyword search found {len(keyword_results)} results for query: '{query}'")
-
+                {"vector": VECTOR_BRANCH_TIMEOUT, "keyword": KEYWORD_BRANCH_TIMEOUT},
+            )
+            contributed = [name for name, docs in branch_results.items() if docs]
+            if report is not None:
+                report["branches"] = branch_report
+                report["contributed"] = contributed
+            if not branch_results:
+                logger.error(f"All retrieval branches failed for query: '{query}'")
+                return []
 
-            # Apply Weighted Reciprocal Rank Fusion (WRRF)
-            # Prepare results in the expected format for WRRF: list of dicts with _id and content
-            print(f"Vector results: {len(vector_results)}, Keyword results: {len(keyword_results)}")
-            vec_docs = [{"_id": str(doc["_id"]), "content": doc.get("content", "")} for doc in vector_results]
-            key_docs = [{"_id": str(doc["_id"]), "content": doc.get("content", "")} for doc in keyword_results]
+            # Apply rank fusion (method and per-branch weights are configured in fusion.py)
+            # Prepare results in the expected format: list of dicts with _id, content and the branch's raw score
+            logger.debug(f"Retrieval branches: { {name: info['count'] for name, info in branch_report.items()} }")
+            doc_lists = {
+                name: [{"_id": str(doc["_id"]), "content": doc.get("content", ""), "score": doc.get("score", float("nan"))} for doc in docs]
+                for name, docs in branch_results.items()
+            }
 
             # Handle potential missing 'content' key more robustly
             # Ensure content is string
-            for doc_list in [vec_docs, key_docs]:
+            for doc_list in doc_lists.values():
                  for doc in doc_list:
                      if not isinstance(doc["content"], str):
                          logger.warning(f"Document content is not a string (ID: {doc['_id']}), converting.")
                          doc["content"] = str(doc["content"])
 
 
-            fused_documents = self.weighted_reciprocal_rank([vec_docs, key_docs], top_k)
+            with time_stage("fusion"):
+                fused_documents = fusion.fuse(doc_lists, top_k)
             if len(fused_documents) < exact_top_k:
                 exact_top_k = len(fused_documents) 
             fused_documents = fused_documents[:exact_top_k] 
@@ -224,82 +476,29 @@ class MongoHybridSearch:
             # else:
             #     return [e["content"] for e in fused_documents] # If no indices selected, return all content
             # --- END OF NEW LOGIC ---
-            return [e["content"] for e in fused_documents]
+            return fused_documents
 
         except Exception as e:
-            logger.error(f"Error in atlas_hybrid_search for query '{query}': {e}", exc_info=True)
+            logger.error(f"Error in hybrid_search_documents for query '{query}': {e}", exc_info=True)
             return []
 
     def weighted_reciprocal_rank(self, doc_lists: list[list[dict]], top_k: int) -> list[dict]:
         """
         Apply Weighted Reciprocal Rank Fusion (WRRF) to rank results.
+        Kept for callers that pass positional lists; fusion itself lives in fusion.py.
         Args:
-            doc_lists: List of lists of documents. Each inner list is from one search method.
+            doc_lists: List of lists of documents, in (vector, keyword) order.
                        Each document is a dict with at least '_id' and 'content'.
             top_k: The maximum number of documents to return after fusion.
         Returns:
             List of fused documents, sorted by RRF score, limited by top_k.
         """
         try:
-            # Ensure doc_lists is not empty and contains lists
             if not doc_lists or not all(isinstance(dl, list) for dl in doc_lists):
                 logger.warning("WRRF called with invalid doc_lists.")
                 return []
-
-            # Configuration for WRRF
-            c = 60 # Constant for rank penalty, tunable
-            weights = [1.0, 1.0] # Vector search weight, keyword search weight - Tunable
-
-            if len(doc_lists) != len(weights):
-                 # Fallback if weights don't match lists (e.g., one search returned nothing)
-                 # This basic handling might need refinement based on desired behavior
-                 weights = [1.0] * len(doc_lists)
-                 logger.warning(f"Number of doc lists ({len(doc_lists)}) != number of weights ({len(weights)}). Using equal weights.")
-                 # raise ValueError("Number of rank lists must be equal to the number of weights.")
-
-
-            # Use a dictionary to map unique content to its document dict and accumulate scores
-            # This handles cases where the same doc appears in multiple lists or multiple times
-            rrf_scores = {} # content -> {'score': float, 'doc': dict}
-
-            for doc_list, weight in zip(doc_lists, weights):
-                processed_ids_in_list = set() # Track IDs within the current list to handle duplicates from the *same* source
-                for rank, doc in enumerate(doc_list, start=1):
-                    doc_id = doc.get("_id")
-                    content = doc.get("content")
-
-                    # Basic validation
-                    if not doc_id or content is None:
-                        logger.warning(f"Skipping doc with missing ID or content in WRRF: {doc}")
-                        continue
-                    if not isinstance(content, str): # Ensure content is string for keying
-                        content = str(content)
-                        doc["content"] = content # Update doc dict too
-
-                    # Only score the first occurrence of a document *within the same list*
-                    if doc_id in processed_ids_in_list:
-                        continue
-                    processed_ids_in_list.add(doc_id)
-
-
-                    # Calculate RRF score contribution
-                    rank_score = weight * (1.0 / (rank + c))
-
-                    # Accumulate score or add new entry
-                    if content in rrf_scores:
-                        rrf_scores[content]['score'] += rank_score
-                    else:
-                        # Store the first encountered 'doc' dict for this content
-                        rrf_scores[content] = {'score': rank_score, 'doc': doc}
-
-
-            # Sort documents based on accumulated RRF score
-            # We sort the items (content, score_data) by score
-            sorted_items = sorted(rrf_scores.items(), key=lambda item: item[1]['score'], reverse=True)
-            
-            # Return the document dictionaries from the sorted items, limited by top_k
-            return [item[1]['doc'] for item in sorted_items[:top_k]]
-
+            names = ["vector", "keyword"] + [f"branch_{i}" for i in range(2, len(doc_lists))]
+            return fusion.fuse(dict(zip(names, doc_lists)), top_k, method="wrrf")
         except Exception as e:
             logger.error(f"Error in weighted_reciprocal_rank: {e}", exc_info=True)
             return []
@@ -0,0 +1,147 @@
+# keywordindex.py
+"""
+In-process BM25 keyword index over the `content_tokenized` field.
+
+`preprocess/todb.py` stores every document's PyThaiNLP tokens joined by spaces,
+so the index is built with a plain `find()` and works against any MongoDB,
+not only deployments with an Atlas Search node.
+
+Posting lists are kept in CSR form: `indptr[t]:indptr[t+1]` slices the
+`doc_idx` / `tf` arrays for term t. A query gathers the slices of its terms
+and accumulates BM25 contributions with a single `np.bincount`.
+"""
+
+import os
+import asyncio
+import logging
+from collections import Counter
+from typing import List, Dict, Any, Optional, Iterable
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+
+def normalize_tokens(tokens: Iterable[str]) -> List[str]:
+    """Lowercases tokens and drops whitespace-only ones (todb tokenizes with keep_whitespace=True)."""
+    return [t.lower() for t in tokens if t and not t.isspace()]
+
+
+class BM25Index:
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        """Initializes an empty index. Call `build()` or `build_from_collection()` before searching."""
+        self.k1 = k1
+        self.b = b
+        self.vocab: Dict[str, int] = {}
+        self.indptr: Optional[np.ndarray] = None     # (num_terms + 1,) int64
+        self.doc_idx: Optional[np.ndarray] = None    # (num_postings,) int32
+        self.tf: Optional[np.ndarray] = None         # (num_postings,) float32
+        self.idf: Optional[np.ndarray] = None        # (num_terms,) float32
+        self.length_norm: Optional[np.ndarray] = None  # (num_docs,) float32, k1 * (1 - b + b * dl / avgdl)
+        self.ids: List[str] = []
+        self.contents: List[str] = []
+        self.kb_version: Optional[str] = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.indptr is not None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    # --- Build ---
+    def build(self, docs: Iterable[Dict[str, Any]], kb_version: Optional[str] = None) -> bool:
+        """Builds the index from documents with `_id`, `content` and `content_tokenized`."""
+        vocab: Dict[str, int] = {}
+        term_ids: List[int] = []
+        doc_ids: List[int] = []
+        freqs: List[int] = []
+        doc_lengths: List[int] = []
+        ids, contents = [], []
+
+        for doc in docs:
+            tokenized = doc.get("content_tokenized")
+            if not isinstance(tokenized, str):
+                continue
+            tokens = normalize_tokens(tokenized.split())
+            doc_index = len(ids)
+            ids.append(str(doc["_id"]))
+            contents.append(str(doc.get("content", "")))
+            doc_lengths.append(len(tokens))
+            for token, count in Counter(tokens).items():
+                term_ids.append(vocab.setdefault(token, len(vocab)))
+                doc_ids.append(doc_index)
+                freqs.append(count)
+
+        if not ids:
+            logger.warning("No documents with content_tokenized found; keyword index not built.")
+            return False
+
+        term_arr = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_arr, kind="stable")
+        num_terms = len(vocab)
+        df = np.bincount(term_arr, minlength=num_terms)
+
+        self.indptr = np.zeros(num_terms + 1, dtype=np.int64)
+        np.cumsum(df, out=self.indptr[1:])
+        self.doc_idx = np.asarray(doc_ids, dtype=np.int32)[order]
+        self.tf = np.asarray(freqs, dtype=np.float32)[order]
+
+        num_docs = len(ids)
+        self.idf = np.log1p((num_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        lengths = np.asarray(doc_lengths, dtype=np.float32)
+        avgdl = float(lengths.mean()) or 1.0
+        self.length_norm = (self.k1 * (1.0 - self.b + self.b * lengths / avgdl)).astype(np.float32)
+
+        self.vocab = vocab
+        self.ids = ids
+        self.contents = contents
+        self.kb_version = kb_version
+        logger.info(f"BM25 index built: {num_docs} documents, {num_terms} terms, {len(self.doc_idx)} postings.")
+        return True
+
+    async def build_from_collection(self, collection, kb_version: Optional[str] = None) -> bool:
+        """Reads `content_tokenized` from a Motor collection and builds the index off the event loop."""
+        cursor = collection.find({"content_tokenized": {"$exists": True}}, {"_id": 1, "content": 1, "content_tokenized": 1})
+        docs = await cursor.to_list(length=None)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.build, docs, kb_version)
+
+    # --- Search ---
+    def search(self, query_tokens: List[str], top_k: int) -> List[Dict[str, Any]]:
+        """Returns up to top_k matching documents as {_id, content, score}, best first."""
+        if self.indptr is None:
+            raise RuntimeError("Keyword index is not loaded.")
+
+        term_ids = np.asarray(
+            sorted({self.vocab[t] for t in normalize_tokens(query_tokens) if t in self.vocab}),
+            dtype=np.int64,
+        )
+        if term_ids.size == 0 or top_k <= 0:
+            return []
+
+        starts, ends = self.indptr[term_ids], self.indptr[term_ids + 1]
+        lengths = ends - starts
+        positions = np.concatenate([np.arange(s, e) for s, e in zip(starts.tolist(), ends.tolist())])
+        docs = self.doc_idx[positions]
+        tf = self.tf[positions]
+        idf = np.repeat(self.idf[term_ids], lengths)
+
+        contributions = idf * tf * (self.k1 + 1.0) / (tf + self.length_norm[docs])
+        scores = np.bincount(docs, weights=contributions, minlength=len(self.ids))
+
+        matched = np.flatnonzero(scores)
+        if matched.size > top_k:
+            matched = matched[np.argpartition(-scores[matched], top_k - 1)[:top_k]]
+        matched = matched[np.argsort(-scores[matched], kind="stable")]
+
+        return [
+            {"_id": self.ids[i], "content": self.contents[i], "score": float(scores[i])}
+            for i in matched.tolist()
+        ]
@@ -0,0 +1,197 @@
+# llmclients.py
+"""
+Process-wide registry of OpenAI-compatible LLM clients.
+
+One `AsyncOpenAI` client (and one httpx connection pool) exists per
+(provider, base_url), no matter how many `LLMFinanceAnalyzer` instances ask for
+it. Pool size, keep-alive and HTTP/2 are configured here, connections can be
+pre-warmed at startup so the first requests after a deploy or an idle period
+skip the TCP/TLS handshake, and every pool reports its utilization.
+"""
+
+import os
+import time
+import asyncio
+import threading
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+LLM_POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "100")) # Per provider
+LLM_POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "20")) # Idle connections kept open per provider
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "120")) # Seconds an idle connection is kept
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "true").lower() == "true" # Needs the `h2` package; falls back to HTTP/1.1
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "120"))
+LLM_PREWARM_CONNECTIONS = int(os.getenv("LLM_PREWARM_CONNECTIONS", "2")) # Per provider at startup, 0 disables
+LLM_PREWARM_TIMEOUT = float(os.getenv("LLM_PREWARM_TIMEOUT", "3")) # Seconds per pre-warm request, not the generation read timeout
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+        self._closed = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self._on_close()
+
+
+class PooledTransport(httpx.AsyncBaseTransport):
+    def __init__(self, name: str, limits: httpx.Limits, http2: bool):
+        """httpx transport that counts requests holding a connection (until their body is closed)."""
+        self.name = name
+        self.limits = limits
+        self.http2 = http2
+        self._transport = httpx.AsyncHTTPTransport(limits=limits, http2=http2)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.wait_ms = 0.0
+
+    def _release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        with self._lock:
+            self.in_flight += 1
+            self.requests += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        start = time.perf_counter()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            self._release()
+            raise
+        with self._lock:
+            self.wait_ms += (time.perf_counter() - start) * 1000
+        response.stream = _TrackedStream(response.stream, self._release)
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        # httpcore exposes the pool's connections; the transport's `_pool` attribute is not public API.
+        connections = getattr(getattr(self._transport, "_pool", None), "connections", [])
+        idle = sum(1 for c in connections if c.is_idle())
+        with self._lock:
+            return {
+                "http2": self.http2,
+                "max_connections": self.limits.max_connections,
+                "max_keepalive": self.limits.max_keepalive_connections,
+                "open_connections": len(connections),
+                "idle_connections": idle,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "utilization": round(self.in_flight / self.limits.max_connections, 4) if self.limits.max_connections else 0.0,
+                "requests": self.requests,
+                "errors": self.errors,
+                "avg_headers_ms": round(self.wait_ms / (self.requests - self.errors), 1) if self.requests > self.errors else 0.0,
+            }
+
+
+class LLMClientRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients: Dict[Tuple[str, str], AsyncOpenAI] = {}
+        self._transports: Dict[Tuple[str, str], PooledTransport] = {}
+        self._http_clients: Dict[Tuple[str, str], httpx.AsyncClient] = {}
+
+    def get(self, provider: str, api_key: str, base_url: Optional[str] = None) -> AsyncOpenAI:
+        """Returns the shared client for (provider, base_url), creating it on first use."""
+        key = (provider, base_url or "")
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                return client
+            http2 = LLM_HTTP2 and HTTP2_AVAILABLE
+            if LLM_HTTP2 and not HTTP2_AVAILABLE:
+                logger.warning("LLM_HTTP2 is enabled but the `h2` package is not installed; using HTTP/1.1.")
+            limits = httpx.Limits(
+                max_connections=LLM_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+            )
+            transport = PooledTransport(f"{provider}@{base_url or 'default'}", limits, http2)
+            http_client = httpx.AsyncClient(
+                transport=transport,
+                timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+            )
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+            self._clients[key] = client
+            self._transports[key] = transport
+            self._http_clients[key] = http_client
+            logger.info(f"LLM client created for {transport.name} (http2={http2}, max_connections={limits.max_connections}).")
+            return client
+
+    async def prewarm(self, connections: int = LLM_PREWARM_CONNECTIONS, timeout: float = LLM_PREWARM_TIMEOUT) -> None:
+        """
+        Opens `connections` keep-alive connections per provider with cheap HEAD requests,
+        so the TLS handshake is paid at startup. Response status is irrelevant; failures are logged.
+        Each request gives up after `timeout` seconds, so a provider that accepts the
+        connection but never answers cannot hold up startup.
+        """
+        if connections <= 0:
+            return
+
+        async def _warm(key: Tuple[str, str], client: AsyncOpenAI, http_client: httpx.AsyncClient):
+            url = str(client.base_url)
+            start = time.perf_counter()
+            results = await asyncio.gather(*(http_client.head(url, timeout=timeout) for _ in range(connections)), return_exceptions=True)
+            failures = [r for r in results if isinstance(r, Exception)]
+            if failures:
+                logger.warning(f"Pre-warming {key[0]} failed for {len(failures)}/{connections} connections: {failures[0]!r}")
+            else:
+                logger.info(f"Pre-warmed {connections} connections to {key[0]} in {(time.perf_counter() - start) * 1000:.0f} ms.")
+
+        with self._lock:
+            clients = [(key, client, self._http_clients[key]) for key, client in self._clients.items()]
+        await asyncio.gather(*(_warm(*entry) for entry in clients))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            transports = list(self._transports.values())
+        return {transport.name: transport.stats() for transport in transports}
+
+    async def aclose(self) -> None:
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._transports.clear()
+            self._http_clients.clear()
+        await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+
+
+LLM_CLIENTS = LLMClientRegistry()
+
+
+def get_llm_client(provider: str, api_key: str, base_url: Optional[str] = None) -> AsyncOpenAI:
+    return LLM_CLIENTS.get(provider, api_key, base_url)
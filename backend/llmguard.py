@@ -0,0 +1,261 @@
+# llmguard.py
+"""
+Per-provider circuit breaker and adaptive concurrency limit for LLM calls.
+
+Circuit breaker: "closed" passes every request. After
+LLM_BREAKER_FAILURE_THRESHOLD consecutive failures (or a failure rate of
+LLM_BREAKER_FAILURE_RATE over the last LLM_BREAKER_WINDOW outcomes) it turns
+"open" and rejects immediately for LLM_BREAKER_OPEN_SECONDS. Then it is
+"half_open": up to LLM_BREAKER_HALF_OPEN_PROBES requests go through, a success
+closes it, a failure opens it again.
+
+Concurrency limit (AIMD): each success adds 1/limit (about +1 per round of
+requests); a 429, 5xx, timeout, or a latency above LLM_LIMIT_LATENCY_FACTOR
+times the recent average halves it, at most once per
+LLM_LIMIT_DECREASE_INTERVAL. A request that cannot get a slot within
+LLM_LIMIT_QUEUE_TIMEOUT_MS is rejected instead of queuing.
+
+Rejections raise ProviderUnavailable, which the router treats as an immediate
+failover without counting it against the provider's health.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5")) # Consecutive failures that open the breaker
+LLM_BREAKER_FAILURE_RATE = float(os.getenv("LLM_BREAKER_FAILURE_RATE", "0.5")) # Failure rate over the window that opens the breaker
+LLM_BREAKER_WINDOW = int(os.getenv("LLM_BREAKER_WINDOW", "20")) # Recent outcomes considered for the failure rate
+LLM_BREAKER_MIN_CALLS = int(os.getenv("LLM_BREAKER_MIN_CALLS", "10")) # Outcomes needed before the rate applies
+LLM_BREAKER_OPEN_SECONDS = float(os.getenv("LLM_BREAKER_OPEN_SECONDS", "30"))
+LLM_BREAKER_HALF_OPEN_PROBES = int(os.getenv("LLM_BREAKER_HALF_OPEN_PROBES", "1")) # Concurrent trial requests while half-open
+LLM_LIMIT_INITIAL = float(os.getenv("LLM_LIMIT_INITIAL", "16")) # Concurrent requests per provider
+LLM_LIMIT_MIN = float(os.getenv("LLM_LIMIT_MIN", "1"))
+LLM_LIMIT_MAX = float(os.getenv("LLM_LIMIT_MAX", "64"))
+LLM_LIMIT_BACKOFF = float(os.getenv("LLM_LIMIT_BACKOFF", "0.5")) # Multiplicative decrease
+LLM_LIMIT_LATENCY_FACTOR = float(os.getenv("LLM_LIMIT_LATENCY_FACTOR", "2.0")) # Latency above this multiple of the average counts as congestion
+LLM_LIMIT_DECREASE_INTERVAL = float(os.getenv("LLM_LIMIT_DECREASE_INTERVAL", "1.0")) # Seconds between decreases
+LLM_LIMIT_QUEUE_TIMEOUT_MS = float(os.getenv("LLM_LIMIT_QUEUE_TIMEOUT_MS", "200")) # Wait for a slot before rejecting
+
+
+class ProviderUnavailable(Exception):
+    """The guard rejected the request without sending it."""
+
+
+class CircuitOpen(ProviderUnavailable):
+    pass
+
+
+class ProviderSaturated(ProviderUnavailable):
+    pass
+
+
+def is_overload_error(exc: BaseException) -> bool:
+    """429, 5xx, timeouts and connection failures; other client errors say nothing about provider health."""
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    if isinstance(exc, (asyncio.TimeoutError, httpx.TimeoutException, httpx.NetworkError)):
+        return True
+    # openai's APITimeoutError / APIConnectionError carry no status code.
+    return type(exc).__name__ in ("APITimeoutError", "APIConnectionError")
+
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.consecutive_failures = 0
+        self.outcomes: Deque[bool] = deque(maxlen=LLM_BREAKER_WINDOW)
+        self.probes = 0
+        self.times_opened = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        """Whether a request may go out now; half-open admits a limited number of probes."""
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < LLM_BREAKER_OPEN_SECONDS:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+            self.probes = 0
+            logger.info(f"Circuit for {self.name} is half-open.")
+        if self.state == "half_open":
+            if self.probes >= LLM_BREAKER_HALF_OPEN_PROBES:
+                self.rejected += 1
+                return False
+            self.probes += 1
+        return True
+
+    def _open(self) -> None:
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+        self.outcomes.clear()
+        logger.warning(f"Circuit for {self.name} opened for {LLM_BREAKER_OPEN_SECONDS:.0f} s "
+                       f"after {self.consecutive_failures} consecutive failures.")
+
+    def record(self, success: bool) -> None:
+        if self.state == "half_open":
+            self.probes = max(0, self.probes - 1)
+            if success:
+                self.state = "closed"
+                self.consecutive_failures = 0
+                self.outcomes.clear()
+                logger.info(f"Circuit for {self.name} closed.")
+            else:
+                self._open()
+            return
+        if self.state == "open":
+            return  # A request admitted before the breaker opened.
+        self.outcomes.append(success)
+        self.consecutive_failures = 0 if success else self.consecutive_failures + 1
+        failures = self.outcomes.count(False)
+        if self.consecutive_failures >= LLM_BREAKER_FAILURE_THRESHOLD or (
+                len(self.outcomes) >= LLM_BREAKER_MIN_CALLS and failures / len(self.outcomes) >= LLM_BREAKER_FAILURE_RATE):
+            self._open()
+
+    def release_probe(self) -> None:
+        """A half-open probe ended without an outcome (cancelled, or a client error)."""
+        if self.state == "half_open":
+            self.probes = max(0, self.probes - 1)
+
+
+class AdaptiveLimiter:
+    def __init__(self, name: str):
+        self.name = name
+        self.limit = LLM_LIMIT_INITIAL
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.rejected = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._condition: Optional[asyncio.Condition] = None
+
+    def _cond(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self) -> bool:
+        cond = self._cond()
+        async with cond:
+            if self.in_flight >= int(self.limit):
+                try:
+                    await asyncio.wait_for(cond.wait_for(lambda: self.in_flight < int(self.limit)),
+                                           LLM_LIMIT_QUEUE_TIMEOUT_MS / 1000.0)
+                except asyncio.TimeoutError:
+                    self.rejected += 1
+                    return False
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return True
+
+    async def release(self) -> None:
+        cond = self._cond()
+        async with cond:
+            self.in_flight -= 1
+            cond.notify()
+
+    def on_success(self) -> None:
+        self.limit = min(LLM_LIMIT_MAX, self.limit + 1.0 / self.limit)
+
+    def on_congestion(self) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < LLM_LIMIT_DECREASE_INTERVAL:
+            return
+        self._last_decrease = now
+        self.decreases += 1
+        self.limit = max(LLM_LIMIT_MIN, self.limit * LLM_LIMIT_BACKOFF)
+
+
+class Permit:
+    def __init__(self, guard: "ProviderGuard", provider: str):
+        """One admitted request. release() is idempotent, so every exit path may call it."""
+        self._guard = guard
+        self.provider = provider
+        self._released = False
+
+    async def release(self) -> None:
+        if not self._released:
+            self._released = True
+            await self._guard._limiter(self.provider).release()
+
+
+class ProviderGuard:
+    def __init__(self):
+        """Breakers and limiters keyed by provider name; only touched from the event loop."""
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._limiters: Dict[str, AdaptiveLimiter] = {}
+
+    def _breaker(self, provider: str) -> CircuitBreaker:
+        if provider not in self._breakers:
+            self._breakers[provider] = CircuitBreaker(provider)
+        return self._breakers[provider]
+
+    def _limiter(self, provider: str) -> AdaptiveLimiter:
+        if provider not in self._limiters:
+            self._limiters[provider] = AdaptiveLimiter(provider)
+        return self._limiters[provider]
+
+    def is_open(self, provider: str) -> bool:
+        breaker = self._breaker(provider)
+        return breaker.state == "open" and time.monotonic() - breaker.opened_at < LLM_BREAKER_OPEN_SECONDS
+
+    async def acquire(self, provider: str) -> Permit:
+        """Admits a request or raises CircuitOpen / ProviderSaturated without waiting long."""
+        breaker = self._breaker(provider)
+        if not breaker.allow():
+            raise CircuitOpen(f"Circuit for {provider} is {breaker.state}.")
+        if not await self._limiter(provider).acquire():
+            breaker.release_probe()
+            raise ProviderSaturated(f"{provider} is at its concurrency limit ({int(self._limiter(provider).limit)}).")
+        return Permit(self, provider)
+
+    def record_success(self, provider: str, latency_ms: float, average_ms: Optional[float]) -> None:
+        self._breaker(provider).record(True)
+        limiter = self._limiter(provider)
+        if average_ms and latency_ms > LLM_LIMIT_LATENCY_FACTOR * average_ms:
+            limiter.on_congestion()
+        else:
+            limiter.on_success()
+
+    def record_failure(self, provider: str, exc: BaseException) -> None:
+        if is_overload_error(exc):
+            self._breaker(provider).record(False)
+            self._limiter(provider).on_congestion()
+        else:
+            self._breaker(provider).release_probe()
+
+    def record_cancelled(self, provider: str) -> None:
+        self._breaker(provider).release_probe()
+
+    def stats(self) -> Dict[str, Any]:
+        report = {}
+        for provider in sorted(set(self._breakers) | set(self._limiters)):
+            breaker = self._breaker(provider)
+            limiter = self._limiter(provider)
+            state = "half_open" if breaker.state == "open" and not self.is_open(provider) else breaker.state
+            report[provider] = {
+                "state": state,
+                "consecutive_failures": breaker.consecutive_failures,
+                "times_opened": breaker.times_opened,
+                "rejected_open": breaker.rejected,
+                "limit": round(limiter.limit, 2),
+                "in_flight": limiter.in_flight,
+                "peak_in_flight": limiter.peak_in_flight,
+                "rejected_saturated": limiter.rejected,
+                "limit_decreases": limiter.decreases,
+            }
+        return report
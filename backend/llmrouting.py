@@ -0,0 +1,290 @@
+# llmrouting.py
+"""
+Latency-aware routing of LLM calls over ordered fallback chains.
+
+Every role (classification, subquery, rag, ...) has an ordered chain of models.
+A call goes to the first healthy model in the chain. If it has not answered
+after the hedge delay (a high percentile of that provider's recent latency for
+the role), a duplicate request goes to the next model in the chain (or the
+same one when the chain has a single entry) and the first response wins; the
+other request is cancelled. An error fails over to the next model at once,
+with no sleep. Providers whose moving error rate is high are moved to the end
+of the chain until they recover.
+
+For streamed calls the latency that counts is the time to the first content
+chunk, so the hedge races on time to first token.
+
+With a ProviderGuard (llmguard.py), every request first needs a permit from its
+provider's circuit breaker and concurrency limiter; a rejection fails over at
+once and does not count against the provider's health.
+"""
+
+import os
+import time
+import asyncio
+import threading
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from llmguard import Permit, ProviderGuard, ProviderUnavailable
+from metrics import record_upstream_error
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+LLM_HEDGE = os.getenv("LLM_HEDGE", "true").lower() == "true"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95")) # Hedge once the primary is slower than this percentile
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20")) # Below this, LLM_HEDGE_INITIAL_DELAY_MS is used
+LLM_HEDGE_INITIAL_DELAY_MS = float(os.getenv("LLM_HEDGE_INITIAL_DELAY_MS", "4000"))
+LLM_HEDGE_MIN_DELAY_MS = float(os.getenv("LLM_HEDGE_MIN_DELAY_MS", "250")) # Floor, so fast providers are not hedged on jitter
+LLM_MAX_HEDGES = int(os.getenv("LLM_MAX_HEDGES", "1")) # Extra requests per call
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200")) # Recent samples kept per provider and role
+LLM_EWMA_ALPHA = float(os.getenv("LLM_EWMA_ALPHA", "0.2"))
+LLM_DEMOTE_ERROR_RATE = float(os.getenv("LLM_DEMOTE_ERROR_RATE", "0.5")) # Moving error rate that moves a provider to the end of its chain
+LLM_ERROR_HALF_LIFE = float(os.getenv("LLM_ERROR_HALF_LIFE", "30")) # Seconds; a demoted provider gets no traffic, so its error rate also decays with time
+
+
+def model_chain(env_name: str, default: List[str]) -> List[str]:
+    """Reads a comma-separated model chain from the environment, falling back to `default`."""
+    value = os.getenv(env_name, "")
+    chain = [m.strip() for m in value.split(",") if m.strip()]
+    return chain or list(default)
+
+
+class NoModelAvailable(Exception):
+    """Raised when none of a role's models has a configured client, or the guard rejected every one of them."""
+
+
+class ProviderHealth:
+    def __init__(self):
+        """Moving latency and error estimates for one provider."""
+        self.calls = 0
+        self.errors = 0
+        self._error_rate = 0.0
+        self._error_rate_at = time.monotonic()
+        self.ewma_ms: Dict[str, float] = {}
+        self.samples: Dict[str, Deque[float]] = {}
+
+    @property
+    def error_rate(self) -> float:
+        return self._error_rate * 0.5 ** ((time.monotonic() - self._error_rate_at) / LLM_ERROR_HALF_LIFE)
+
+    def _update_error_rate(self, failed: bool) -> None:
+        self._error_rate = self.error_rate + LLM_EWMA_ALPHA * (float(failed) - self.error_rate)
+        self._error_rate_at = time.monotonic()
+
+    def record_success(self, role: str, latency_ms: float) -> None:
+        self.calls += 1
+        self._update_error_rate(False)
+        previous = self.ewma_ms.get(role)
+        self.ewma_ms[role] = latency_ms if previous is None else previous + LLM_EWMA_ALPHA * (latency_ms - previous)
+        self.samples.setdefault(role, deque(maxlen=LLM_LATENCY_WINDOW)).append(latency_ms)
+
+    def record_error(self) -> None:
+        self.calls += 1
+        self.errors += 1
+        self._update_error_rate(True)
+
+    def percentile(self, role: str, q: float) -> Optional[float]:
+        samples = self.samples.get(role)
+        if not samples or len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return float(np.percentile(np.fromiter(samples, dtype=np.float64), q))
+
+    def stats(self) -> Dict[str, Any]:
+        roles = {}
+        for role, samples in self.samples.items():
+            values = np.fromiter(samples, dtype=np.float64)
+            roles[role] = {
+                "ewma_ms": round(self.ewma_ms[role], 1),
+                "p50_ms": round(float(np.percentile(values, 50)), 1),
+                "p95_ms": round(float(np.percentile(values, 95)), 1),
+                "samples": len(samples),
+            }
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "error_rate": round(self.error_rate, 4),
+            "roles": roles,
+        }
+
+
+class LLMRouter:
+    def __init__(self, provider_for_model: Callable[[str], str], guard: Optional[ProviderGuard] = None):
+        """provider_for_model maps a model name to the provider whose health it shares."""
+        self.provider_for_model = provider_for_model
+        self.guard = guard
+        self._lock = threading.Lock()
+        self._health: Dict[str, ProviderHealth] = {}
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        self.failures = 0
+
+    def _provider_health(self, provider: str) -> ProviderHealth:
+        health = self._health.get(provider)
+        if health is None:
+            health = self._health.setdefault(provider, ProviderHealth())
+        return health
+
+    def order(self, models: List[str]) -> List[str]:
+        """Chain order, with open circuits and providers above LLM_DEMOTE_ERROR_RATE moved to the end (stable)."""
+        with self._lock:
+            demoted = {m for m in models if self._provider_health(self.provider_for_model(m)).error_rate >= LLM_DEMOTE_ERROR_RATE}
+        if self.guard is not None:
+            demoted |= {m for m in models if self.guard.is_open(self.provider_for_model(m))}
+        return [m for m in models if m not in demoted] + [m for m in models if m in demoted]
+
+    def hedge_delay(self, model: str, role: str) -> float:
+        """Seconds to wait for `model` before sending a hedged duplicate."""
+        with self._lock:
+            p = self._provider_health(self.provider_for_model(model)).percentile(role, LLM_HEDGE_PERCENTILE)
+        delay_ms = LLM_HEDGE_INITIAL_DELAY_MS if p is None else max(LLM_HEDGE_MIN_DELAY_MS, p)
+        return delay_ms / 1000.0
+
+    def _record(self, model: str, role: str, latency_ms: Optional[float], error: Optional[BaseException] = None) -> None:
+        provider = self.provider_for_model(model)
+        with self._lock:
+            health = self._provider_health(provider)
+            average_ms = health.ewma_ms.get(role)
+            if latency_ms is None:
+                health.record_error()
+            else:
+                health.record_success(role, latency_ms)
+        if latency_ms is None:
+            record_upstream_error(provider, role, error)
+        if self.guard is not None:
+            if latency_ms is None:
+                self.guard.record_failure(provider, error)
+            else:
+                self.guard.record_success(provider, latency_ms, average_ms)
+
+    async def call(self, role: str, models: List[str], attempt: Callable[[str], Awaitable[Any]],
+                   discard: Optional[Callable[[Any], Awaitable[None]]] = None,
+                   hold_permit: bool = False) -> Tuple[Any, str, Optional[Permit]]:
+        """
+        Runs `attempt(model)` over the chain and returns (result, model that answered, permit).
+        `attempt` must raise on failure. `discard` releases a result that completed
+        but lost the race (e.g. closes an open stream). With hold_permit the winner's
+        guard permit stays held and the caller must release it (a stream holds its
+        slot until it is closed); otherwise it is released already. Raises the last
+        error if every model failed, or NoModelAvailable if the guard rejected every
+        model (open circuits, saturated providers) without one being tried. A request
+        that lost the race is cancelled and has released its permit by the time this
+        returns.
+        """
+        queue = self.order(models)
+        if not queue:
+            raise NoModelAvailable(f"No model available for role '{role}'.")
+        with self._lock:
+            self.calls += 1
+
+        loop = asyncio.get_running_loop()
+        pending: Dict[asyncio.Future, Tuple[str, bool]] = {}
+        hedges = 0
+        last_error: Optional[BaseException] = None
+        all_rejected = True
+
+        async def _timed(model: str) -> Tuple[Any, Optional[Permit]]:
+            permit = None
+            if self.guard is not None:
+                permit = await self.guard.acquire(self.provider_for_model(model))
+            start = time.perf_counter()
+            try:
+                result = await attempt(model)
+            except asyncio.CancelledError:
+                if permit is not None:
+                    self.guard.record_cancelled(permit.provider)
+                    await permit.release()
+                raise
+            except Exception as e:
+                self._record(model, role, None, e)
+                if permit is not None:
+                    await permit.release()
+                raise
+            self._record(model, role, (time.perf_counter() - start) * 1000)
+            if permit is not None and not hold_permit:
+                await permit.release()
+            return result, permit
+
+        def _launch(model: str, hedge: bool) -> float:
+            pending[asyncio.ensure_future(_timed(model))] = (model, hedge)
+            return loop.time() + self.hedge_delay(model, role)
+
+        primary = queue.pop(0)
+        hedge_at = _launch(primary, False)
+        try:
+            while pending:
+                can_hedge = LLM_HEDGE and hedges < LLM_MAX_HEDGES
+                timeout = max(0.0, hedge_at - loop.time()) if can_hedge else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedges += 1
+                    target = queue.pop(0) if queue else primary
+                    logger.info(f"LLM hedge for '{role}': {primary} slower than {self.hedge_delay(primary, role) * 1000:.0f} ms, also trying {target}.")
+                    with self._lock:
+                        self.hedges += 1
+                    _launch(target, True)
+                    continue
+
+                for task in done:
+                    model, hedged = pending.pop(task)
+                    if task.exception() is None:
+                        if hedged:
+                            with self._lock:
+                                self.hedge_wins += 1
+                        result, permit = task.result()
+                        return result, model, permit
+                    last_error = task.exception()
+                    if isinstance(last_error, ProviderUnavailable):
+                        logger.info(f"LLM call for '{role}' skipped {model}: {last_error}")
+                    else:
+                        all_rejected = False
+                        logger.warning(f"LLM call for '{role}' failed on {model}: {last_error}")
+
+                if not pending and queue:
+                    primary = queue.pop(0)
+                    logger.info(f"LLM failover for '{role}' to {primary}.")
+                    with self._lock:
+                        self.failovers += 1
+                    hedge_at = _launch(primary, False)
+            with self._lock:
+                self.failures += 1
+            if all_rejected:
+                raise NoModelAvailable(f"No model available for role '{role}': {last_error}") from last_error
+            raise last_error
+        finally:
+            cancelled = [task for task in pending if not task.done()]
+            for task in cancelled:
+                task.cancel()
+            # Let the losers run their cleanup (close the stream, release the permit) before returning.
+            await asyncio.gather(*cancelled, return_exceptions=True)
+            for task in pending:
+                if not task.cancelled() and task.exception() is None:
+                    result, permit = task.result()
+                    if discard is not None:
+                        await discard(result)
+                    if permit is not None:
+                        await permit.release()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "hedging": LLM_HEDGE,
+                "hedge_percentile": LLM_HEDGE_PERCENTILE,
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "failovers": self.failovers,
+                "failures": self.failures,
+                "providers": {name: health.stats() for name, health in self._health.items()},
+            }
+
+    def guard_stats(self) -> Dict[str, Any]:
+        return self.guard.stats() if self.guard is not None else {}
@@ -1,24 +1,39 @@
 # main.py (Refined for simpler logic)
+import time
+PROCESS_START = time.perf_counter()  # Before the heavy imports, so cold-start timings include them
+
 from langfuse import Langfuse
 from langfuse.decorators import langfuse_context, observe
 import os
 import logging
-from typing import List, Dict, Optional, Any, AsyncGenerator
+from typing import List, Dict, Optional, Any, AsyncGenerator, Callable, Tuple
 import asyncio
 import json
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Response
 from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel, Field
 import uvicorn
 from dotenv import load_dotenv
 
-from models import LLMFinanceAnalyzer
+from models import LLMFinanceAnalyzer, LLM_ROUTER, BGE, EMBED_EXECUTOR, EMBED_WARMUP, EMBED_SERVER
+from embedserver import EmbedServerUnavailable, EMBED_SERVER_FALLBACK
 from functions import MongoHybridSearch
+from semanticcache import SemanticResponseCache, cache_key_text
+from speculation import Speculation, SPECULATION_STATS, SPECULATIVE_REUSE_SIMILARITY, cosine_similarity
+from ragrouter import RagRouter, log_llm_decision
+from streaming import coalesce, STREAM_STATS
+from contextpacker import pack_context, PACK_STATS
+from llmclients import LLM_CLIENTS
+from sessionstore import SessionStore, summary_messages
+from metrics import mark_process_dead, observe_stage, record_cache, record_rag_decision, render as render_metrics
 from systemprompt import (
     get_rag_classification_prompt,
     get_subquery_prompt,
     get_normal_prompt,
     get_non_rag_prompt,
+    NORMAL_TEMPLATE,
+    NON_RAG_TEMPLATE,
 )
 
 # --- Setup ---
@@ -44,6 +59,7 @@ class ChatMessage(BaseModel):
 
 class ChatRequest(BaseModel):
     user_id: Optional[str] = Field("default_user", description="Identifier for the user session")
+    session_id: Optional[str] = Field(None, description="Server-side session to continue; with it, `history` is only needed to seed an unknown session")
     history: List[ChatMessage] = Field([], description="Previous conversation history")
     message: str = Field(..., description="The latest message from the user")
 
@@ -51,24 +67,111 @@ class ChatResponse(BaseModel):
     reply: str = Field(..., description="The chatbot's full reply (for non-streaming responses)")
     stage: str = Field(..., description="Indicates the processing stage or type of response generated")
     current_rag_decision: Optional[str] = Field(None, description="RAG decision ('yes' or 'no') for the current message.")
+    session_id: Optional[str] = Field(None, description="Server-side session the turn was recorded in")
     debug_info: Optional[Dict[str, Any]] = Field(None, description="Optional debug information")
 
-# --- FastAPI Application Setup ---
-app = FastAPI(
-    title= "Rabbit reward Chatbot API",
-    description="API for Rabbit reward Chatbot with a simplified RAG/Non-RAG workflow.",
-    version="0.0.0"
-)
+# --- Startup State ---
+# "starting" until the embedding model is loaded and warmed up, then "ready"; "failed" if anything on the way fails.
+STARTUP: Dict[str, Any] = {
+    "state": "starting",
+    "error": None,
+    "imports_ms": round((time.perf_counter() - PROCESS_START) * 1000, 1),
+    "init_ms": None,
+    "model_load_ms": None,
+    "tokenizer_ms": None,
+    "warmup_ms": None,
+    "ready_after_ms": None,
+}
 
 # --- Global Instances ---
+llm_analyzer = search_engine = response_cache = rag_router = session_store = None
+_init_start = time.perf_counter()
 try:
     llm_analyzer = LLMFinanceAnalyzer()
-    search_engine = MongoHybridSearch()
+    search_engine = MongoHybridSearch(llm_analyzer=llm_analyzer)
+    response_cache = SemanticResponseCache()
+    rag_router = RagRouter.load()
+    session_store = SessionStore()
+    STARTUP["init_ms"] = round((time.perf_counter() - _init_start) * 1000, 1)
     logger.info("Successfully initialized LLMAnalyzer and MongoHybridSearch.")
 except Exception as e:
     logger.critical(f"Fatal error during initialization: {e}", exc_info=True)
-    # Depending on deployment, you might want the app to fail hard here.
-    # raise RuntimeError(f"Failed to initialize core components: {e}")
+    # The process stays up so /healthz and /readyz can report the failure; /chat answers 503.
+    STARTUP.update(state="failed", error=f"Initialization failed: {e}")
+
+async def load_embedding_model():
+    """Loads and warms up BGE on the encode executor, or waits for the embedding server."""
+    loop = asyncio.get_running_loop()
+    if EMBED_SERVER is not None:
+        try:
+            STARTUP["embedding_server"] = await EMBED_SERVER.wait_ready()
+            logger.info(f"Embeddings from {EMBED_SERVER.path}.")
+            return
+        except EmbedServerUnavailable as e:
+            if not EMBED_SERVER_FALLBACK:
+                raise
+            logger.warning(f"{e}; loading the embedding model in-process instead.")
+    await loop.run_in_executor(EMBED_EXECUTOR, BGE.load)
+    STARTUP["model_load_ms"] = round(BGE.load_ms, 1)
+    if EMBED_WARMUP:
+        STARTUP["warmup_ms"] = round(await loop.run_in_executor(EMBED_EXECUTOR, BGE.warmup), 1)
+
+async def prepare_search_indexes():
+    """Loads or builds the local search indexes outside any request deadline. Failures fall back to Atlas at query time."""
+    try:
+        STARTUP["indexes"] = await search_engine.prepare_indexes()
+    except Exception as e:
+        logger.error(f"Preparing local search indexes failed, queries will use Atlas until they are built: {e}", exc_info=True)
+        STARTUP["indexes"] = {"error": str(e)}
+
+async def start_tokenizer():
+    """Starts the tokenizer's worker pool here rather than at import: its workers import __main__."""
+    start = time.perf_counter()
+    await asyncio.get_running_loop().run_in_executor(None, search_engine.tokenizer.start)
+    STARTUP["tokenizer_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+async def start_up():
+    """Runs the slow startup work, then marks the app ready."""
+    try:
+        await load_embedding_model()
+    except Exception as e:
+        logger.critical(f"Failed to load the embedding model: {e}", exc_info=True)
+        STARTUP.update(state="failed", error=f"Embedding model failed to load: {e}")
+        return
+    try:
+        await start_tokenizer()
+    except Exception as e:
+        logger.critical(f"Failed to start the tokenizer: {e}", exc_info=True)
+        STARTUP.update(state="failed", error=f"Tokenizer failed to start: {e}")
+        return
+    await prepare_search_indexes()
+    STARTUP["ready_after_ms"] = round((time.perf_counter() - PROCESS_START) * 1000, 1)
+    STARTUP["state"] = "ready"
+    logger.info(f"Ready {STARTUP['ready_after_ms']:.0f} ms after process start: {STARTUP}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The model and the local indexes load in the background so /healthz answers at once and /readyz reports progress.
+    model_task = asyncio.create_task(start_up()) if STARTUP["state"] != "failed" else None
+    # Open keep-alive connections to every LLM provider before the first request needs them,
+    # in the background too: a slow provider must not hold up /healthz.
+    prewarm_task = asyncio.create_task(LLM_CLIENTS.prewarm())
+    yield
+    if model_task is not None:
+        model_task.cancel()
+    prewarm_task.cancel()
+    await LLM_CLIENTS.aclose()
+    if search_engine is not None:
+        search_engine.tokenizer.shutdown()
+    mark_process_dead()
+
+# --- FastAPI Application Setup ---
+app = FastAPI(
+    title= "Rabbit reward Chatbot API",
+    description="API for Rabbit reward Chatbot with a simplified RAG/Non-RAG workflow.",
+    version="0.0.0",
+    lifespan=lifespan,
+)
 
 # --- Helper Functions ---
 def create_truncated_history_for_classification(
@@ -113,6 +216,347 @@ def detect_thai_or_english(text: str) -> str:
     return "en"
 
 
+# --- Chat Pipeline ---
+class GenerationFailed(Exception):
+    pass
+
+async def raise_on_error_marker(source: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+    """The generators report failures in-band ("[ERROR: ...]", "[STREAM_ERROR: ...]"); turn them into an exception."""
+    async for chunk in source:
+        if "[STREAM_ERROR" in chunk or "[ERROR" in chunk:
+            raise GenerationFailed(chunk.strip().strip("[]").split(": ", 1)[-1])
+        yield chunk
+
+ChatEvent = Tuple[str, Dict[str, Any]]
+
+class ChatTurn:
+    def __init__(self, request: ChatRequest, stream_non_rag: bool):
+        """
+        One chat turn as a sequence of typed events, shared by /chat and /chat/stream:
+          stage      {name, elapsed_ms} when a pipeline stage starts
+          retrieval  {query, documents, packed, branches, cache, speculative} once the context is ready
+          token      {text} answer text, coalesced by streaming.py
+          done       {stage, rag_decision, session_id, timings, total_ms}, plus `reply` for a non-streamed answer
+          error      {message, stage, status}; ends the turn
+        With stream_non_rag the non-RAG answer is streamed as tokens too; otherwise it arrives in `done`.
+        """
+        self.request = request
+        self.stream_non_rag = stream_non_rag
+        self.start = time.perf_counter()
+        self.stage = "Initiated"
+        self.rag_decision: Optional[str] = None
+        self.debug_info: Dict[str, Any] = {"classification": {}}
+        self.timings: Dict[str, float] = {}
+        self._stage_started: Dict[str, float] = {}
+
+        # --- Server-Side Session ---
+        # With a session_id the stored history is used and the client only sends the new message;
+        # turns that no longer fit are folded into a rolling summary.
+        history = [msg.dict() for msg in request.history]
+        self.use_session = bool(request.session_id) and session_store.enabled
+        summary = ""
+        self.session_headers: Dict[str, str] = {}
+        if self.use_session:
+            history, summary, session_status = session_store.load(request.user_id, request.session_id, history)
+            self.debug_info["session"] = {"status": session_status, "messages": len(history), "summary_chars": len(summary)}
+            self.session_headers = {"X-Session-Id": request.session_id, "X-Session-Status": session_status}
+        self.leading_messages = summary_messages(summary)
+
+        self.full_conversation = history + [{"role": "user", "content": request.message}]
+        truncated_conversation = create_truncated_history_for_classification(self.leading_messages + self.full_conversation, MAX_ASSISTANT_MSG_LENGTH_FOR_CLASSIFICATION)
+        self.pseudo_conversation = generate_pseudo_conversation(truncated_conversation)
+
+    def _elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self.start) * 1000, 1)
+
+    def _begin(self, name: str) -> ChatEvent:
+        self._stage_started[name] = time.perf_counter()
+        return "stage", {"name": name, "elapsed_ms": self._elapsed_ms()}
+
+    def _end(self, name: str) -> None:
+        self.timings[name] = round((time.perf_counter() - self._stage_started[name]) * 1000, 1)
+
+    def _error(self, message: str, final_stage: str, status_code: int = 500) -> ChatEvent:
+        logger.error(f"Returning error: {message} (Stage: {final_stage}, Status: {status_code})")
+        self.stage = final_stage
+        self.debug_info["error"] = message
+        return "error", {"message": message, "stage": final_stage, "status": status_code}
+
+    def _done(self, **extra: Any) -> ChatEvent:
+        return "done", {
+            "stage": self.stage,
+            "rag_decision": self.rag_decision,
+            "session_id": self.request.session_id if self.use_session else None,
+            "timings": self.timings,
+            "total_ms": self._elapsed_ms(),
+            **extra,
+        }
+
+    def _record_turn(self, reply: str) -> None:
+        if self.use_session:
+            session_store.append_turn(self.request.user_id, self.request.session_id, self.request.message, reply)
+
+    async def _stream(self, gen: AsyncGenerator[str, None], on_complete: Callable[[List[str]], None]) -> AsyncGenerator[ChatEvent, None]:
+        """Token events for a generated answer, then `done` (or `error` if generation fails part-way)."""
+        chunks: List[str] = []
+        start = time.perf_counter()
+        ttfb_ms = 0.0
+        try:
+            # LLM deltas are coalesced by size/age (streaming.py); the first one is sent immediately.
+            async for chunk in coalesce(raise_on_error_marker(gen)):
+                if not chunks:
+                    ttfb_ms = (time.perf_counter() - start) * 1000
+                    self.timings["ttft"] = self._elapsed_ms()
+                    observe_stage("ttft", time.perf_counter() - self.start)
+                chunks.append(chunk)
+                yield "token", {"text": chunk}
+        except Exception as e_stream:
+            logger.error(f"Error during stream transmission: {e_stream}", exc_info=True)
+            yield self._error(str(e_stream), self.stage + " - Error: Stream Failed", 502)
+            return
+        duration_ms = (time.perf_counter() - start) * 1000
+        self._end("generation")
+        observe_stage("stream", duration_ms / 1000)
+        STREAM_STATS.record(len(chunks), sum(len(c.encode("utf-8")) for c in chunks), ttfb_ms, duration_ms)
+        logger.info(f"Finished stream transmission ({len(chunks)} writes, ttfb {ttfb_ms:.0f} ms, total {duration_ms:.0f} ms).")
+        on_complete(chunks)
+        yield self._done()
+
+    async def events(self) -> AsyncGenerator[ChatEvent, None]:
+        request = self.request
+        debug_info = self.debug_info
+        full_conversation = self.full_conversation
+        pseudo_conversation = self.pseudo_conversation
+        speculation = Speculation()
+        speculative_retrieval: Dict[str, Any] = {}  # Branch report of the speculative search
+        if speculation.mode != "off":
+            debug_info["speculation"] = speculation.report
+
+        try:
+            lang = detect_thai_or_english(full_conversation[-1].get("content"))
+            logger.debug(f"lang detected:{lang}")
+
+            # --- Semantic Answer Cache ---
+            # Keyed on the last few user messages (short and capped, see cache_key_text) and the language,
+            # so context-dependent follow-ups don't collide and a long history is never embedded for it.
+            cache_vector, kb_version = None, None
+            if response_cache.enabled:
+                yield self._begin("embedding")
+                cache_vector = await search_engine.embedder.embed(cache_key_text(full_conversation), "query")
+                self._end("embedding")
+                self.stage = "Semantic Cache Lookup"
+                yield self._begin("cache_lookup")
+                kb_version = await search_engine.get_kb_version()
+                cached_chunks = response_cache.lookup(cache_vector, lang, kb_version) if cache_vector else None
+                record_cache("semantic", cached_chunks is not None)
+                self._end("cache_lookup")
+                if cached_chunks is not None:
+                    async def replay_cached():
+                        for chunk in cached_chunks:
+                            yield chunk
+
+                    self.stage = "RAG Generation (Streaming)"
+                    self.rag_decision = "yes"
+                    yield self._begin("generation")
+                    async for event in self._stream(replay_cached(), lambda chunks: self._record_turn("".join(chunks))):
+                        yield event
+                    return
+
+            # --- Local RAG Router ---
+            # A confident local decision skips the classification LLM call entirely.
+            self.stage = "RAG Classification"
+            yield self._begin("classification")
+            # The router was trained on the whole truncated conversation, so only it pays for embedding that.
+            conversation_vector = None
+            if rag_router.enabled:
+                conversation_vector = await search_engine.embedder.embed(pseudo_conversation[0]["content"], "query")
+            rag_decision, p_yes = rag_router.route(conversation_vector)
+            decision_source = "router" if rag_decision is not None else "llm"
+            if rag_router.enabled:
+                debug_info["classification"]["router"] = {"version": rag_router.version, "p_yes": round(p_yes, 4), "decision": rag_decision}
+
+            if rag_decision is None:
+                # --- Speculative RAG Work ---
+                # Started before classification so a "yes" does not pay for two serial LLM round trips.
+                if speculation.enabled("subquery"):
+                    speculation.start("subquery", llm_analyzer.generate_subquery(pseudo_conversation))
+                if speculation.enabled("retrieval"):
+                    speculation.start("retrieval", search_engine.search_documents(request.message, speculative_retrieval))
+
+                # --- Simplified Single-Step Classification ---
+                rag_decision = await llm_analyzer.classify_rag_requirement(pseudo_conversation)
+                log_llm_decision(pseudo_conversation[0]["content"], rag_decision)
+            classified_at = time.perf_counter()
+            self._end("classification")
+            debug_info["classification"]["rag_decision_result"] = rag_decision
+
+            if rag_decision not in ['yes', 'no']:
+                logger.warning(f"RAG classification returned an unexpected value: '{rag_decision}'. Defaulting to 'no'.")
+                rag_decision = 'yes'
+
+            logger.info(f"Final Classification: RAG Required = {rag_decision}")
+            record_rag_decision(rag_decision, decision_source)
+            self.rag_decision = rag_decision
+
+            # --- Pipeline Execution ---
+            if rag_decision == 'yes':
+                # --- RAG Pipeline (Always Streaming) ---
+                self.stage = "RAG"
+                logger.info("Executing RAG Pipeline - Streaming")
+
+                # 1. Generate Subqueries
+                yield self._begin("subquery")
+                if speculation.has("subquery"):
+                    query = await speculation.take("subquery", needed_since=classified_at)
+                else:
+                    query = await llm_analyzer.generate_subquery(pseudo_conversation)
+                self._end("subquery")
+                if query is None:
+                    yield self._error("ขออภัยค่ะ ไม่สามารถวิเคราะห์คำถามเพื่อดึงข้อมูลได้", self.stage + " - Error: Subquery Failed", 400)
+                    return
+
+                # prethinking, subquery_fact, subquery_report = subquery_result
+                # logger.info(f"Generated {len(subquery_fact)} fact subqueries and {len(subquery_report)} report subqueries.")
+                # debug_info["subqueries"] = {"fact": subquery_fact, "report": subquery_report, "prethinking": prethinking}
+
+                # 2. Search Documents
+                retrieved_data = ""
+                docs: List[str] = []
+                if query:
+                    yield self._begin("retrieval")
+                    try:
+                        similarity = None
+                        if speculation.has("retrieval"):
+                            # Both embeddings are cached: the speculative search embedded the message, and the
+                            # subquery's is reused by the search below if it runs.
+                            similarity = cosine_similarity(await search_engine.embedder.embed(query, "query"),
+                                                           await search_engine.embedder.embed(request.message, "query"))
+                        if similarity is not None and similarity >= SPECULATIVE_REUSE_SIMILARITY:
+                            docs = await speculation.take("retrieval", needed_since=time.perf_counter())
+                            # Its branch report carries "complete", which decides whether the answer is cached.
+                            debug_info["retrieval"] = {**speculative_retrieval, "speculative": True, "similarity": round(similarity, 4)}
+                        else:
+                            speculation.discard("retrieval")
+                            docs = await search_engine.search_documents(query, debug_info.setdefault("retrieval", {})) if query else []
+                        # docs_report = await search_engine.search_documents(subquery_report, "report") if subquery_report else []
+
+                        # all_docs = [doc for doc_list in (docs_fact + docs_report) for doc in doc_list if doc]
+                        # unique_docs = list(dict.fromkeys(docs)) # Simple deduplication
+
+                        # if not unique_docs:
+                        #     logger.warning("RAG: Database search returned no unique documents.")
+                        #     return create_json_error_response("ฉันไม่พบข้อมูลที่เกี่ยวข้องกับคำถามของคุณค่ะ", stage + " - No Documents Found", rag_decision, 404)
+
+                        # Drop near-duplicate chunks and stop at the token budget, in fused-rank order.
+                        retrieved_data, packing_report = pack_context(docs)
+                        debug_info["context_packing"] = packing_report
+                        logger.info(f"RAG: Retrieved {len(docs)} documents, packed {packing_report['packed']} "
+                                    f"({packing_report['tokens_packed']}/{packing_report['tokens_in']} estimated tokens).")
+                        debug_info["retrieved_data_snippet"] = retrieved_data[:500] + "..."
+
+                    except Exception as search_err:
+                        logger.error(f"RAG: Error during document search: {search_err}", exc_info=True)
+                        yield self._error("ขออภัยค่ะ เกิดข้อผิดพลาดขณะค้นหาข้อมูล", self.stage + " - Error: Search Failed", 500)
+                        return
+                    self._end("retrieval")
+                    retrieval_report = debug_info.get("retrieval", {})
+                    yield "retrieval", {
+                        "query": query,
+                        "documents": len(docs),
+                        "packed": packing_report["packed"],
+                        "branches": retrieval_report.get("contributed", []),
+                        "cache": retrieval_report.get("cache"),
+                        "speculative": retrieval_report.get("speculative", False),
+                    }
+                else:
+                    logger.info("RAG: No subqueries generated, proceeding without document search.")
+
+                # 3. Generate Response (Streaming)
+                self.stage = "RAG Generation (Streaming)"
+                if len(full_conversation) >7:
+                    full_conversation = full_conversation[-7:]
+                full_conversation = self.leading_messages + full_conversation
+                debug_info["prompt_tokens"] = NORMAL_TEMPLATE.section_tokens(lang, retrieved_data, full_conversation)
+                response_generator = llm_analyzer.generate_normal_response(retrieved_data, full_conversation, lang)
+
+                # An answer built on an empty or partial retrieval (a branch timed out or failed) is not
+                # cached, or it would be replayed to every paraphrase long after the outage.
+                cacheable = bool(docs) and debug_info.get("retrieval", {}).get("complete", False)
+
+                def on_complete(chunks: List[str]) -> None:
+                    if cache_vector and cacheable:
+                        response_cache.store(cache_vector, lang, kb_version, chunks)
+                    self._record_turn("".join(chunks))
+
+                yield self._begin("generation")
+                async for event in self._stream(response_generator, on_complete):
+                    yield event
+
+            else: # rag_decision == 'no'
+                # --- Non-RAG Pipeline ---
+                speculation.discard()
+                self.stage = "Non-RAG Generation"
+                logger.info("Executing Non-RAG Pipeline")
+                if len(full_conversation) >7:
+                    full_conversation = full_conversation[-9:]
+                full_conversation = self.leading_messages + full_conversation
+
+                debug_info["prompt_tokens"] = NON_RAG_TEMPLATE.section_tokens(lang, history=full_conversation)
+                yield self._begin("generation")
+                if self.stream_non_rag:
+                    async for event in self._stream(llm_analyzer.stream_non_rag_response(full_conversation, lang),
+                                                    lambda chunks: self._record_turn("".join(chunks))):
+                        yield event
+                    return
+
+                final_response = await llm_analyzer.generate_non_rag_response(full_conversation,lang)
+                self._end("generation")
+                if final_response is None:
+                    yield self._error("ขออภัยค่ะ เกิดข้อผิดพลาดในการประมวลผลคำถามของคุณ", self.stage + " - Error: Generation Failed", 500)
+                    return
+
+                self._record_turn(final_response)
+                self.stage += " - Completed"
+                yield self._done(reply=final_response)
+
+        except Exception as e:
+            logger.critical(f"Unhandled exception in chat pipeline: {e}", exc_info=True)
+            yield self._error("ขออภัยค่ะ เกิดข้อผิดพลาดที่ไม่คาดคิด", self.stage + " - Error: Unhandled", 500)
+        finally:
+            # Anything still speculative was not needed (e.g. the decision was "no"): cancel it.
+            speculation.discard()
+            if speculation.report:
+                logger.info(f"Speculation ({speculation.mode}): {speculation.report}")
+
+def not_ready_response() -> JSONResponse:
+    response_data = ChatResponse(
+        reply="ขออภัยค่ะ ระบบกำลังเริ่มต้น กรุณาลองใหม่อีกครั้งในอีกสักครู่",
+        stage=f"Not Ready ({STARTUP['state']})",
+        debug_info={"startup": STARTUP},
+    )
+    return JSONResponse(content=response_data.model_dump(exclude_none=True), status_code=503, headers={"Retry-After": "5"})
+
+async def text_stream(first_chunk: str, events: AsyncGenerator[ChatEvent, None]) -> AsyncGenerator[str, None]:
+    """Plain-text body for /chat: the answer; a failure after the first chunk is reported in-band."""
+    try:
+        yield first_chunk
+        async for kind, data in events:
+            if kind == "token":
+                yield data["text"]
+            elif kind == "error":
+                yield f"\n[STREAM_ERROR: {data['message']}]\n"
+    finally:
+        await events.aclose()
+
+async def sse_stream(events: AsyncGenerator[ChatEvent, None]) -> AsyncGenerator[str, None]:
+    """Server-Sent Events body for /chat/stream: one event per pipeline event, as JSON data."""
+    try:
+        async for kind, data in events:
+            yield f"event: {kind}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    finally:
+        await events.aclose()
+
+
 # --- API Endpoint ---
 @app.post("/chat")
 @observe()
@@ -124,118 +568,97 @@ async def handle_chat(request: ChatRequest) -> Response:
     - Returns `JSONResponse` for Non-RAG responses and all errors.
     """
     logger.info(f"Received chat request for user: {request.user_id}")
-    full_conversation = [msg.dict() for msg in request.history] + [{"role": "user", "content": request.message}]
-    truncated_conversation = create_truncated_history_for_classification(full_conversation, MAX_ASSISTANT_MSG_LENGTH_FOR_CLASSIFICATION)
-    pseudo_conversation = generate_pseudo_conversation(truncated_conversation)
-    
-    stage = "Initiated"
-    debug_info: Dict[str, Any] = {"classification": {}}
-
-    def create_json_error_response(message: str, final_stage: str, rag_decision: Optional[str], status_code: int = 500) -> JSONResponse:
-        logger.error(f"Returning error: {message} (Stage: {final_stage}, Status: {status_code})")
-        response_data = ChatResponse(
-            reply=message,
-            stage=final_stage,
-            current_rag_decision=rag_decision,
-            debug_info={**debug_info, "error": message}
-        )
-        return JSONResponse(content=response_data.model_dump(exclude_none=True), status_code=status_code)
-
-    try:
-        # --- Simplified Single-Step Classification ---
-        stage = "RAG Classification"
-        rag_decision = await llm_analyzer.classify_rag_requirement(pseudo_conversation)
-        debug_info["classification"]["rag_decision_result"] = rag_decision
-
-        lang = detect_thai_or_english(full_conversation[-1].get("content"))
-        print(f"lang detected:{lang}")
-        if rag_decision not in ['yes', 'no']:
-            logger.warning(f"RAG classification returned an unexpected value: '{rag_decision}'. Defaulting to 'no'.")
-            rag_decision = 'yes'
-
-        logger.info(f"Final Classification: RAG Required = {rag_decision}")
-
-        # --- Pipeline Execution ---
-        if rag_decision == 'yes':
-            # --- RAG Pipeline (Always Streaming) ---
-            stage = "RAG"
-            logger.info("Executing RAG Pipeline - Streaming")
-
-            # 1. Generate Subqueries
-            query = await llm_analyzer.generate_subquery(pseudo_conversation)
-            if query is None:
-                return create_json_error_response("ขออภัยค่ะ ไม่สามารถวิเคราะห์คำถามเพื่อดึงข้อมูลได้", stage + " - Error: Subquery Failed", rag_decision, 400)
-
-            # prethinking, subquery_fact, subquery_report = subquery_result
-            # logger.info(f"Generated {len(subquery_fact)} fact subqueries and {len(subquery_report)} report subqueries.")
-            # debug_info["subqueries"] = {"fact": subquery_fact, "report": subquery_report, "prethinking": prethinking}
-
-            # 2. Search Documents
-            retrieved_data = ""
-            if query:
-                try:
-                    docs = await search_engine.search_documents(query) if query else []
-                    # docs_report = await search_engine.search_documents(subquery_report, "report") if subquery_report else []
-                    
-                    # all_docs = [doc for doc_list in (docs_fact + docs_report) for doc in doc_list if doc]
-                    # unique_docs = list(dict.fromkeys(docs)) # Simple deduplication
-                    
-                    # if not unique_docs:
-                    #     logger.warning("RAG: Database search returned no unique documents.")
-                    #     return create_json_error_response("ฉันไม่พบข้อมูลที่เกี่ยวข้องกับคำถามของคุณค่ะ", stage + " - No Documents Found", rag_decision, 404)
-
-                    retrieved_data = "\n-------\n".join(docs)
-                    logger.info(f"RAG: Retrieved {len(docs)} unique documents.")
-                    debug_info["retrieved_data_snippet"] = retrieved_data[:500] + "..."
-
-                except Exception as search_err:
-                    logger.error(f"RAG: Error during document search: {search_err}", exc_info=True)
-                    return create_json_error_response("ขออภัยค่ะ เกิดข้อผิดพลาดขณะค้นหาข้อมูล", stage + " - Error: Search Failed", rag_decision, 500)
-            else:
-                logger.info("RAG: No subqueries generated, proceeding without document search.")
-
-            # 3. Generate Response (Streaming)
-            stage = "RAG Generation (Streaming)"
-            if len(full_conversation) >7:
-                full_conversation = full_conversation[-7:]
-            response_generator = llm_analyzer.generate_normal_response(retrieved_data, full_conversation, lang)
-
-            async def stream_wrapper(gen: AsyncGenerator[str, None]):
-                try:
-                    async for chunk in gen:
-                        yield chunk
-                        await asyncio.sleep(0.05)
-                    logger.info("Finished RAG stream transmission.")
-                except Exception as e_stream:
-                    logger.error(f"Error during stream transmission: {e_stream}", exc_info=True)
-                    yield f"\n[STREAM_ERROR: {e_stream}]\n"
-
-            headers = {"X-Final-Stage": stage, "X-RAG-Decision": rag_decision}
-            return StreamingResponse(stream_wrapper(response_generator), media_type=STREAMING_CONTENT_TYPE, headers=headers)
-
-        else: # rag_decision == 'no'
-            # --- Non-RAG Pipeline (JSON Response) ---
-            stage = "Non-RAG Generation"
-            logger.info("Executing Non-RAG Pipeline")
-            if len(full_conversation) >7:
-                full_conversation = full_conversation[-9:]
-
-            final_response = await llm_analyzer.generate_non_rag_response(full_conversation,lang)
-            if final_response is None:
-                return create_json_error_response("ขออภัยค่ะ เกิดข้อผิดพลาดในการประมวลผลคำถามของคุณ", stage + " - Error: Generation Failed", rag_decision, 500)
-
-            stage += " - Completed"
+    if STARTUP["state"] != "ready":
+        return not_ready_response()
+    turn = ChatTurn(request, stream_non_rag=False)
+    events = turn.events()
+    async for kind, data in events:
+        if kind == "token":
+            headers = {
+                "X-Final-Stage": turn.stage,
+                "X-RAG-Decision": turn.rag_decision,
+                "X-Retrieval-Branches": ",".join(turn.debug_info.get("retrieval", {}).get("contributed", [])),
+                **turn.session_headers,
+            }
+            return StreamingResponse(text_stream(data["text"], events), media_type=STREAMING_CONTENT_TYPE, headers=headers)
+        if kind in ("done", "error"):
+            await events.aclose()
             response_data = ChatResponse(
-                reply=final_response,
-                stage=stage,
-                current_rag_decision=rag_decision,
-                debug_info=debug_info
+                reply=data.get("reply", "") if kind == "done" else data["message"],
+                stage=turn.stage,
+                current_rag_decision=turn.rag_decision,
+                session_id=data.get("session_id"),
+                debug_info=turn.debug_info,
             )
-            return JSONResponse(content=response_data.model_dump(exclude_none=True))
+            return JSONResponse(content=response_data.model_dump(exclude_none=True), status_code=data.get("status", 200))
 
-    except Exception as e:
-        logger.critical(f"Unhandled exception in handle_chat: {e}", exc_info=True)
-        return create_json_error_response("ขออภัยค่ะ เกิดข้อผิดพลาดที่ไม่คาดคิด", stage + " - Error: Unhandled", None, 500)
+@app.post("/chat/stream")
+@observe()
+async def handle_chat_stream(request: ChatRequest) -> Response:
+    """
+    Same pipeline as /chat as Server-Sent Events (`stage`, `retrieval`, `token`, `done`, `error`),
+    each sent as soon as it is known; non-RAG answers stream too. See ChatTurn for the payloads.
+    """
+    logger.info(f"Received chat stream request for user: {request.user_id}")
+    if STARTUP["state"] != "ready":
+        return not_ready_response()
+    turn = ChatTurn(request, stream_non_rag=True)
+    # No proxy buffering: each event has to reach the browser as soon as it is written.
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **turn.session_headers}
+    return StreamingResponse(sse_stream(turn.events()), media_type="text/event-stream", headers=headers)
+
+@app.get("/healthz")
+async def healthz() -> Dict[str, Any]:
+    """Liveness: the process and its event loop respond. Does not depend on the model or Mongo."""
+    return {"status": "ok", "uptime_s": round(time.perf_counter() - PROCESS_START, 1)}
+
+@app.get("/readyz")
+async def readyz() -> Response:
+    """Readiness: 200 once the components are initialized and the embedding model is loaded and warmed up."""
+    status_code = 200 if STARTUP["state"] == "ready" else 503
+    return JSONResponse(content=STARTUP, status_code=status_code)
+
+async def embedding_server_stats() -> Optional[Dict[str, Any]]:
+    """This worker's client counters plus the server's own stats, which cover every API worker."""
+    if EMBED_SERVER is None:
+        return None
+    stats = EMBED_SERVER.stats()
+    if EMBED_SERVER.available:
+        try:
+            stats["server"] = await EMBED_SERVER.server_stats()
+        except (EmbedServerUnavailable, RuntimeError) as e:
+            stats["server_error"] = str(e)
+    return stats
+
+@app.get("/metrics")
+async def metrics() -> Response:
+    """Prometheus metrics: per-stage latency histograms, RAG decisions, cache hits and upstream errors."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/stats")
+async def get_stats() -> Dict[str, Any]:
+    """Runtime counters for the caches and speculative work on the query path."""
+    if session_store is None:
+        # Initialization failed part-way (see /readyz), so there are no components to report on.
+        return {"startup": STARTUP}
+    return {
+        "startup": STARTUP,
+        "embedding_cache": search_engine.embedder.cache_stats(),
+        "embedding_batcher": search_engine.embedder.batcher_stats(),
+        "embedding_server": await embedding_server_stats(),
+        "semantic_cache": response_cache.stats(),
+        "retrieval_cache": search_engine.retrieval_cache.stats(),
+        "tokenizer": search_engine.tokenizer.stats(),
+        "speculation": SPECULATION_STATS.stats(),
+        "rag_router": rag_router.stats(),
+        "streaming": STREAM_STATS.stats(),
+        "context_packing": PACK_STATS.stats(),
+        "llm_pools": LLM_CLIENTS.stats(),
+        "llm_routing": LLM_ROUTER.stats(),
+        "llm_guard": LLM_ROUTER.guard_stats(),
+        "sessions": session_store.stats(),
+    }
 
 # --- Run Application ---
 if __name__ == "__main__":
@@ -0,0 +1,113 @@
+# metrics.py
+"""
+Prometheus metrics for the /chat pipeline, served at /metrics.
+
+chat_stage_seconds is one histogram labelled by stage (STAGES); p50/p95/p99
+per stage come from histogram_quantile over its buckets, e.g.
+
+    histogram_quantile(0.95, sum by (le, stage) (rate(chat_stage_seconds_bucket[5m])))
+
+Stages are timed where the work happens (models.py, functions.py), so
+speculative subqueries and retrievals are measured too. "ttft" runs from the
+arrival of the request to the first streamed chunk; "stream" from the start of
+the stream to its last chunk.
+
+Counters: RAG decisions by source (local router or LLM), cache lookups by cache
+and result, and upstream LLM errors by provider, role and kind.
+
+With several uvicorn workers, set PROMETHEUS_MULTIPROC_DIR to a directory shared
+by the workers; /metrics then aggregates all of them. The directory must be
+wiped before the workers start (see the Dockerfile): files left by a previous
+run would be summed into the new counters. Each worker calls
+mark_process_dead() from the app's shutdown hook, so live gauges of exited
+workers stop being reported.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import Iterator, Optional, Tuple
+
+from dotenv import load_dotenv
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "") # Read by prometheus_client itself; set for multi-worker servers
+STAGES = ("classification", "subquery", "embedding", "vector_search", "keyword_search", "fusion",
+          "non_rag_generation", "ttft", "stream")
+# Seconds; from in-memory fusion (milliseconds) up to full streamed answers.
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 30.0, 60.0)
+
+STAGE_SECONDS = Histogram("chat_stage_seconds", "Duration of each /chat pipeline stage.", ["stage"], buckets=STAGE_BUCKETS)
+RAG_DECISIONS = Counter("chat_rag_decisions", "RAG classification outcomes.", ["decision", "source"])
+CACHE_LOOKUPS = Counter("chat_cache_lookups", "Cache lookups on the /chat path.", ["cache", "result"])
+UPSTREAM_ERRORS = Counter("llm_upstream_errors", "Failed LLM provider requests.", ["provider", "role", "kind"])
+
+# Every stage shows up (at zero) from the first scrape, so quantile queries never miss a series.
+for _stage in STAGES:
+    STAGE_SECONDS.labels(_stage)
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+@contextmanager
+def time_stage(stage: str) -> Iterator[None]:
+    """Observes the duration of the block, also when it raises; cancelled work (e.g. unneeded speculation) is not a sample."""
+    start = time.perf_counter()
+    cancelled = False
+    try:
+        yield
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    finally:
+        if not cancelled:
+            STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+def record_rag_decision(decision: str, source: str) -> None:
+    RAG_DECISIONS.labels(decision, source).inc()
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def error_kind(exc: BaseException) -> str:
+    """Coarse error class, so the label keeps a small fixed set of values."""
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return "429" if status == 429 else ("5xx" if status >= 500 else "4xx")
+    name = type(exc).__name__
+    if isinstance(exc, asyncio.TimeoutError) or "Timeout" in name:
+        return "timeout"
+    if isinstance(exc, ConnectionError) or "Connect" in name or "Network" in name:
+        return "connection"
+    return "other"
+
+
+def record_upstream_error(provider: str, role: str, exc: BaseException) -> None:
+    UPSTREAM_ERRORS.labels(provider, role, error_kind(exc)).inc()
+
+
+def mark_process_dead(pid: Optional[int] = None) -> None:
+    """Multiprocess mode only: drops this worker's live-gauge files when it exits."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid if pid is not None else os.getpid())
+
+
+def render() -> Tuple[bytes, str]:
+    """(body, content type) in the Prometheus text format."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -6,11 +6,25 @@ import re
 import logging
 import json
 import asyncio
-from typing import List, Dict, Any, Optional, Union, Tuple, AsyncGenerator
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Union, Tuple, AsyncGenerator, Callable
 from dotenv import load_dotenv
 from openai import AsyncOpenAI, RateLimitError, APIError
 from sentence_transformers import SentenceTransformer
 from langfuse.decorators import langfuse_context, observe
+import numpy as np
+
+from cache import LRUCache, DiskCache, normalize_query
+from llmclients import get_llm_client
+from llmrouting import LLMRouter, NoModelAvailable, model_chain
+from llmguard import ProviderGuard
+from outputfilter import filter_stream, get_output_filter
+from metrics import record_cache, time_stage
+from onnxembed import OnnxEmbeddingModel
+from embedserver import EmbedClient, EmbedServerUnavailable, EMBED_SERVER_SOCKET, EMBED_SERVER_FALLBACK, EMBED_SERVER_RETRY_SECONDS
 
 from systemprompt import (
     get_rag_classification_prompt,
@@ -31,13 +45,223 @@ SUBQUERY_MODEL = "jai-chat-1-3-2"
 NORMAL_RAG_MODEL = 'gemini-2.5-flash'
 NON_RAG_MODEL = "gemini-2.5-flash"
 
+# Ordered fallback chains per role; override with a comma-separated LLM_CHAIN_<ROLE>.
+LLM_ROLE_CHAINS = {
+    "classification": model_chain("LLM_CHAIN_CLASSIFICATION", [CLASSIFICATION_MODEL, NON_RAG_MODEL]),
+    "subquery": model_chain("LLM_CHAIN_SUBQUERY", [SUBQUERY_MODEL, NON_RAG_MODEL]),
+    "rerank": model_chain("LLM_CHAIN_RERANK", [RERANKER_MODEL]),
+    "rag": model_chain("LLM_CHAIN_RAG", [NORMAL_RAG_MODEL, "jai-chat-1-3-2"]),
+    "non_rag": model_chain("LLM_CHAIN_NON_RAG", [NON_RAG_MODEL, "jai-chat-1-3-2"]),
+}
+
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "2048")) # 0 disables the in-memory tier
+EMBED_CACHE_TTL = float(os.getenv("EMBED_CACHE_TTL", "86400")) # Seconds, 0 = no expiry
+EMBED_CACHE_DISK_PATH = os.getenv("EMBED_CACHE_DISK_PATH", "") # SQLite file for the on-disk tier, empty disables it
+EMBED_CACHE_DISK_MAX_ROWS = int(os.getenv("EMBED_CACHE_DISK_MAX_ROWS", "100000")) # Oldest rows beyond this are evicted, 0 = no cap
+EMBED_MODEL_NAME = "BAAI/bge-m3"
+EMBED_MODEL_PATH = os.getenv("EMBED_MODEL_PATH", "") # Local snapshot directory of EMBED_MODEL_NAME; when set, the hub is never contacted
+EMBED_WARMUP = os.getenv("EMBED_WARMUP", "true").lower() == "true" # Warm-up forward pass before the app reports ready
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch") # "torch" (SentenceTransformer) or "onnx" (int8 ONNX Runtime graph, see onnxembed.py)
+EMBED_BATCH_MAX_SIZE = int(os.getenv("EMBED_BATCH_MAX_SIZE", "32")) # Texts per encode() call
+EMBED_BATCH_MAX_WAIT_MS = float(os.getenv("EMBED_BATCH_MAX_WAIT_MS", "5")) # How long to wait for a batch to fill
+EMBED_EXECUTOR_WORKERS = int(os.getenv("EMBED_EXECUTOR_WORKERS", "1")) # Concurrent encode() batches
+EMBED_TORCH_THREADS = int(os.getenv("EMBED_TORCH_THREADS", "0")) # Intra-op threads per batch, 0 = torch default
+
+class EmbeddingBatcher:
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray], executor: ThreadPoolExecutor,
+                 max_batch_size: int = EMBED_BATCH_MAX_SIZE, max_wait_ms: float = EMBED_BATCH_MAX_WAIT_MS,
+                 max_concurrent_batches: int = EMBED_EXECUTOR_WORKERS):
+        """
+        Collects concurrent single-text embed calls and runs them as one encode() batch.
+        A batch is dispatched once it holds max_batch_size texts or max_wait_ms after its first text arrived.
+        At most one batch per executor worker runs at a time; the rest queue up and grow into bigger batches.
+        """
+        self.encode_fn = encode_fn
+        self.executor = executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.max_concurrent_batches = max(1, max_concurrent_batches)
+        self._pending: deque = deque()
+        self._has_items: Optional[asyncio.Event] = None
+        self._batch_full: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.texts = 0
+        self.max_observed_batch = 0
+
+    def _ensure_worker(self) -> None:
+        # Created lazily so the asyncio primitives bind to the server's running loop.
+        if self._worker is None or self._worker.done():
+            self._has_items = asyncio.Event()
+            self._batch_full = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, text: str) -> np.ndarray:
+        """Queues one text and waits for its vector from the next batch."""
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text, future))
+        self._has_items.set()
+        if len(self._pending) >= self.max_batch_size:
+            self._batch_full.set()
+        return await future
+
+    async def _run(self) -> None:
+        while True:
+            await self._has_items.wait()
+            if len(self._pending) < self.max_batch_size:
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), timeout=self.max_wait)
+                except asyncio.TimeoutError:
+                    pass
+            await self._slots.acquire()
+            batch = [self._pending.popleft() for _ in range(min(self.max_batch_size, len(self._pending)))]
+            if len(self._pending) < self.max_batch_size:
+                self._batch_full.clear()
+            if not self._pending:
+                self._has_items.clear()
+            batch = [(text, future) for text, future in batch if not future.cancelled()]
+            if batch:
+                asyncio.get_running_loop().create_task(self._encode_batch(batch))
+            else:
+                self._slots.release()
+
+    async def _encode_batch(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        try:
+            vectors = await asyncio.get_running_loop().run_in_executor(self.executor, self.encode_fn, [text for text, _ in batch])
+            self.batches += 1
+            self.texts += len(batch)
+            self.max_observed_batch = max(self.max_observed_batch, len(batch))
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "avg_batch_size": round(self.texts / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size": self.max_observed_batch,
+            "pending": len(self._pending),
+        }
+
+class EmbeddingModel:
+    def __init__(self, name: str = EMBED_MODEL_NAME, path: str = EMBED_MODEL_PATH):
+        """
+        The BGE SentenceTransformer, loaded on first use instead of at import time.
+        The app loads it (and runs a warm-up pass) from its lifespan; scripts that never
+        embed anything never pay for it.
+        """
+        self.name = name
+        self.path = path
+        self._model: Optional[SentenceTransformer] = None
+        self._lock = threading.Lock()
+        self.load_ms: Optional[float] = None
+        self.warmup_ms: Optional[float] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def load(self) -> SentenceTransformer:
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    start = time.perf_counter()
+                    if self.path:
+                        model = SentenceTransformer(self.path, local_files_only=True)
+                    else:
+                        logger.warning(f"EMBED_MODEL_PATH is not set; resolving {self.name} through the Hugging Face hub.")
+                        model = SentenceTransformer(self.name)
+                    if EMBED_TORCH_THREADS > 0:
+                        import torch
+                        torch.set_num_threads(EMBED_TORCH_THREADS)
+                    self.load_ms = (time.perf_counter() - start) * 1000
+                    logger.info(f"Embedding model {self.name} loaded from {self.path or 'the hub'} in {self.load_ms:.0f} ms.")
+                    self._model = model
+        return self._model
+
+    def warmup(self) -> float:
+        """One forward pass so the first real query does not pay for lazy kernel and allocator setup."""
+        model = self.load()
+        start = time.perf_counter()
+        model.encode(["warm-up", "อุ่นเครื่อง"], batch_size=2)
+        self.warmup_ms = (time.perf_counter() - start) * 1000
+        logger.info(f"Embedding model warm-up took {self.warmup_ms:.0f} ms.")
+        return self.warmup_ms
+
+    def encode(self, texts, **kwargs) -> np.ndarray:
+        return self.load().encode(texts, **kwargs)
+
+
 # --- Embedding Setup (Global Scope) ---
-BGE = SentenceTransformer("BAAI/bge-m3")
+if EMBEDDING_BACKEND not in ("torch", "onnx"):
+    raise ValueError(f"Unknown EMBEDDING_BACKEND '{EMBEDDING_BACKEND}'. Use 'torch' or 'onnx'.")
+BGE = OnnxEmbeddingModel() if EMBEDDING_BACKEND == "onnx" else EmbeddingModel()
+# Vectors from the two backends differ slightly, so they never share on-disk cache entries.
+EMBED_CACHE_NAMESPACE = EMBED_MODEL_NAME if EMBEDDING_BACKEND == "torch" else f"{EMBED_MODEL_NAME}@{BGE.name}"
+EMBED_EXECUTOR = ThreadPoolExecutor(max_workers=EMBED_EXECUTOR_WORKERS, thread_name_prefix="bge-encode")
+EMBED_BATCHER = EmbeddingBatcher(lambda texts: BGE.encode(texts, batch_size=len(texts)), EMBED_EXECUTOR)
+EMBED_CACHE = LRUCache(EMBED_CACHE_SIZE, ttl=EMBED_CACHE_TTL, name="embedding")
+EMBED_DISK_CACHE = DiskCache(EMBED_CACHE_DISK_PATH, ttl=EMBED_CACHE_TTL, name="embedding_disk", max_rows=EMBED_CACHE_DISK_MAX_ROWS) if EMBED_CACHE_DISK_PATH else None
+# Shared out-of-process model (embedserver.py); BGE above is then only loaded as a fallback.
+EMBED_SERVER = EmbedClient(EMBED_SERVER_SOCKET) if EMBED_SERVER_SOCKET else None
 
 class Embedder:
     def __init__(self):
-        """Initializes the Embedder with a local BGE model."""
-        logger.info("Embedder initialized with BGE SentenceTransformer.")
+        """Initializes the Embedder with a local BGE model, or a client of the shared embedding server."""
+        if EMBED_SERVER is not None:
+            logger.info(f"Embedder initialized with the embedding server at {EMBED_SERVER_SOCKET} (in-process fallback: {EMBED_SERVER_FALLBACK}).")
+        else:
+            logger.info(f"Embedder initialized with the {EMBEDDING_BACKEND} BGE backend.")
+
+    async def _encode(self, texts: List[str]) -> np.ndarray:
+        """Vectors for texts from the embedding server when one is configured, otherwise in-process."""
+        if EMBED_SERVER is not None and (EMBED_SERVER.available or not EMBED_SERVER_FALLBACK):
+            try:
+                return await EMBED_SERVER.embed(texts)
+            except EmbedServerUnavailable as e:
+                if not EMBED_SERVER_FALLBACK:
+                    raise
+                logger.warning(f"{e}; encoding in-process for the next {EMBED_SERVER_RETRY_SECONDS:.0f} s.")
+        if EMBED_SERVER is not None:
+            EMBED_SERVER.fallbacks += 1
+        if len(texts) == 1:
+            return np.asarray([await EMBED_BATCHER.submit(texts[0])], dtype=np.float32)
+        # BGE.encode is synchronous and CPU-bound, so run it on the dedicated encode executor.
+        return await asyncio.get_running_loop().run_in_executor(EMBED_EXECUTOR, BGE.encode, texts)
+
+    async def _embed_single(self, text: str, key: str) -> List[float]:
+        """Encodes one query through the on-disk tier (if enabled) and the micro-batcher or embedding server."""
+        loop = asyncio.get_running_loop()
+        disk_key = f"{EMBED_CACHE_NAMESPACE}:{key}"
+        if EMBED_DISK_CACHE is not None:
+            cached = await loop.run_in_executor(None, EMBED_DISK_CACHE.get, disk_key)
+            if cached is not None:
+                return np.frombuffer(cached, dtype=np.float32).tolist()
+        vector = np.asarray((await self._encode([text]))[0], dtype=np.float32)
+        if EMBED_DISK_CACHE is not None:
+            loop.run_in_executor(None, EMBED_DISK_CACHE.set, disk_key, vector.tobytes())
+        return vector.tolist()
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss/eviction counters for the query embedding cache tiers."""
+        stats = {"memory": EMBED_CACHE.stats()}
+        if EMBED_DISK_CACHE is not None:
+            stats["disk"] = EMBED_DISK_CACHE.stats()
+        return stats
+
+    def batcher_stats(self) -> Dict[str, Any]:
+        """Batch counts and sizes from the in-process micro-batching scheduler."""
+        return EMBED_BATCHER.stats()
 
     async def embed(self, text: Union[str, List[str]], input_type: str) -> Optional[List[List[float]]]:
         """
@@ -45,16 +269,44 @@ class Embedder:
         The 'input_type' parameter is kept for signature consistency but is not used by this BGE implementation.
         """
         try:
-            # BGE.encode is synchronous and CPU-bound, so run it in a thread to avoid blocking the event loop.
-            loop = asyncio.get_running_loop()
-            response = await loop.run_in_executor(None, BGE.encode, text)
-            return response.tolist()
+            with time_stage("embedding"):
+                if isinstance(text, str):
+                    # Single queries go through the cache, keyed on the normalized text, then the micro-batcher.
+                    key = normalize_query(text)
+                    cached = EMBED_CACHE.get(key)
+                    record_cache("embedding", cached is not None)
+                    if cached is not None:
+                        return cached
+                    vector = await self._embed_single(text, key)
+                    EMBED_CACHE.set(key, vector)
+                    return vector
+                response = await self._encode(text)
+                return response.tolist()
         except Exception as e:
             logger.error(f"Error during BGE embedding: {e}", exc_info=True)
             return None
 
+def provider_for_model(model_name: str) -> str:
+    """Provider (client) that serves a model name."""
+    if model_name.startswith("gpt-"):
+        return "openai"
+    elif model_name.startswith("gemini-"):
+        return "gemini"
+    elif model_name.startswith("typhoon-"):
+        return "typhoon"
+    elif model_name.startswith("gemma3-"):
+        return "gemma"
+    else:
+        return "jai"
+
+
+# Shared by every LLMFinanceAnalyzer, so latency estimates cover all traffic.
+LLM_ROUTER = LLMRouter(provider_for_model, guard=ProviderGuard())
+
+
 class LLMFinanceAnalyzer:
     def __init__(self):
+        """Clients come from the process-wide registry in llmclients.py, so every instance shares one pool per provider."""
         self.openai_api_key = os.getenv("OPENAI_API_KEY")
         self.typhoon_api_key = os.getenv("TYPHOON_API_KEY")
         self.typhoon_base_url = os.getenv("TYPHOON_BASE_URL")
@@ -68,7 +320,7 @@ class LLMFinanceAnalyzer:
             logger.error("JTS_API_KEY or JAI_BASE_URL not found for JAI client.")
             raise ValueError("JAI API credentials are not configured.")
         try:
-            self.client_jai = AsyncOpenAI(base_url=self.jai_base_url, api_key=self.jai_api_key)
+            self.client_jai = get_llm_client("jai", self.jai_api_key, self.jai_base_url)
             logger.info("LLMFinanceAnalyzer initialized with JAI client.")
         except Exception as e:
             logger.error(f"Failed to initialize JAI client: {e}")
@@ -77,7 +329,7 @@ class LLMFinanceAnalyzer:
         self.client_gemini = None
         if self.gemini_api_key:
             try:
-                self.client_gemini = AsyncOpenAI(api_key=self.gemini_api_key, base_url="https://generativelanguage.googleapis.com/v1beta/openai/")
+                self.client_gemini = get_llm_client("gemini", self.gemini_api_key, "https://generativelanguage.googleapis.com/v1beta/openai/")
                 logger.info("LLMFinanceAnalyzer initialized with Gemini client.")
             except Exception as e:
                 logger.error(f"Failed to initialize Gemini client: {e}")
@@ -87,7 +339,7 @@ class LLMFinanceAnalyzer:
         self.client_openai = None
         if self.openai_api_key:
             try:
-                self.client_openai = AsyncOpenAI(api_key=self.openai_api_key)
+                self.client_openai = get_llm_client("openai", self.openai_api_key)
                 logger.info("LLMFinanceAnalyzer initialized with OpenAI client.")
             except Exception as e:
                 logger.error(f"Failed to initialize OpenAI client: {e}")
@@ -97,7 +349,7 @@ class LLMFinanceAnalyzer:
         self.client_typhoon = None
         if self.typhoon_api_key:
             try:
-                self.client_typhoon = AsyncOpenAI(api_key=self.typhoon_api_key, base_url=self.typhoon_base_url)
+                self.client_typhoon = get_llm_client("typhoon", self.typhoon_api_key, self.typhoon_base_url)
                 logger.info("LLMFinanceAnalyzer initialized with typhoon client.")
             except Exception as e:
                 logger.error(f"Failed to initialize typhoon client: {e}")
@@ -107,7 +359,7 @@ class LLMFinanceAnalyzer:
         self.client_gemma = None
         if self.gemma_api_key:
             try:
-                self.client_gemma = AsyncOpenAI(api_key=self.gemma_api_key, base_url=self.gemma_base_url)
+                self.client_gemma = get_llm_client("gemma", self.gemma_api_key, self.gemma_base_url)
                 logger.info("LLMFinanceAnalyzer initialized with gemma client.")
             except Exception as e:
                 logger.error(f"Failed to initialize gemma client: {e}")
@@ -116,92 +368,103 @@ class LLMFinanceAnalyzer:
 
     def _get_client_for_model(self, model_name: str) -> Optional[AsyncOpenAI]:
         """Selects the appropriate client based on the model name."""
-        if model_name.startswith("gpt-"):
-            return self.client_openai
-        elif model_name.startswith("gemini-"):
-            return self.client_gemini
-        elif model_name.startswith("typhoon-"):
-            return self.client_typhoon
-        elif model_name.startswith("gemma3-"):
-            return self.client_gemma
-        else:
-            return self.client_jai
+        return getattr(self, f"client_{provider_for_model(model_name)}", None)
+
+    async def _request(self, model: str, messages: List[Dict[str, str]], stream: bool,
+                       extra_params: Optional[Dict[str, Any]] = None) -> Union[str, Tuple[str, Any]]:
+        """
+        One request to one model. Non-streamed calls return the text; streamed calls
+        return (first content chunk, open stream) once the first content arrives.
+        Raises on any failure so the router can fail over.
+        """
+        client = self._get_client_for_model(model)
+        params = dict(extra_params or {})
+        if not stream:
+            response = await client.chat.completions.create(model=model, messages=messages, stream=False, **params)
+            content = response.choices[0].message.content
+            return content.strip() if content else ""
+
+        if model.startswith("gemini-"):
+            params["reasoning_effort"] = "none"
+        response_stream = await client.chat.completions.create(model=model, messages=messages, stream=True, **params)
+        try:
+            async for chunk in response_stream:
+                if chunk and chunk.choices and chunk.choices[0].delta.content:
+                    return chunk.choices[0].delta.content, response_stream
+            return "", response_stream
+        except BaseException:
+            # Lost the hedge race (cancelled) or failed before the first token.
+            await response_stream.close()
+            raise
+
+    @staticmethod
+    async def _close_stream(result: Any) -> None:
+        """Closes a streamed result that lost a hedge race (the router releases its permit)."""
+        if isinstance(result, tuple):
+            await result[1].close()
 
     @observe()
     async def _call_llm(
         self,
-        model: str,
+        role: str,
         messages: List[Dict[str, str]],
         temperature: float,
         max_tokens: int = 2048,
         seed: int = 66,
-        max_retries: int = 2,
-        stream: bool = False
+        stream: bool = False,
+        extra_params: Optional[Dict[str, Any]] = None,
     ) -> Union[Optional[str], AsyncGenerator[str, None]]:
-        """Internal helper to call the appropriate LLM client with retries."""
-        client = self._get_client_for_model(model)
-        if not client:
-            logger.error(f"No async client available for model {model}.")
+        """Calls the role's fallback chain through LLM_ROUTER (hedging and failover, no retry sleeps)."""
+        models = [m for m in LLM_ROLE_CHAINS[role] if self._get_client_for_model(m)]
+        try:
+            result, model, permit = await LLM_ROUTER.call(
+                role, models,
+                lambda m: self._request(m, messages, stream, extra_params),
+                discard=self._close_stream,
+                hold_permit=stream,
+            )
+        except NoModelAvailable as e:
+            logger.error(str(e))
             return None if not stream else (x for x in [])
+        except Exception as e:
+            logger.error(f"Every model failed for LLM role '{role}' ({LLM_ROLE_CHAINS[role]}): {e}")
+            if stream:
+                async def _error_gen(): yield f"\n[STREAM_ERROR: Max retries exceeded]\n"
+                return _error_gen()
+            return None
+
+        if not stream:
+            return result
 
-        attempt = 0
-        while attempt <= max_retries:
+        first_chunk, response_stream = result
+        async def _async_stream_generator():
             try:
-                if stream:
-                    if model.startswith("gemini-"):
-                        response_stream = await client.chat.completions.create(
-                        model=model, messages=messages, stream=True, reasoning_effort="none"
-                    )
-                    else:
-                        response_stream = await client.chat.completions.create(
-                            model=model, messages=messages, stream=True
-                        )
-                    async def _async_stream_generator():
-                        try:
-                            async for chunk in response_stream:
-                                # delta_content = chunk.choices[0].delta.content.replace("•", "\n•")
-                                
-                                if chunk:
-                                    content = chunk.choices[0].delta.content
-                                    if content:
-                                        # Clean up content by removing unwanted characters
-                                        
-                                        delta_content = content.replace("•", "\n•")
-                                        
-                                        yield delta_content
-                                
-                        except Exception as stream_err:
-                            logger.error(f"Error during LLM stream ({model}): {stream_err}", exc_info=True)
-                            yield f"\n[STREAM_ERROR: {stream_err}]\n"
-                    return _async_stream_generator()
-                else:
-                    response = await client.chat.completions.create(
-                        model=model, messages=messages,  stream=False
-                    )
-                    content = response.choices[0].message.content
-                    return content.strip() if content else ""
-            except (RateLimitError, APIError, Exception) as e:
-                logger.warning(f"Error on attempt {attempt+1} for model {model}: {e}. Retrying...")
-                attempt += 1
-                if attempt > max_retries:
-                    logger.error(f"Max retries exceeded for LLM call ({model}).")
-                    if stream:
-                        async def _error_gen(): yield f"\n[STREAM_ERROR: Max retries exceeded]\n"
-                        return _error_gen()
-                    return None
-                await asyncio.sleep(3 * attempt)
-        return None
+                if first_chunk:
+                    yield first_chunk
+                async for chunk in response_stream:
+                    if chunk and chunk.choices:
+                        content = chunk.choices[0].delta.content
+                        if content:
+                            yield content
+            except Exception as stream_err:
+                logger.error(f"Error during LLM stream ({model}): {stream_err}", exc_info=True)
+                yield f"\n[STREAM_ERROR: {stream_err}]\n"
+            finally:
+                await response_stream.close()
+                if permit is not None:
+                    await permit.release()
+        return _async_stream_generator()
 
     @observe()
     async def classify_rag_requirement(self, conversation: ConversationHistory) -> Optional[str]:
         """Classifies if the latest query requires RAG ('yes' or 'no') using full context."""
         if not conversation:
             return 'no'
-        print(conversation)
         system_prompt = get_rag_classification_prompt()
         messages = [{"role": "user", "content": system_prompt+"/n"+conversation[0].get("content")}] 
-        result = await self._call_llm(model=CLASSIFICATION_MODEL, messages=messages, temperature=0, max_tokens=10, stream=False)
-        print(result)
+        with time_stage("classification"):
+            result = await self._call_llm(role="classification", messages=messages, temperature=0, max_tokens=10, stream=False)
+        logger.debug(f"RAG classification raw result: {result!r}")
         if isinstance(result, str):
             result_lower = result.lower().strip().rstrip('.')
             if 'yes' in result_lower: return 'yes'
@@ -231,7 +494,7 @@ class LLMFinanceAnalyzer:
 
         # Use a fast and cheap model for this simple classification task
         result = await self._call_llm(
-            model=RERANKER_MODEL,
+            role="rerank",
             messages=messages,
             temperature=0,
             stream=False
@@ -262,7 +525,7 @@ Do not describe, answer as a list of number of the documents. example [0,2,4] \n
 
         # Use a fast and cheap model for this simple classification task
         result = await self._call_llm(
-            model=RERANKER_MODEL,
+            role="rerank",
             messages=messages,
             temperature=0,
             max_tokens=5, # 'yes' or 'no' is very short
@@ -285,24 +548,13 @@ Do not describe, answer as a list of number of the documents. example [0,2,4] \n
             logger.warning("generate_subquery called with empty conversation")
             return None
 
-        client = self._get_client_for_model(SUBQUERY_MODEL)
-        if not client:
-            logger.error(f"Client for subquery model '{SUBQUERY_MODEL}' not available")
-            return None
-
         system_prompt_content = get_subquery_prompt()
         messages = [{"role": "system", "content": system_prompt_content}] + conversation
 
-        try:
-            response = await client.chat.completions.create(
-                model=SUBQUERY_MODEL,
-                messages=messages,
-                temperature=0,
+        with time_stage("subquery"):
+            final_content = await self._call_llm(
+                role="subquery", messages=messages, temperature=0, stream=False, extra_params={"temperature": 0}
             )
-            final_content = response.choices[0].message.content
-        except Exception as e:
-            logger.error(f"API call error in generate_subquery: {e}", exc_info=True)
-            return None
 
         if not final_content:
             logger.error("No content received from subquery model")
@@ -320,32 +572,42 @@ Do not describe, answer as a list of number of the documents. example [0,2,4] \n
             messages = [{"role": "system", "content": system_prompt}] + conversation
 
             result_generator = await self._call_llm(
-                model=NORMAL_RAG_MODEL, messages=messages, temperature=0.2, stream=True
+                role="rag", messages=messages, temperature=0.2, stream=True
             )
             
             if isinstance(result_generator, AsyncGenerator):
-                async for chunk in result_generator:
-                    if lang == "th":
-                        print(chunk)
-                        yield chunk.replace("!","").replace("เซลล์","").replace("เเอดมิน","").replace("พนักงานขาย","").replace("คนสวย","")
-                    else:
-                        yield chunk.replace("เซลล์","").replace("เเอดมิน","").replace("พนักงานขาย","").replace("คนสวย","").replace("สวัสดีค่ะ!","สวัสดีค่ะ").replace("สวัสดีค่า!","สวัสดีค่า")
+                # Rules for this language from output_rules.json; terms split across deltas are caught too.
+                async for chunk in filter_stream(result_generator, get_output_filter("rag", lang)):
+                    yield chunk
             else:
                 yield "[ERROR: Failed to initiate normal RAG stream.]"
         except Exception as e:
             logger.error(f"Error in generate_normal_response setup: {e}", exc_info=True)
             yield f"[ERROR: {e}]"
 
+    @observe()
+    async def stream_non_rag_response(self, conversation: ConversationHistory, lang: str) -> AsyncGenerator[str, None]:
+        """Streamed variant of generate_non_rag_response, yielding text chunks."""
+        try:
+            messages = [{"role": "system", "content": get_non_rag_prompt(lang)}] + conversation
+            result_generator = await self._call_llm(role="non_rag", messages=messages, temperature=0, stream=True)
+            if isinstance(result_generator, AsyncGenerator):
+                async for chunk in filter_stream(result_generator, get_output_filter("non_rag", lang)):
+                    yield chunk
+            else:
+                yield "[ERROR: Failed to initiate non-RAG stream.]"
+        except Exception as e:
+            logger.error(f"Error in stream_non_rag_response setup: {e}", exc_info=True)
+            yield f"[ERROR: {e}]"
+
     @observe()
     async def generate_non_rag_response(self, conversation: ConversationHistory, lang : str) -> Optional[str]:
         """Generate response for non-RAG questions."""
         messages = [{"role": "system", "content": get_non_rag_prompt(lang)}] + conversation
-        result = await self._call_llm(model=NON_RAG_MODEL, messages=messages, temperature=0, stream=False)
+        with time_stage("non_rag_generation"):
+            result = await self._call_llm(role="non_rag", messages=messages, temperature=0, stream=False)
         
         if isinstance(result, str):
-            if lang == "th":
-                return result.replace("!","")
-            else:
-                return result
+            return get_output_filter("non_rag", lang).apply(result)
         logger.error("generate_non_rag_response call failed or returned non-string.")
         return None
\ No newline at end of file
@@ -0,0 +1,319 @@
+# onnxembed.py
+"""
+ONNX Runtime backend for BGE-m3 query embeddings (EMBEDDING_BACKEND=onnx).
+
+The transformer is exported once to ONNX and its weights are dynamically
+quantized to int8 (activations stay float and are quantized per call). That is
+about a quarter of the float32 weight memory per worker and faster on CPUs with
+VNNI/AMX. Pooling matches the SentenceTransformer pipeline of BGE-m3: CLS token,
+then L2 normalization.
+
+    python onnxembed.py export --model-path /models/bge-m3 --out /models/bge-m3-onnx
+    python onnxembed.py parity          # cosine vs SentenceTransformer on eval questions and KB chunks
+                                        # (also tests/test_onnxembed.py, skipped without an export)
+    python onnxembed.py bench           # latency and resident memory, each backend in its own process
+
+onnxruntime, onnx and the tokenizer are imported only when this backend loads,
+so the torch backend does not need them installed.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import logging
+from typing import Any, Dict, List, Optional, Union
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+EMBED_ONNX_PATH = os.getenv("EMBED_ONNX_PATH", "") # Directory written by `python onnxembed.py export`
+EMBED_ONNX_FILE = os.getenv("EMBED_ONNX_FILE", "model_int8.onnx") # "model.onnx" for the unquantized float32 graph
+EMBED_ONNX_THREADS = int(os.getenv("EMBED_ONNX_THREADS", "0")) # Intra-op threads per session, 0 = onnxruntime default
+EMBED_ONNX_MAX_LENGTH = int(os.getenv("EMBED_ONNX_MAX_LENGTH", "8192")) # Same as the SentenceTransformer config of BGE-m3
+EMBED_ONNX_BATCH_SIZE = 32
+ONNX_CONFIG_FILE = "onnx_config.json"
+PARITY_MIN_COSINE = 0.99
+
+
+def rss_mb() -> float:
+    """Current resident set size of this process in MiB (peak RSS where /proc is unavailable)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class OnnxEmbeddingModel:
+    def __init__(self, path: str = EMBED_ONNX_PATH, file_name: str = EMBED_ONNX_FILE, threads: int = EMBED_ONNX_THREADS,
+                 max_length: int = EMBED_ONNX_MAX_LENGTH):
+        """Same interface as models.EmbeddingModel (load, warmup, encode), backed by an ONNX Runtime session."""
+        self.path = path
+        self.file_name = file_name
+        self.threads = threads
+        self.max_length = max_length
+        self.name = f"onnx:{file_name}"
+        self._session = None
+        self._tokenizer = None
+        self._lock = threading.Lock()
+        self.load_ms: Optional[float] = None
+        self.warmup_ms: Optional[float] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._session is not None
+
+    def load(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    if not self.path:
+                        raise ValueError("EMBEDDING_BACKEND=onnx needs EMBED_ONNX_PATH (run `python onnxembed.py export` first).")
+                    graph = os.path.join(self.path, self.file_name)
+                    if not os.path.exists(graph):
+                        raise FileNotFoundError(f"No ONNX graph at {graph}. Run `python onnxembed.py export` "
+                                                "(in the Docker image: build with --build-arg EMBED_ONNX_EXPORT=true).")
+                    import onnxruntime as ort
+                    from transformers import AutoTokenizer
+
+                    start = time.perf_counter()
+                    options = ort.SessionOptions()
+                    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                    if self.threads > 0:
+                        options.intra_op_num_threads = self.threads
+                    self._tokenizer = AutoTokenizer.from_pretrained(self.path, local_files_only=True)
+                    self._session = ort.InferenceSession(os.path.join(self.path, self.file_name), options,
+                                                         providers=["CPUExecutionProvider"])
+                    self.load_ms = (time.perf_counter() - start) * 1000
+                    logger.info(f"ONNX embedding model {self.name} loaded in {self.load_ms:.0f} ms.")
+        return self._session
+
+    def warmup(self) -> float:
+        self.load()
+        start = time.perf_counter()
+        self.encode(["warm-up", "อุ่นเครื่อง"])
+        self.warmup_ms = (time.perf_counter() - start) * 1000
+        logger.info(f"ONNX embedding model warm-up took {self.warmup_ms:.0f} ms.")
+        return self.warmup_ms
+
+    def encode(self, texts: Union[str, List[str]], batch_size: Optional[int] = None, **kwargs: Any) -> np.ndarray:
+        """Normalized CLS embeddings, float32; a single string gives a 1-D vector like SentenceTransformer.encode."""
+        session = self.load()
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        batch_size = batch_size or EMBED_ONNX_BATCH_SIZE
+        outputs = []
+        for i in range(0, len(texts), batch_size):
+            encoded = self._tokenizer(texts[i:i + batch_size], padding=True, truncation=True,
+                                      max_length=self.max_length, return_tensors="np")
+            hidden = session.run(["last_hidden_state"], {
+                "input_ids": encoded["input_ids"].astype(np.int64),
+                "attention_mask": encoded["attention_mask"].astype(np.int64),
+            })[0]
+            cls = hidden[:, 0].astype(np.float32)
+            outputs.append(cls / np.maximum(np.linalg.norm(cls, axis=1, keepdims=True), 1e-12))
+        vectors = np.vstack(outputs) if outputs else np.zeros((0, 0), dtype=np.float32)
+        return vectors[0] if single else vectors
+
+
+def export(model_path: str, out_dir: str, quantize: bool = True, per_channel: bool = False, opset: int = 17) -> str:
+    """Exports the transformer to ONNX (float32), then writes the dynamically quantized int8 graph next to it."""
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(out_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModel.from_pretrained(model_path)
+    model.config.return_dict = False
+    model.eval()
+    sample = tokenizer(["hello world", "บัตรแรบบิทมีกี่ประเภท"], padding=True, return_tensors="pt")
+    fp32_path = os.path.join(out_dir, "model.onnx")
+    start = time.perf_counter()
+    with torch.no_grad():
+        # Weights above 2 GB are written as external data next to the graph.
+        torch.onnx.export(
+            model, (sample["input_ids"], sample["attention_mask"]), fp32_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state", "pooler_output"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "last_hidden_state": {0: "batch", 1: "sequence"},
+                "pooler_output": {0: "batch"},
+            },
+            opset_version=opset,
+            do_constant_folding=True,
+        )
+    print(f"Exported float32 graph to {fp32_path} in {time.perf_counter() - start:.0f} s")
+    tokenizer.save_pretrained(out_dir)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        start = time.perf_counter()
+        int8_path = os.path.join(out_dir, "model_int8.onnx")
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8, per_channel=per_channel)
+        print(f"Quantized int8 graph to {int8_path} in {time.perf_counter() - start:.0f} s "
+              f"({os.path.getsize(int8_path) / 2**20:.0f} MiB)")
+
+    with open(os.path.join(out_dir, ONNX_CONFIG_FILE), "w", encoding="utf-8") as f:
+        json.dump({"source": model_path, "pooling": "cls", "normalize": True, "opset": opset,
+                   "quantized": quantize, "per_channel": per_channel}, f, indent=2)
+    return out_dir
+
+
+def parity_report(reference: np.ndarray, candidate: np.ndarray, top_k: int = 5) -> Dict[str, Any]:
+    """
+    Row-wise cosine between two backends' embeddings of the same texts, and how much the
+    top_k nearest neighbours of each text (among all texts) move between them.
+    """
+    cosine = np.sum(reference * candidate, axis=1) / (np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1))
+    ref_top = np.argsort(-(reference @ reference.T), axis=1)[:, 1:top_k + 1]
+    cand_top = np.argsort(-(candidate @ candidate.T), axis=1)[:, 1:top_k + 1]
+    overlap = float(np.mean([len(set(a) & set(b)) / top_k for a, b in zip(ref_top, cand_top)]))
+    return {
+        "texts": int(len(cosine)),
+        "min_cosine": float(cosine.min()),
+        "p1_cosine": float(np.percentile(cosine, 1)),
+        "mean_cosine": float(cosine.mean()),
+        "neighbour_overlap": overlap,
+        "worst": [(int(i), float(cosine[i])) for i in np.argsort(cosine)[:3]],  # (text index, cosine)
+    }
+
+
+def check_parity(texts: List[str], candidate: Optional[OnnxEmbeddingModel] = None) -> Dict[str, Any]:
+    """Encodes texts with the SentenceTransformer model and the ONNX model and compares them (parity_report)."""
+    from models import EmbeddingModel
+
+    reference_vectors = np.asarray(EmbeddingModel().encode(texts, batch_size=16, normalize_embeddings=True), dtype=np.float32)
+    candidate_vectors = (candidate or OnnxEmbeddingModel()).encode(texts, batch_size=16)
+    return parity_report(reference_vectors, candidate_vectors)
+
+
+def parity_corpus(csv_path: str, mongo_limit: int) -> List[str]:
+    """Eval questions plus up to mongo_limit knowledge-base chunks (from Mongo, else the local vector index)."""
+    from ragrouter import load_eval_examples
+
+    texts = [text for text, _ in load_eval_examples(csv_path)]
+    chunks: List[str] = []
+    if mongo_limit > 0 and os.getenv("MONGO_URL"):
+        try:
+            from pymongo import MongoClient
+            client = MongoClient(os.getenv("MONGO_URL"), serverSelectionTimeoutMS=5000)
+            chunks = [d["content"] for d in client["rabbit-reward"]["rabbit-reward"].find({}, {"content": 1}).limit(mongo_limit) if d.get("content")]
+            client.close()
+        except Exception as e:
+            logger.warning(f"Could not read chunks from Mongo ({e}); trying the local vector index.")
+    if mongo_limit > 0 and not chunks:
+        from vectorindex import LocalVectorIndex
+        index = LocalVectorIndex()
+        if index.load():
+            chunks = index.contents[:mongo_limit]
+    return texts + chunks
+
+
+def _bench_one(backend: str, queries: List[str], repeats: int) -> Dict[str, Any]:
+    """Latency and RSS for one backend in the current process (bench runs each backend in its own process)."""
+    from models import EmbeddingModel
+
+    base_rss = rss_mb()
+    model = OnnxEmbeddingModel() if backend == "onnx" else EmbeddingModel()
+    model.load()
+    loaded_rss = rss_mb()
+    model.warmup()
+    single = []
+    for _ in range(repeats):
+        for query in queries:
+            start = time.perf_counter()
+            model.encode([query], batch_size=1)
+            single.append((time.perf_counter() - start) * 1000)
+    start = time.perf_counter()
+    model.encode(queries, batch_size=len(queries))
+    batch_ms = (time.perf_counter() - start) * 1000
+    return {
+        "backend": backend,
+        "model": model.name,
+        "load_ms": round(model.load_ms, 0),
+        "rss_base_mb": round(base_rss, 0),
+        "rss_loaded_mb": round(loaded_rss, 0),
+        "rss_after_mb": round(rss_mb(), 0),
+        "single_p50_ms": round(float(np.percentile(single, 50)), 2),
+        "single_p95_ms": round(float(np.percentile(single, 95)), 2),
+        "batch_ms_per_text": round(batch_ms / len(queries), 2),
+        "batch_size": len(queries),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import subprocess
+
+    parser = argparse.ArgumentParser(description="ONNX int8 embedding backend: export, parity check, benchmark.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_export = sub.add_parser("export")
+    p_export.add_argument("--model-path", default=os.getenv("EMBED_MODEL_PATH") or "BAAI/bge-m3")
+    p_export.add_argument("--out", default=EMBED_ONNX_PATH or "onnx-bge-m3")
+    p_export.add_argument("--no-quantize", action="store_true")
+    p_export.add_argument("--per-channel", action="store_true", help="Per-channel weight scales (more accurate, slightly larger)")
+    p_parity = sub.add_parser("parity")
+    p_parity.add_argument("--csv", default=None)
+    p_parity.add_argument("--chunks", type=int, default=500, help="Knowledge-base chunks added to the eval questions")
+    p_parity.add_argument("--min-cosine", type=float, default=PARITY_MIN_COSINE)
+    p_bench = sub.add_parser("bench")
+    p_bench.add_argument("--csv", default=None)
+    p_bench.add_argument("--queries", type=int, default=32)
+    p_bench.add_argument("--repeats", type=int, default=3)
+    p_one = sub.add_parser("_bench_one")
+    p_one.add_argument("backend", choices=("torch", "onnx"))
+    p_one.add_argument("--csv", default=None)
+    p_one.add_argument("--queries", type=int, default=32)
+    p_one.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.command == "export":
+        export(args.model_path, args.out, quantize=not args.no_quantize, per_channel=args.per_channel)
+
+    elif args.command == "parity":
+        from ragrouter import EVAL_CSV_PATH
+
+        texts = parity_corpus(args.csv or EVAL_CSV_PATH, args.chunks)
+        report = check_parity(texts)
+        print(f"{report['texts']} texts: cosine min {report['min_cosine']:.5f}, p1 {report['p1_cosine']:.5f}, mean {report['mean_cosine']:.5f}")
+        for i, cosine in report["worst"]:
+            print(f"  {cosine:.5f}  {texts[i][:80]!r}")
+        # Retrieval-level check: the top-5 neighbours of each eval question among all texts should barely move.
+        print(f"top-5 neighbour overlap: {report['neighbour_overlap']:.4f}")
+        if report["min_cosine"] < args.min_cosine:
+            print(f"FAIL: minimum cosine below {args.min_cosine}")
+            sys.exit(1)
+        print("OK")
+
+    elif args.command == "bench":
+        rows = []
+        for backend in ("torch", "onnx"):
+            cmd = [sys.executable, os.path.abspath(__file__), "_bench_one", backend,
+                   "--queries", str(args.queries), "--repeats", str(args.repeats)] + (["--csv", args.csv] if args.csv else [])
+            result = subprocess.run(cmd, capture_output=True, text=True)
+            if result.returncode != 0:
+                print(f"{backend}: failed\n{result.stderr[-2000:]}")
+                continue
+            rows.append(json.loads(result.stdout.strip().splitlines()[-1]))
+        for row in rows:
+            print(json.dumps(row, ensure_ascii=False))
+
+    elif args.command == "_bench_one":
+        from ragrouter import EVAL_CSV_PATH, load_eval_examples
+
+        queries = [text for text, _ in load_eval_examples(args.csv or EVAL_CSV_PATH)][:args.queries]
+        print(json.dumps(_bench_one(args.backend, queries, args.repeats)))
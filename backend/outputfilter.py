@@ -0,0 +1,181 @@
+# outputfilter.py
+"""
+Multi-pattern rewriting of model output, correct across stream chunk boundaries.
+
+Rules live in `output_rules.json` as {table: {lang: {pattern: replacement}}}
+(tables: "rag" for streamed RAG answers, "non_rag" for the non-RAG reply).
+All patterns of a table are compiled into one Aho-Corasick automaton, so each
+chunk is scanned once whatever the number of rules. Matches are replaced
+leftmost-longest and never overlap.
+
+This differs from the chain of `str.replace` calls it replaced, where each rule
+ran on the output of the previous ones. Replacements are not rescanned here, so
+text that only forms a pattern once another one is removed stays as it is: with
+the "en" table, "สวัสดีค่ะเซลล์!" became "สวัสดีค่ะ" and now becomes "สวัสดีค่ะ!".
+Add the joined form as its own rule where that matters. Rule order no longer
+matters either; overlaps resolve by position and length.
+
+Streaming: the automaton state carries over between chunks. Text is held back
+only while it could still be the start of a match, i.e. at most the longest
+pattern minus one character, so a banned term split across two deltas is still
+caught and nothing else is delayed.
+"""
+
+import os
+import json
+import logging
+from collections import deque
+from typing import AsyncGenerator, AsyncIterable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+OUTPUT_RULES_PATH = os.getenv("OUTPUT_RULES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "output_rules.json"))
+OUTPUT_DEFAULT_LANG = "en" # Used for languages without their own rules
+
+
+class OutputFilter:
+    def __init__(self, rules: Dict[str, str]):
+        """Compiles {pattern: replacement} into an Aho-Corasick automaton."""
+        self.rules = {p: r for p, r in rules.items() if p}
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._depth: List[int] = [0]
+        self._out: List[List[str]] = [[]]  # Patterns ending at each node (including via failure links)
+        for pattern in self.rules:
+            node = 0
+            for char in pattern:
+                nxt = self._goto[node].get(char)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][char] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._depth.append(self._depth[node] + 1)
+                    self._out.append([])
+                node = nxt
+            self._out[node].append(pattern)
+
+        # Breadth-first failure links; children of the root fail to the root.
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                self._fail[child] = self._step(self._fail[node], char) if node else 0
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+        # Depth of the longest suffix state that can still grow into a longer match; a
+        # completed pattern with no continuation does not need to be held back.
+        self._open_depth = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            queue.extend(self._goto[node].values())
+            self._open_depth[node] = self._depth[node] if self._goto[node] else self._open_depth[self._fail[node]]
+
+    def _step(self, node: int, char: str) -> int:
+        while node and char not in self._goto[node]:
+            node = self._fail[node]
+        return self._goto[node].get(char, 0)
+
+    def stream(self) -> "FilterStream":
+        return FilterStream(self)
+
+    def apply(self, text: str) -> str:
+        """Filters a complete string."""
+        if not self.rules:
+            return text
+        state = self.stream()
+        return state.feed(text) + state.flush()
+
+
+class FilterStream:
+    def __init__(self, output_filter: OutputFilter):
+        """Per-response filter state: automaton node, unemitted tail and the matches found in it."""
+        self._filter = output_filter
+        self._node = 0
+        self._pos = 0           # Characters consumed so far
+        self._tail = ""         # Unemitted text, starting at absolute offset _tail_start
+        self._tail_start = 0
+        self._matches: List[Tuple[int, int, str]] = []  # (start, end, pattern), absolute offsets
+
+    def feed(self, chunk: str) -> str:
+        """Consumes a chunk and returns the filtered text that can no longer change."""
+        if not self._filter.rules:
+            return chunk
+        f = self._filter
+        node, pos = self._node, self._pos
+        for char in chunk:
+            node = f._step(node, char)
+            pos += 1
+            for pattern in f._out[node]:
+                start = pos - len(pattern)
+                if start >= self._tail_start:
+                    self._matches.append((start, pos, pattern))
+        self._node, self._pos = node, pos
+        self._tail += chunk
+        # No match found later can start before this offset.
+        return self._emit(pos - f._open_depth[node])
+
+    def flush(self) -> str:
+        """Returns the held-back tail at the end of the stream."""
+        out = self._emit(self._pos)
+        self._node = 0
+        return out
+
+    def _emit(self, safe: int) -> str:
+        parts: List[str] = []
+        cursor = self._tail_start
+        # Leftmost first, longest first among matches with the same start.
+        for start, end, pattern in sorted(self._matches, key=lambda m: (m[0], m[0] - m[1])):
+            if start >= safe:
+                break
+            if start < cursor:
+                continue
+            parts.append(self._tail[cursor - self._tail_start:start - self._tail_start])
+            parts.append(self._filter.rules[pattern])
+            cursor = end
+        emitted_to = max(cursor, safe)
+        parts.append(self._tail[cursor - self._tail_start:emitted_to - self._tail_start])
+        self._tail = self._tail[emitted_to - self._tail_start:]
+        self._tail_start = emitted_to
+        self._matches = [m for m in self._matches if m[0] >= emitted_to]
+        return "".join(parts)
+
+
+def load_rules(path: str = OUTPUT_RULES_PATH) -> Dict[str, Dict[str, Dict[str, str]]]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+_RULES: Optional[Dict[str, Dict[str, Dict[str, str]]]] = None
+_FILTERS: Dict[Tuple[str, str], OutputFilter] = {}
+
+
+def get_output_filter(table: str, lang: str) -> OutputFilter:
+    """Compiled filter for a rule table and language (compiled once, then shared)."""
+    global _RULES
+    key = (table, lang)
+    output_filter = _FILTERS.get(key)
+    if output_filter is None:
+        if _RULES is None:
+            _RULES = load_rules()
+            logger.info(f"Output rules loaded from {OUTPUT_RULES_PATH}.")
+        tables = _RULES.get(table, {})
+        output_filter = _FILTERS.setdefault(key, OutputFilter(tables.get(lang, tables.get(OUTPUT_DEFAULT_LANG, {}))))
+    return output_filter
+
+
+async def filter_stream(source: AsyncIterable[str], output_filter: OutputFilter) -> AsyncGenerator[str, None]:
+    state = output_filter.stream()
+    async for chunk in source:
+        out = state.feed(chunk)
+        if out:
+            yield out
+    tail = state.flush()
+    if tail:
+        yield tail
@@ -0,0 +1,160 @@
+# quantization.py
+"""
+Compact embedding representations for storage and first-pass search.
+
+Stored format (`EMBEDDING_STORAGE`, shared with `preprocess/todb.py`):
+- "list":    BSON array of doubles (legacy, ~13 KB per 1024-d vector).
+- "float32": BSON binary vector, float32 (4 KB, lossless for search).
+- "int8":    `embedding` is a BSON int8 binary vector of the unit vector scaled by 127
+             (what the Atlas vector index sees), and `embedding_full` keeps the float32
+             vector for exact rescoring.
+
+In the local index, `Codebook` learns an optional PCA projection and per-dimension
+int8 calibration at build time; the same projected vectors also give binary
+(sign) codes compared by Hamming distance. The first pass runs over the codes and
+the top candidates are rescored against the float32 vectors.
+"""
+
+import os
+import logging
+from typing import Any, Dict, Optional
+
+import numpy as np
+from bson.binary import Binary, BinaryVectorDtype
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "list") # "list", "float32" or "int8"
+EMBEDDING_STORAGE_FORMATS = ("list", "float32", "int8")
+
+# BSON binary subtype 9 (vector) dtype bytes
+_VECTOR_SUBTYPE = 9
+_DTYPES = {BinaryVectorDtype.FLOAT32.value[0]: "<f4", BinaryVectorDtype.INT8.value[0]: "i1"}
+
+
+def decode_vector(value: Any) -> Optional[np.ndarray]:
+    """Returns a stored embedding (list, array or BSON binary vector) as float32, or None."""
+    if value is None:
+        return None
+    if isinstance(value, Binary) and value.subtype == _VECTOR_SUBTYPE:
+        raw = bytes(value)
+        dtype = _DTYPES.get(raw[0])
+        if dtype is None:
+            raise ValueError(f"Unsupported binary vector dtype byte {raw[0]:#x}.")
+        return np.frombuffer(raw[2:], dtype=dtype).astype(np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+
+def atlas_int8(vector: Any) -> np.ndarray:
+    """Unit-normalizes a vector and scales it to int8 in [-127, 127]; the Atlas-side int8 format."""
+    v = np.asarray(vector, dtype=np.float32)
+    v = v / (np.linalg.norm(v) or 1.0)
+    return np.clip(np.rint(v * 127.0), -127, 127).astype(np.int8)
+
+
+def encode_for_storage(vector: Any, storage: str = EMBEDDING_STORAGE) -> Dict[str, Any]:
+    """Returns the document fields holding an embedding in the configured stored format."""
+    v = np.asarray(vector, dtype=np.float32)
+    if storage == "list":
+        return {"embedding": v.tolist()}
+    if storage == "float32":
+        return {"embedding": Binary.from_vector(v.tolist(), BinaryVectorDtype.FLOAT32)}
+    if storage == "int8":
+        return {
+            "embedding": Binary.from_vector(atlas_int8(v).tolist(), BinaryVectorDtype.INT8),
+            "embedding_full": Binary.from_vector(v.tolist(), BinaryVectorDtype.FLOAT32),
+        }
+    raise ValueError(f"Unknown embedding storage '{storage}'. Use one of {EMBEDDING_STORAGE_FORMATS}.")
+
+
+def bson_list_bytes(dim: int) -> int:
+    """Size of a BSON array of `dim` doubles: per element a type byte, the index key and 8 bytes."""
+    return 5 + sum(1 + len(str(i)) + 1 + 8 for i in range(dim))
+
+
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _popcount(x: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    return _POPCOUNT_TABLE[x]
+
+
+class Codebook:
+    def __init__(self, mean: np.ndarray, components: Optional[np.ndarray], low: np.ndarray, scale: np.ndarray):
+        """
+        mean:       (dim,) centering applied before projection.
+        components: (dim, pca_dim) PCA basis, or None to keep every dimension.
+        low, scale: per-dimension int8 calibration; code = round((x - low) / scale) - 128.
+        """
+        self.mean = mean.astype(np.float32)
+        self.components = None if components is None else components.astype(np.float32)
+        self.low = low.astype(np.float32)
+        self.scale = scale.astype(np.float32)
+
+    @property
+    def dim(self) -> int:
+        return len(self.low)
+
+    @classmethod
+    def fit(cls, vectors: np.ndarray, pca_dim: int = 0, sample: int = 20000, seed: int = 66) -> "Codebook":
+        """Learns the centering, optional PCA basis and int8 ranges from (a sample of) unit vectors."""
+        rng = np.random.default_rng(seed)
+        train = vectors if len(vectors) <= sample else vectors[rng.choice(len(vectors), size=sample, replace=False)]
+        train = np.asarray(train, dtype=np.float32)
+        mean = train.mean(axis=0)
+        components = None
+        if 0 < pca_dim < vectors.shape[1]:
+            _, _, vt = np.linalg.svd(train - mean, full_matrices=False)
+            components = vt[:pca_dim].T
+        projected = (train - mean) if components is None else (train - mean) @ components
+        # Clip calibration at the 0.1/99.9 percentiles so outliers do not waste the int8 range.
+        low = np.percentile(projected, 0.1, axis=0)
+        high = np.percentile(projected, 99.9, axis=0)
+        scale = np.maximum(high - low, 1e-6) / 255.0
+        return cls(mean, components, low, scale)
+
+    def project(self, vectors: np.ndarray) -> np.ndarray:
+        centered = np.asarray(vectors, dtype=np.float32) - self.mean
+        return centered if self.components is None else centered @ self.components
+
+    def int8_codes(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.rint((self.project(vectors) - self.low) / self.scale) - 128.0
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def binary_codes(self, vectors: np.ndarray) -> np.ndarray:
+        return np.packbits(self.project(vectors) > 0, axis=-1)
+
+    def int8_scores(self, codes: np.ndarray, query: np.ndarray, block: int = 65536) -> np.ndarray:
+        """Approximate dot products of the query with the dequantized vectors (up to a per-query constant)."""
+        # The rows were centered, the query is not: q.(x - m) = q.x - q.m, and q.m is the same for every row.
+        # Centering the query too would add the row-dependent term -m.x and bias the ranking.
+        q = np.asarray(query, dtype=np.float32).reshape(-1)
+        if self.components is not None:
+            q = q @ self.components
+        weights = q * self.scale
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), block):
+            # Upcast one block at a time so the float copy stays bounded.
+            scores[start:start + block] = codes[start:start + block].astype(np.float32) @ weights
+        return scores
+
+    def binary_scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """Negative Hamming distance between the query's sign code and each row (higher is closer)."""
+        q = self.binary_codes(query.reshape(1, -1)).reshape(-1)
+        return -_popcount(np.bitwise_xor(codes, q)).sum(axis=1, dtype=np.int32).astype(np.float32)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        arrays = {"mean": self.mean, "low": self.low, "scale": self.scale}
+        if self.components is not None:
+            arrays["components"] = self.components
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays) -> "Codebook":
+        components = arrays["components"] if "components" in arrays else None
+        return cls(arrays["mean"], components, arrays["low"], arrays["scale"])
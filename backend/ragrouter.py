@@ -0,0 +1,309 @@
+# ragrouter.py
+"""
+Local RAG router: decides "yes"/"no" from the BGE-m3 embedding of the truncated
+conversation, so most turns skip the classification LLM call.
+
+The model is a logistic regression (or a two-centroid classifier) over unit
+embeddings, trained offline and serialized as versioned JSON. At request time
+the router only answers when its probability is outside the uncertainty band;
+otherwise main.py falls back to `classify_rag_requirement`. LLM decisions can
+be appended to a JSONL traffic log, which becomes extra training data.
+
+Train and evaluate:
+    python ragrouter.py train [--method logreg|centroid] [--traffic router/traffic.jsonl]
+    python ragrouter.py eval
+Training reports leave-one-out accuracy, local coverage and latency against the
+`ref_classification` column of eval/eval-rabbit.csv.
+"""
+
+import os
+import re
+import csv
+import json
+import time
+import threading
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+ROUTER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "router")
+RAG_ROUTER_MODEL_PATH = os.getenv("RAG_ROUTER_MODEL_PATH", os.path.join(ROUTER_DIR, "rag_router.json")) # Missing file disables the router
+RAG_ROUTER_CONFIDENCE = float(os.getenv("RAG_ROUTER_CONFIDENCE", "0.85")) # Decide locally only when max(p, 1 - p) >= this
+RAG_ROUTER_TRAFFIC_LOG = os.getenv("RAG_ROUTER_TRAFFIC_LOG", "") # JSONL of LLM-labelled conversations; empty disables logging
+EVAL_CSV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "eval", "eval-rabbit.csv")
+MAX_ASSISTANT_MSG_LENGTH = 300 # Same truncation main.py applies before classification
+
+
+def _sigmoid(z: np.ndarray) -> np.ndarray:
+    return 1.0 / (1.0 + np.exp(-z))
+
+
+def _unit(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class RagRouter:
+    def __init__(self, weights: Optional[np.ndarray] = None, bias: float = 0.0, meta: Optional[Dict[str, Any]] = None,
+                 confidence: float = RAG_ROUTER_CONFIDENCE):
+        """p(yes) = sigmoid(weights . unit(x) + bias). A router without weights is disabled."""
+        self.weights = None if weights is None else np.asarray(weights, dtype=np.float32)
+        self.bias = float(bias)
+        self.meta = meta or {}
+        self.confidence = confidence
+        self._lock = threading.Lock()
+        self.decided = {"yes": 0, "no": 0}
+        self.fallbacks = 0
+        self.total_ms = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.weights is not None
+
+    @property
+    def version(self) -> Optional[str]:
+        return self.meta.get("version")
+
+    # --- Training ---
+    @classmethod
+    def fit(cls, vectors: np.ndarray, labels: np.ndarray, method: str = "logreg", l2: float = 1e-2,
+            epochs: int = 500, lr: float = 0.5) -> "RagRouter":
+        """Trains on unit embeddings with labels 1 = "yes", 0 = "no"."""
+        x = _unit(vectors)
+        y = np.asarray(labels, dtype=np.float32)
+        if method == "centroid":
+            # Two-centroid rule as a linear model: margin = cos(x, c_yes) - cos(x, c_no), centred between the
+            # class means and scaled so each class mean maps to p = 0.95 / 0.05.
+            c_yes, c_no = _unit(x[y == 1].mean(axis=0)), _unit(x[y == 0].mean(axis=0))
+            margin = x @ (c_yes - c_no)
+            m_yes, m_no = float(margin[y == 1].mean()), float(margin[y == 0].mean())
+            scale = 2.0 * np.log(0.95 / 0.05) / max(m_yes - m_no, 1e-6)
+            return cls((c_yes - c_no) * scale, -scale * (m_yes + m_no) / 2.0, {"method": method})
+        if method != "logreg":
+            raise ValueError(f"Unknown router method '{method}'. Use 'logreg' or 'centroid'.")
+        # Class-balanced L2 logistic regression by full-batch gradient descent; the data is tiny.
+        sample_weight = np.where(y == 1, 0.5 / max(y.mean(), 1e-6), 0.5 / max(1 - y.mean(), 1e-6)).astype(np.float32)
+        w = np.zeros(x.shape[1], dtype=np.float32)
+        b = 0.0
+        for _ in range(epochs):
+            error = (_sigmoid(x @ w + b) - y) * sample_weight
+            w -= lr * (x.T @ error / len(y) + l2 * w)
+            b -= lr * float(error.mean())
+        return cls(w, b, {"method": method})
+
+    # --- Inference ---
+    def probability(self, vector: List[float]) -> float:
+        return float(_sigmoid(_unit(np.asarray(vector)) @ self.weights + self.bias))
+
+    def route(self, vector: Optional[List[float]]) -> Tuple[Optional[str], float]:
+        """Returns ("yes" | "no", p_yes) when confident, or (None, p_yes) to fall back to the LLM."""
+        if not self.enabled or not vector:
+            return None, float("nan")
+        start = time.perf_counter()
+        p_yes = self.probability(vector)
+        decision = None
+        if p_yes >= self.confidence:
+            decision = "yes"
+        elif 1.0 - p_yes >= self.confidence:
+            decision = "no"
+        with self._lock:
+            self.total_ms += (time.perf_counter() - start) * 1000
+            if decision is None:
+                self.fallbacks += 1
+            else:
+                self.decided[decision] += 1
+        return decision, p_yes
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            routed = self.decided["yes"] + self.decided["no"] + self.fallbacks
+            return {
+                "enabled": self.enabled,
+                "version": self.version,
+                "confidence": self.confidence,
+                "local_yes": self.decided["yes"],
+                "local_no": self.decided["no"],
+                "llm_fallbacks": self.fallbacks,
+                "local_rate": round((routed - self.fallbacks) / routed, 4) if routed else 0.0,
+                "avg_route_ms": round(self.total_ms / routed, 4) if routed else 0.0,
+            }
+
+    # --- Serialization ---
+    def save(self, directory: str = ROUTER_DIR) -> str:
+        """Writes rag_router-<version>.json and points rag_router.json at the same content. Returns the versioned path."""
+        os.makedirs(directory, exist_ok=True)
+        version = self.meta.setdefault("version", datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S"))
+        payload = json.dumps({**self.meta, "bias": self.bias, "weights": self.weights.tolist()}, ensure_ascii=False)
+        versioned = os.path.join(directory, f"rag_router-{version}.json")
+        with open(versioned, "w", encoding="utf-8") as f:
+            f.write(payload)
+        latest_tmp = os.path.join(directory, f".rag_router.json.{version}")
+        with open(latest_tmp, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(latest_tmp, os.path.join(directory, "rag_router.json"))
+        return versioned
+
+    @classmethod
+    def load(cls, path: str = RAG_ROUTER_MODEL_PATH, confidence: float = RAG_ROUTER_CONFIDENCE) -> "RagRouter":
+        """Loads a serialized router; a missing or unreadable file gives a disabled router."""
+        if not os.path.exists(path):
+            logger.info(f"No RAG router model at {path}; every turn uses the classification LLM.")
+            return cls(confidence=confidence)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            weights, bias = data.pop("weights"), data.pop("bias")
+            router = cls(np.asarray(weights, dtype=np.float32), bias, data, confidence)
+            logger.info(f"Loaded RAG router {router.version} ({data.get('method')}, embed model {data.get('embed_model')}).")
+            return router
+        except Exception as e:
+            logger.error(f"Failed to load RAG router from {path}: {e}", exc_info=True)
+            return cls(confidence=confidence)
+
+
+def log_llm_decision(text: str, decision: str, path: str = RAG_ROUTER_TRAFFIC_LOG) -> None:
+    """Appends an LLM-labelled conversation to the traffic log used as extra training data."""
+    if not path or decision not in ("yes", "no"):
+        return
+    try:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"text": text, "label": decision}, ensure_ascii=False) + "\n")
+    except OSError as e:
+        logger.warning(f"Could not append to router traffic log {path}: {e}")
+
+
+# --- Offline data loading (same text main.py embeds: truncated pseudo-conversation) ---
+def _parse_history(history_str: str) -> List[Dict[str, str]]:
+    """Parses the `history` column (a repr of ChatMessage objects), as eval/eval.py does."""
+    if not history_str or not history_str.strip() or history_str.strip() == "[]":
+        return []
+    history = []
+    for chunk in re.split(r"\),\s*ChatMessage\(", history_str.strip()[1:-1]):
+        chunk = chunk.removeprefix("ChatMessage(").removesuffix(")")
+        role = re.search(r"role='(.*?)'", chunk, re.DOTALL)
+        content = re.search(r"content='(.*?)'", chunk, re.DOTALL)
+        if role and content:
+            history.append({"role": role.group(1), "content": content.group(1)})
+    return history
+
+
+def conversation_text(conversation: List[Dict[str, str]]) -> str:
+    """Truncates assistant turns and flattens the conversation like main.generate_pseudo_conversation."""
+    lines = []
+    for msg in conversation:
+        content = msg.get("content", "")
+        if msg.get("role") == "assistant" and len(content) > MAX_ASSISTANT_MSG_LENGTH:
+            content = content[:MAX_ASSISTANT_MSG_LENGTH] + "..."
+        lines.append(f"{msg.get('role', 'unknown')}: {content}\n")
+    return "".join(lines).strip()
+
+
+def load_eval_examples(path: str = EVAL_CSV_PATH) -> List[Tuple[str, int]]:
+    with open(path, "r", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    examples = []
+    for row in rows:
+        label = row.get("ref_classification", "").strip().lower()
+        if label in ("yes", "no"):
+            conversation = _parse_history(row.get("history", "")) + [{"role": "user", "content": row["user_input"]}]
+            examples.append((conversation_text(conversation), int(label == "yes")))
+    return examples
+
+
+def load_traffic_examples(path: str) -> List[Tuple[str, int]]:
+    examples = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("label") in ("yes", "no"):
+                examples.append((record["text"], int(record["label"] == "yes")))
+    return examples
+
+
+def evaluate(router: RagRouter, vectors: np.ndarray, labels: np.ndarray) -> Dict[str, float]:
+    """Accuracy if every decision were taken locally, plus coverage and accuracy within the confident band."""
+    decisions = [router.route(v.tolist())[0] for v in vectors]
+    forced = np.array([router.probability(v) >= 0.5 for v in vectors], dtype=np.int32)
+    confident = np.array([d is not None for d in decisions])
+    local = np.array([d == "yes" for d in decisions], dtype=np.int32)
+    return {
+        "accuracy": float((forced == labels).mean()),
+        "coverage": float(confident.mean()),
+        "confident_accuracy": float((local[confident] == labels[confident]).mean()) if confident.any() else float("nan"),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Train or evaluate the local RAG router.")
+    parser.add_argument("command", choices=("train", "eval"))
+    parser.add_argument("--method", default="logreg", choices=("logreg", "centroid"))
+    parser.add_argument("--csv", default=EVAL_CSV_PATH)
+    parser.add_argument("--traffic", default=RAG_ROUTER_TRAFFIC_LOG, help="Optional JSONL of LLM-labelled traffic")
+    parser.add_argument("--confidence", type=float, default=RAG_ROUTER_CONFIDENCE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from models import BGE, EMBED_MODEL_NAME  # Loads the embedding model; only needed offline
+
+    eval_examples = load_eval_examples(args.csv)
+    texts, labels = zip(*eval_examples)
+    start = time.perf_counter()
+    eval_vectors = np.asarray(BGE.encode(list(texts)), dtype=np.float32)
+    embed_ms = (time.perf_counter() - start) * 1000 / len(texts)
+    eval_labels = np.asarray(labels, dtype=np.int32)
+
+    if args.command == "train":
+        train_vectors, train_labels = eval_vectors, eval_labels
+        if args.traffic and os.path.exists(args.traffic):
+            traffic = load_traffic_examples(args.traffic)
+            if traffic:
+                t_texts, t_labels = zip(*traffic)
+                train_vectors = np.vstack([eval_vectors, np.asarray(BGE.encode(list(t_texts)), dtype=np.float32)])
+                train_labels = np.concatenate([eval_labels, np.asarray(t_labels, dtype=np.int32)])
+
+        # Leave-one-out over the labelled eval set (traffic rows always stay in training).
+        held_out_p = []
+        for i in range(len(eval_labels)):
+            mask = np.ones(len(train_labels), dtype=bool)
+            mask[i] = False
+            held_out_p.append(RagRouter.fit(train_vectors[mask], train_labels[mask], args.method).probability(eval_vectors[i]))
+        held_out_p = np.asarray(held_out_p)
+        confident = np.maximum(held_out_p, 1 - held_out_p) >= args.confidence
+        loo = {
+            "accuracy": float(((held_out_p >= 0.5) == eval_labels).mean()),
+            "coverage": float(confident.mean()),
+            "confident_accuracy": float(((held_out_p[confident] >= 0.5) == eval_labels[confident]).mean()) if confident.any() else float("nan"),
+        }
+
+        router = RagRouter.fit(train_vectors, train_labels, args.method)
+        router.confidence = args.confidence
+        start = time.perf_counter()
+        for v in eval_vectors:
+            router.probability(v)
+        route_ms = (time.perf_counter() - start) * 1000 / len(eval_vectors)
+        router.meta.update({
+            "method": args.method,
+            "embed_model": EMBED_MODEL_NAME,
+            "trained_on": {"eval_rows": int(len(eval_labels)), "traffic_rows": int(len(train_labels) - len(eval_labels))},
+            "leave_one_out": loo,
+            "latency_ms": {"embed": round(embed_ms, 2), "route": round(route_ms, 4)},
+        })
+        path = router.save()
+        print(f"Saved {path}")
+        print(json.dumps({k: router.meta[k] for k in ("version", "leave_one_out", "latency_ms", "trained_on")}, indent=2))
+    else:
+        router = RagRouter.load(confidence=args.confidence)
+        if not router.enabled:
+            raise SystemExit("No router model found. Run `python ragrouter.py train` first.")
+        print(json.dumps({"version": router.version, **evaluate(router, eval_vectors, eval_labels),
+                          "embed_ms": round(embed_ms, 2)}, indent=2))
@@ -0,0 +1,135 @@
+# semanticcache.py
+"""
+Semantic cache for generated RAG answers.
+
+Entries are keyed on the embedding of `cache_key_text` (the normalized latest
+user message plus a few earlier user messages, capped in length) and the
+language. A lookup returns the
+stored answer chunks when the cosine similarity to a cached query passes the
+threshold, so paraphrases of the same question skip classification, subquery
+generation, retrieval and generation. The whole cache is dropped whenever the
+knowledge-base version changes, and individual entries expire after a TTL.
+"""
+
+import os
+import time
+import threading
+import logging
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from cache import normalize_query
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1000")) # 0 disables the cache
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "3600")) # Seconds
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")) # Minimum cosine similarity for a hit
+SEMANTIC_CACHE_CONTEXT_MESSAGES = int(os.getenv("SEMANTIC_CACHE_CONTEXT_MESSAGES", "2")) # Earlier user messages in the key, so follow-ups don't collide
+SEMANTIC_CACHE_KEY_CHARS = int(os.getenv("SEMANTIC_CACHE_KEY_CHARS", "512")) # Cap on the embedded key text, latest message kept
+
+
+def cache_key_text(conversation: List[Dict[str, str]]) -> str:
+    """
+    Text embedded for the cache key: the last few user messages, normalized, newest last.
+    Assistant replies are left out and the length is capped, so the embedding stays cheap
+    however long the conversation grows, and a repeated question reuses the embedding cache.
+    """
+    messages = [normalize_query(m["content"]) for m in conversation if m.get("role") == "user" and m.get("content")]
+    return "\n".join(messages[-(SEMANTIC_CACHE_CONTEXT_MESSAGES + 1):])[-SEMANTIC_CACHE_KEY_CHARS:]
+
+
+class SemanticResponseCache:
+    def __init__(self, capacity: int = SEMANTIC_CACHE_SIZE, ttl: float = SEMANTIC_CACHE_TTL, threshold: float = SEMANTIC_CACHE_THRESHOLD):
+        """Fixed-capacity cache; vectors live in one preallocated matrix so a lookup is a single dot product."""
+        self.capacity = capacity
+        self.ttl = ttl
+        self.threshold = threshold
+        self._vectors: Optional[np.ndarray] = None  # (capacity, dim), unit rows
+        self._entries: List[Optional[Dict[str, Any]]] = [None] * capacity
+        self._kb_version: Optional[str] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def _check_version(self, kb_version: str) -> None:
+        """Drops every entry when the knowledge base has been re-ingested."""
+        if kb_version != self._kb_version:
+            if self._kb_version is not None and any(self._entries):
+                self.invalidations += 1
+                logger.info(f"Knowledge base version changed ({self._kb_version} -> {kb_version}); semantic cache cleared.")
+            self._entries = [None] * self.capacity
+            self._kb_version = kb_version
+
+    def lookup(self, query_vector: List[float], lang: str, kb_version: str) -> Optional[List[str]]:
+        """Returns the cached answer chunks for the most similar query, or None."""
+        if not self.enabled:
+            return None
+        query = np.array(query_vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        now = time.monotonic()
+        with self._lock:
+            self._check_version(kb_version)
+            if self._vectors is None:
+                self.misses += 1
+                return None
+            usable = np.array([
+                entry is not None and entry["lang"] == lang and now - entry["stored_at"] <= self.ttl
+                for entry in self._entries
+            ])
+            if not usable.any():
+                self.misses += 1
+                return None
+            similarities = np.where(usable, self._vectors @ query, -np.inf)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            entry = self._entries[best]
+            entry["last_used"] = now
+            self.hits += 1
+            logger.info(f"Semantic cache hit (similarity={similarities[best]:.4f}).")
+            return entry["chunks"]
+
+    def store(self, query_vector: List[float], lang: str, kb_version: str, chunks: List[str]) -> None:
+        """Stores an answer, replacing an expired slot or the least recently used entry when full."""
+        if not self.enabled or not chunks:
+            return
+        query = np.array(query_vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        now = time.monotonic()
+        with self._lock:
+            self._check_version(kb_version)
+            if self._vectors is None:
+                self._vectors = np.zeros((self.capacity, query.shape[0]), dtype=np.float32)
+            slot = next((i for i, entry in enumerate(self._entries)
+                         if entry is None or now - entry["stored_at"] > self.ttl), None)
+            if slot is None:
+                slot = min(range(self.capacity), key=lambda i: self._entries[i]["last_used"])
+                self.evictions += 1
+            self._vectors[slot] = query
+            self._entries[slot] = {"lang": lang, "chunks": list(chunks), "stored_at": now, "last_used": now}
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": sum(entry is not None for entry in self._entries),
+            "capacity": self.capacity,
+            "threshold": self.threshold,
+            "kb_version": self._kb_version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,137 @@
+# sessionstore.py
+"""
+Optional server-side conversation sessions.
+
+A client that sends a `session_id` only has to send the new message: the
+session keeps the most recent SESSION_KEEP_MESSAGES messages verbatim and folds
+older turns into a rolling summary of bounded size. Sessions live in an LRU
+cache (SESSION_STORE_MAX_SESSIONS, idle expiry SESSION_TTL), so memory stays
+bounded and payloads, validation and prompt size stop growing with the length
+of the conversation.
+
+The summary is extractive (no LLM call on the request path): each folded turn
+contributes the user's question and the start of the answer.
+
+Sessions live in the memory of one process. With several uvicorn workers (or
+replicas), run a single worker or route each session to the same worker
+(sticky routing); a request that lands elsewhere finds no session and the
+client has to resend its history.
+"""
+
+import os
+import threading
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from cache import LRUCache
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+SESSION_STORE_MAX_SESSIONS = int(os.getenv("SESSION_STORE_MAX_SESSIONS", "10000")) # 0 disables server-side sessions
+SESSION_TTL = float(os.getenv("SESSION_TTL", "3600")) # Seconds since the last turn before a session expires
+SESSION_KEEP_MESSAGES = int(os.getenv("SESSION_KEEP_MESSAGES", "6")) # Recent messages kept verbatim
+SESSION_SUMMARY_MAX_CHARS = int(os.getenv("SESSION_SUMMARY_MAX_CHARS", "1500")) # Oldest summary lines are dropped first
+SESSION_SUMMARY_ANSWER_CHARS = 150 # Characters of each folded answer kept in the summary
+
+Message = Dict[str, str]
+
+
+class Session:
+    def __init__(self, messages: Optional[List[Message]] = None):
+        self.messages: List[Message] = []
+        self.summary_lines: List[str] = []
+        self.turns = 0
+        self._lock = threading.Lock()
+        if messages:
+            self.extend(messages)
+
+    def _fold(self, message: Message) -> None:
+        content = message.get("content", "").strip().replace("\n", " ")
+        if message.get("role") == "assistant" and len(content) > SESSION_SUMMARY_ANSWER_CHARS:
+            content = content[:SESSION_SUMMARY_ANSWER_CHARS] + "..."
+        self.summary_lines.append(f"{message.get('role', 'unknown')}: {content}")
+        while self.summary_lines and sum(len(line) + 1 for line in self.summary_lines) > SESSION_SUMMARY_MAX_CHARS:
+            self.summary_lines.pop(0)
+
+    def extend(self, messages: List[Message]) -> None:
+        with self._lock:
+            for message in messages:
+                self.messages.append({"role": message["role"], "content": message["content"]})
+                if message["role"] == "user":
+                    self.turns += 1
+            while len(self.messages) > SESSION_KEEP_MESSAGES:
+                self._fold(self.messages.pop(0))
+
+    def snapshot(self) -> Tuple[List[Message], str]:
+        """(recent messages, summary of older turns) as copies."""
+        with self._lock:
+            return [dict(m) for m in self.messages], "\n".join(self.summary_lines)
+
+
+def summary_messages(summary: str) -> List[Message]:
+    """The rolling summary as a leading message, or nothing when there is none."""
+    if not summary:
+        return []
+    return [{"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"}]
+
+
+class SessionStore:
+    def __init__(self, max_sessions: int = SESSION_STORE_MAX_SESSIONS, ttl: float = SESSION_TTL):
+        self.enabled = max_sessions > 0
+        self._sessions = LRUCache(max_sessions, ttl=ttl, name="sessions")
+        self.created = 0
+        self.seeded = 0
+        self.resumed = 0
+
+    def load(self, user_id: str, session_id: str, history: List[Message]) -> Tuple[List[Message], str, str]:
+        """
+        Returns (recent history, summary, status). status is "resumed" for a known
+        session, "seeded" when an unknown session is started from the client's
+        history (e.g. after a restart or eviction), or "new".
+        """
+        key = (user_id, session_id)
+        session = self._sessions.get(key)
+        if session is not None:
+            # A client only resends history when it was told the session is new. If that history has
+            # turns this session never saw, the session was lost and recreated by a turn answered
+            # without context: the client's history is the complete one.
+            if sum(1 for m in history if m["role"] == "user") <= session.turns:
+                self.resumed += 1
+                if history:
+                    logger.info(f"Session {session_id}: ignoring {len(history)} client history messages, the session is known.")
+                messages, summary = session.snapshot()
+                return messages, summary, "resumed"
+            logger.info(f"Session {session_id}: reseeding from {len(history)} client history messages.")
+        if not history:
+            # Not stored yet: append_turn creates it when the turn completes. Storing an empty session
+            # here would make the client's history look stale on its next request after a lost session.
+            return [], "", "new"
+        session = Session(history)
+        self._sessions.set(key, session)
+        self.seeded += 1
+        messages, summary = session.snapshot()
+        return messages, summary, "seeded"
+
+    def append_turn(self, user_id: str, session_id: str, message: str, reply: str) -> None:
+        """Records a completed turn; refreshes the session's position and expiry."""
+        key = (user_id, session_id)
+        session = self._sessions.get(key)
+        if session is None:
+            session = Session()
+            self.created += 1
+        session.extend([{"role": "user", "content": message}, {"role": "assistant", "content": reply}])
+        self._sessions.set(key, session)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._sessions.stats(),
+            "enabled": self.enabled,
+            "keep_messages": SESSION_KEEP_MESSAGES,
+            "created": self.created,
+            "seeded": self.seeded,
+            "resumed": self.resumed,
+        }
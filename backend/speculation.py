@@ -0,0 +1,131 @@
+# speculation.py
+"""
+Speculative execution for the chat pipeline.
+
+Most traffic is classified as needing RAG, so work that only the RAG path
+needs (subquery generation, and optionally retrieval of the raw message) can
+start while classification is still running. If the decision comes back "no",
+or the result turns out not to be needed, the task is cancelled and counted as
+wasted.
+
+SPECULATIVE_MODE:
+- "off":       classification, then subquery generation, then retrieval (serial).
+- "subquery":  subquery generation runs concurrently with classification. Costs
+               an extra LLM call on every turn classified "no".
+- "retrieval": additionally retrieves documents for the raw message; the result
+               is reused when the embedding of the generated subquery is at least
+               SPECULATIVE_REUSE_SIMILARITY cosine-similar to the message's.
+
+Both speculative modes trade provider spend for latency, so the default is "off";
+check wasted_rate in /stats before enabling one.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Any, Awaitable, Dict, Optional, Sequence
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+SPECULATIVE_MODE = os.getenv("SPECULATIVE_MODE", "off") # "off", "subquery" or "retrieval"
+SPECULATIVE_REUSE_SIMILARITY = float(os.getenv("SPECULATIVE_REUSE_SIMILARITY", "0.9")) # Min cosine(subquery, message) to reuse speculative retrieval
+SPECULATIVE_MODES = ("off", "subquery", "retrieval")
+
+
+def cosine_similarity(a: Sequence[float], b: Sequence[float]) -> float:
+    a, b = np.asarray(a, dtype=np.float32), np.asarray(b, dtype=np.float32)
+    norm = float(np.linalg.norm(a) * np.linalg.norm(b))
+    return float(a @ b) / norm if norm else 0.0
+
+
+class SpeculationStats:
+    def __init__(self):
+        """Process-wide counters per speculative task kind."""
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[str, float]] = {}
+
+    def record(self, name: str, outcome: str, saved_ms: float = 0.0) -> None:
+        """outcome is "used" or "wasted"; saved_ms is how long the task ran before it was needed."""
+        with self._lock:
+            counters = self._counters.setdefault(name, {"started": 0, "used": 0, "wasted": 0, "saved_ms": 0.0})
+            counters[outcome] += 1
+            counters["saved_ms"] += saved_ms
+
+    def started(self, name: str) -> None:
+        with self._lock:
+            self._counters.setdefault(name, {"started": 0, "used": 0, "wasted": 0, "saved_ms": 0.0})["started"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            report: Dict[str, Any] = {"mode": SPECULATIVE_MODE}
+            for name, counters in self._counters.items():
+                settled = counters["used"] + counters["wasted"]
+                report[name] = {
+                    "started": int(counters["started"]),
+                    "used": int(counters["used"]),
+                    "wasted": int(counters["wasted"]),
+                    "wasted_rate": round(counters["wasted"] / settled, 4) if settled else 0.0,
+                    "avg_saved_ms": round(counters["saved_ms"] / counters["used"], 1) if counters["used"] else 0.0,
+                }
+            return report
+
+
+SPECULATION_STATS = SpeculationStats()
+
+
+class Speculation:
+    def __init__(self, mode: str = SPECULATIVE_MODE, stats: SpeculationStats = SPECULATION_STATS):
+        """Tracks the speculative tasks of one request."""
+        if mode not in SPECULATIVE_MODES:
+            raise ValueError(f"Unknown speculative mode '{mode}'. Use one of {SPECULATIVE_MODES}.")
+        self.mode = mode
+        self.stats = stats
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._started_at: Dict[str, float] = {}
+        self.report: Dict[str, str] = {}
+
+    def enabled(self, name: str) -> bool:
+        """Whether the mode speculates on a task kind ("subquery" or "retrieval")."""
+        return self.mode == name or (self.mode == "retrieval" and name == "subquery")
+
+    def start(self, name: str, coro: Awaitable[Any]) -> None:
+        self._tasks[name] = asyncio.ensure_future(coro)
+        self._started_at[name] = time.perf_counter()
+        self.stats.started(name)
+
+    def has(self, name: str) -> bool:
+        return name in self._tasks
+
+    async def take(self, name: str, needed_since: Optional[float] = None) -> Any:
+        """
+        Awaits a speculative task and counts it as used. needed_since is when the
+        serial pipeline would have started this work; the overlap is reported as saved time.
+        """
+        task = self._tasks.pop(name)
+        started_at = self._started_at.pop(name)
+        saved_ms = max(0.0, ((needed_since or time.perf_counter()) - started_at) * 1000)
+        self.stats.record(name, "used", saved_ms)
+        self.report[name] = "used"
+        return await task
+
+    def discard(self, name: Optional[str] = None) -> None:
+        """Cancels one (or every remaining) speculative task and counts it as wasted."""
+        names = [name] if name is not None else list(self._tasks)
+        for task_name in names:
+            task = self._tasks.pop(task_name, None)
+            if task is None:
+                continue
+            self._started_at.pop(task_name, None)
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is not None:
+                logger.info(f"Discarded speculative '{task_name}' task had failed: {task.exception()}")
+            self.stats.record(task_name, "wasted")
+            self.report[task_name] = "wasted"
@@ -0,0 +1,127 @@
+# streaming.py
+"""
+Flush policy for streamed answers.
+
+LLM deltas are often a few bytes each. `coalesce` forwards the first delta
+immediately (time to first byte), then buffers the following ones until either
+STREAM_FLUSH_BYTES have accumulated or STREAM_FLUSH_INTERVAL_MS has passed since
+the oldest buffered delta, whichever comes first. The interval is enforced with
+a timeout on the pending read, so a slow model never holds text back longer
+than the interval.
+"""
+
+import os
+import asyncio
+import threading
+import logging
+from typing import Any, AsyncGenerator, AsyncIterable, Dict, List
+
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", "256")) # 0 forwards every delta as it arrives
+STREAM_FLUSH_INTERVAL_MS = float(os.getenv("STREAM_FLUSH_INTERVAL_MS", "50"))
+
+
+async def coalesce(source: AsyncIterable[str], flush_bytes: int = STREAM_FLUSH_BYTES,
+                   flush_interval_ms: float = STREAM_FLUSH_INTERVAL_MS) -> AsyncGenerator[str, None]:
+    """
+    Re-chunks an async stream of text: first delta immediately, then by size or age.
+    The source is closed when this generator ends for any reason, so a consumer that
+    stops early releases the upstream stream (and whatever it holds) right away.
+    """
+    iterator = source.__aiter__()
+    pending = None
+    try:
+        if flush_bytes <= 0:
+            async for chunk in iterator:
+                yield chunk
+            return
+
+        loop = asyncio.get_running_loop()
+        interval = flush_interval_ms / 1000.0
+        buffer: List[str] = []
+        size = 0
+        deadline = 0.0
+        first = True
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = max(0.0, deadline - loop.time()) if buffer else None
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                # The oldest buffered delta has waited the full interval.
+                yield "".join(buffer)
+                buffer, size = [], 0
+                continue
+
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                if buffer:
+                    yield "".join(buffer)
+                    buffer, size = [], 0
+                raise
+
+            if first:
+                first = False
+                yield chunk
+                continue
+            if not buffer:
+                deadline = loop.time() + interval
+            buffer.append(chunk)
+            size += len(chunk.encode("utf-8"))
+            if size >= flush_bytes:
+                yield "".join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+            # The source cannot be closed while that read is still running inside it.
+            await asyncio.gather(pending, return_exceptions=True)
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+class StreamStats:
+    def __init__(self):
+        """Process-wide counters for streamed responses."""
+        self._lock = threading.Lock()
+        self.responses = 0
+        self.writes = 0
+        self.bytes = 0
+        self.ttfb_ms = 0.0
+        self.duration_ms = 0.0
+
+    def record(self, writes: int, num_bytes: int, ttfb_ms: float, duration_ms: float) -> None:
+        with self._lock:
+            self.responses += 1
+            self.writes += writes
+            self.bytes += num_bytes
+            self.ttfb_ms += ttfb_ms
+            self.duration_ms += duration_ms
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            n = self.responses
+            return {
+                "flush_bytes": STREAM_FLUSH_BYTES,
+                "flush_interval_ms": STREAM_FLUSH_INTERVAL_MS,
+                "responses": n,
+                "avg_writes": round(self.writes / n, 1) if n else 0.0,
+                "avg_write_bytes": round(self.bytes / self.writes, 1) if self.writes else 0.0,
+                "avg_ttfb_ms": round(self.ttfb_ms / n, 1) if n else 0.0,
+                "avg_duration_ms": round(self.duration_ms / n, 1) if n else 0.0,
+            }
+
+
+STREAM_STATS = StreamStats()
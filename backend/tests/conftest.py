@@ -0,0 +1,5 @@
+# Backend modules import each other by bare name (they run from this directory), so tests do too.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,17 @@
+import time
+
+from cache import DiskCache
+
+
+def test_disk_cache_prunes_expired_rows_and_caps_size(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.sqlite"), ttl=60, max_rows=5, prune_every=4)
+    cache.set("stale", b"x")
+    cache._connect().execute("UPDATE cache SET stored_at = ? WHERE key = 'stale'", (time.time() - 120,))
+    for i in range(7):
+        cache.set(f"k{i}", b"v")
+
+    rows = {key for (key,) in cache._connect().execute("SELECT key FROM cache")}
+    # Pruned after the 4th and 8th write: the expired row first, then the oldest beyond max_rows.
+    assert rows == {"k2", "k3", "k4", "k5", "k6"}
+    assert cache.get("k6") == b"v"
+    assert cache.stats()["pruned"] == 3
@@ -0,0 +1,211 @@
+import asyncio
+import time
+import types
+
+import pytest
+
+import llmguard
+from llmguard import AdaptiveLimiter, CircuitBreaker, CircuitOpen, ProviderGuard, ProviderSaturated
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Only llmguard's view of time; the event loop keeps the real clock.
+    fake = Clock()
+    monkeypatch.setattr(llmguard, "time", types.SimpleNamespace(monotonic=fake.monotonic))
+    return fake
+
+
+class StatusError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def open_breaker(breaker: CircuitBreaker) -> None:
+    for _ in range(llmguard.LLM_BREAKER_FAILURE_THRESHOLD):
+        breaker.record(False)
+    assert breaker.state == "open"
+
+
+def test_consecutive_failures_open_the_breaker(clock):
+    breaker = CircuitBreaker("p")
+    for _ in range(llmguard.LLM_BREAKER_FAILURE_THRESHOLD - 1):
+        breaker.record(False)
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "open" and breaker.times_opened == 1
+    assert not breaker.allow() and breaker.rejected == 1
+
+
+def test_success_resets_the_consecutive_count(clock):
+    breaker = CircuitBreaker("p")
+    for _ in range(3):
+        for _ in range(llmguard.LLM_BREAKER_FAILURE_THRESHOLD - 1):
+            breaker.record(False)
+        breaker.record(True)
+        breaker.outcomes.clear()  # Keep the failure rate out of this test
+    assert breaker.state == "closed"
+
+
+def test_failure_rate_opens_the_breaker(clock, monkeypatch):
+    monkeypatch.setattr(llmguard, "LLM_BREAKER_MIN_CALLS", 10)
+    monkeypatch.setattr(llmguard, "LLM_BREAKER_FAILURE_RATE", 0.5)
+    breaker = CircuitBreaker("p")
+    # Alternating outcomes never reach the consecutive threshold.
+    for i in range(9):
+        breaker.record(i % 2 == 0)
+    assert breaker.state == "closed"  # 4 failures in 9
+    breaker.record(False)  # 5 in 10
+    assert breaker.state == "open"
+
+
+def test_open_breaker_turns_half_open_after_the_open_period(clock):
+    breaker = CircuitBreaker("p")
+    open_breaker(breaker)
+    clock.now += llmguard.LLM_BREAKER_OPEN_SECONDS - 0.1
+    assert not breaker.allow()
+    clock.now += 0.1
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+
+
+def test_half_open_admits_a_limited_number_of_probes(clock, monkeypatch):
+    monkeypatch.setattr(llmguard, "LLM_BREAKER_HALF_OPEN_PROBES", 2)
+    breaker = CircuitBreaker("p")
+    open_breaker(breaker)
+    clock.now += llmguard.LLM_BREAKER_OPEN_SECONDS
+    assert breaker.allow() and breaker.allow()
+    assert not breaker.allow()
+    breaker.release_probe()
+    assert breaker.allow()
+
+
+def test_half_open_probe_outcome_closes_or_reopens(clock):
+    breaker = CircuitBreaker("p")
+    open_breaker(breaker)
+    clock.now += llmguard.LLM_BREAKER_OPEN_SECONDS
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "open" and breaker.times_opened == 2
+    assert not breaker.allow()
+
+    clock.now += llmguard.LLM_BREAKER_OPEN_SECONDS
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == "closed" and breaker.consecutive_failures == 0
+
+
+def test_guard_releases_the_probe_on_cancel_and_client_error(clock):
+    async def run():
+        guard = ProviderGuard()
+        open_breaker(guard._breaker("p"))
+        assert guard.is_open("p")
+        with pytest.raises(CircuitOpen):
+            await guard.acquire("p")
+
+        clock.now += llmguard.LLM_BREAKER_OPEN_SECONDS
+        assert not guard.is_open("p")
+        permit = await guard.acquire("p")  # The single probe
+        with pytest.raises(CircuitOpen):
+            await guard.acquire("p")
+
+        # Cancelled: no verdict on the provider, the probe slot is free again.
+        guard.record_cancelled("p")
+        await permit.release()
+        permit = await guard.acquire("p")
+
+        # A client error says nothing about provider health either.
+        guard.record_failure("p", StatusError(400))
+        await permit.release()
+        assert guard._breaker("p").state == "half_open"
+        permit = await guard.acquire("p")
+
+        guard.record_failure("p", StatusError(503))
+        await permit.release()
+        assert guard.is_open("p")
+
+    asyncio.run(run())
+
+
+def test_aimd_increase_and_rate_limited_halving(clock, monkeypatch):
+    monkeypatch.setattr(llmguard, "LLM_LIMIT_INITIAL", 16.0)
+    limiter = AdaptiveLimiter("p")
+    limiter.on_success()
+    assert limiter.limit == pytest.approx(16.0 + 1 / 16)
+
+    limiter.limit = 16.0
+    limiter.on_congestion()
+    assert limiter.limit == 8.0
+    clock.now += llmguard.LLM_LIMIT_DECREASE_INTERVAL / 2
+    limiter.on_congestion()  # Same burst of errors: no second halving
+    assert limiter.limit == 8.0 and limiter.decreases == 1
+    clock.now += llmguard.LLM_LIMIT_DECREASE_INTERVAL
+    limiter.on_congestion()
+    assert limiter.limit == 4.0 and limiter.decreases == 2
+
+    for _ in range(10):
+        clock.now += llmguard.LLM_LIMIT_DECREASE_INTERVAL
+        limiter.on_congestion()
+    assert limiter.limit == llmguard.LLM_LIMIT_MIN
+
+
+def test_slow_success_counts_as_congestion(clock):
+    guard = ProviderGuard()
+    limiter = guard._limiter("p")
+    start = limiter.limit
+    guard.record_success("p", latency_ms=100, average_ms=100)
+    assert limiter.limit > start
+    guard.record_success("p", latency_ms=100 * llmguard.LLM_LIMIT_LATENCY_FACTOR + 1, average_ms=100)
+    assert limiter.limit < start
+
+
+def test_acquire_rejects_after_the_queue_timeout(monkeypatch):
+    monkeypatch.setattr(llmguard, "LLM_LIMIT_INITIAL", 1.0)
+    monkeypatch.setattr(llmguard, "LLM_LIMIT_QUEUE_TIMEOUT_MS", 50.0)
+
+    async def run():
+        limiter = AdaptiveLimiter("p")
+        assert await limiter.acquire()
+        start = time.perf_counter()
+        assert not await limiter.acquire()
+        assert 0.04 <= time.perf_counter() - start < 0.5
+        assert limiter.rejected == 1
+
+        # A slot freed within the timeout admits the waiter.
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0.01)
+        await limiter.release()
+        assert await waiter
+        assert limiter.in_flight == 1
+
+    asyncio.run(run())
+
+
+def test_saturated_guard_releases_the_probe(clock, monkeypatch):
+    monkeypatch.setattr(llmguard, "LLM_LIMIT_INITIAL", 1.0)
+    monkeypatch.setattr(llmguard, "LLM_LIMIT_QUEUE_TIMEOUT_MS", 10.0)
+
+    async def run():
+        guard = ProviderGuard()
+        held = await guard.acquire("p")
+        open_breaker(guard._breaker("p"))
+        clock.now += llmguard.LLM_BREAKER_OPEN_SECONDS
+        with pytest.raises(ProviderSaturated):
+            await guard.acquire("p")
+        assert guard._breaker("p").probes == 0
+        await held.release()
+        await held.release()  # Idempotent
+        assert guard._limiter("p").in_flight == 0
+        permit = await guard.acquire("p")
+        await permit.release()
+
+    asyncio.run(run())
@@ -0,0 +1,199 @@
+import asyncio
+import time
+
+import pytest
+
+import llmguard
+import llmrouting
+from llmguard import ProviderGuard
+from llmrouting import LLMRouter, NoModelAvailable
+
+HEDGE_DELAY_MS = 50
+
+
+@pytest.fixture(autouse=True)
+def hedging(monkeypatch):
+    monkeypatch.setattr(llmrouting, "LLM_HEDGE", True)
+    monkeypatch.setattr(llmrouting, "LLM_MAX_HEDGES", 1)
+    monkeypatch.setattr(llmrouting, "LLM_HEDGE_INITIAL_DELAY_MS", HEDGE_DELAY_MS)
+
+
+class UpstreamError(Exception):
+    status_code = 503
+
+
+class FakeStream:
+    def __init__(self, model: str):
+        self.model = model
+        self.closed = False
+
+    async def close(self) -> None:
+        self.closed = True
+
+
+class FakeProviders:
+    """attempt() for LLMRouter.call: each model opens a stream, waits, then answers or raises."""
+
+    def __init__(self, delays=None, errors=None, gate: asyncio.Event = None):
+        self.delays = delays or {}
+        self.errors = errors or {}
+        self.gate = gate
+        self.started = []
+        self.streams = []
+        self.discarded = []
+
+    async def attempt(self, model: str) -> FakeStream:
+        self.started.append(model)
+        stream = FakeStream(model)
+        self.streams.append(stream)
+        try:
+            if self.gate is not None:
+                await self.gate.wait()
+            await asyncio.sleep(self.delays.get(model, 0))
+            if model in self.errors:
+                raise self.errors[model]
+            return stream
+        except BaseException:
+            await stream.close()
+            raise
+
+    async def discard(self, stream: FakeStream) -> None:
+        self.discarded.append(stream.model)
+        await stream.close()
+
+
+def in_flight(guard: ProviderGuard, provider: str) -> int:
+    return guard._limiter(provider).in_flight
+
+
+def test_hedge_fires_after_the_delay_and_the_faster_result_wins():
+    async def run():
+        router = LLMRouter(lambda m: m)
+        providers = FakeProviders(delays={"slow": 1.0, "fast": 0.01})
+        start = time.perf_counter()
+        result, model, permit = await router.call("rag", ["slow", "fast"], providers.attempt)
+        elapsed = time.perf_counter() - start
+        assert model == "fast" and result.model == "fast" and permit is None
+        assert HEDGE_DELAY_MS / 1000 <= elapsed < 0.5
+        assert providers.started == ["slow", "fast"]
+        assert router.hedges == 1 and router.hedge_wins == 1
+
+    asyncio.run(run())
+
+
+def test_no_hedge_before_the_delay():
+    async def run():
+        router = LLMRouter(lambda m: m)
+        providers = FakeProviders(delays={"a": 0.01})
+        _, model, _ = await router.call("rag", ["a", "b"], providers.attempt)
+        assert model == "a" and providers.started == ["a"]
+        assert router.hedges == 0
+
+    asyncio.run(run())
+
+
+def test_losing_stream_is_closed_and_its_permit_released():
+    async def run():
+        guard = ProviderGuard()
+        router = LLMRouter(lambda m: m, guard=guard)
+        providers = FakeProviders(delays={"slow": 1.0, "fast": 0.01})
+        result, model, permit = await router.call("rag", ["slow", "fast"], providers.attempt,
+                                                  discard=providers.discard, hold_permit=True)
+        assert model == "fast" and not result.closed
+        loser = next(s for s in providers.streams if s.model == "slow")
+        assert loser.closed
+        assert in_flight(guard, "slow") == 0
+        assert in_flight(guard, "fast") == 1  # Held for the caller
+        await permit.release()
+        assert in_flight(guard, "fast") == 0
+
+    asyncio.run(run())
+
+
+def test_result_that_completes_with_the_winner_is_discarded():
+    async def run():
+        guard = ProviderGuard()
+        router = LLMRouter(lambda m: m, guard=guard)
+        gate = asyncio.Event()
+        providers = FakeProviders(gate=gate)
+
+        async def release_gate():
+            while len(providers.started) < 2:
+                await asyncio.sleep(0.005)
+            gate.set()
+
+        opener = asyncio.ensure_future(release_gate())
+        result, model, permit = await router.call("rag", ["a", "b"], providers.attempt,
+                                                  discard=providers.discard, hold_permit=True)
+        await opener
+        loser = "b" if model == "a" else "a"
+        assert providers.discarded == [loser]
+        assert all(s.closed == (s.model == loser) for s in providers.streams)
+        assert in_flight(guard, loser) == 0
+        await permit.release()
+
+    asyncio.run(run())
+
+
+def test_no_model_available_when_every_breaker_is_open():
+    async def run():
+        guard = ProviderGuard()
+        router = LLMRouter(lambda m: m, guard=guard)
+        for provider in ("a", "b"):
+            for _ in range(llmguard.LLM_BREAKER_FAILURE_THRESHOLD):
+                guard._breaker(provider).record(False)
+        providers = FakeProviders()
+        with pytest.raises(NoModelAvailable):
+            await router.call("rag", ["a", "b"], providers.attempt)
+        assert providers.started == []
+        with pytest.raises(NoModelAvailable):
+            await router.call("rag", [], providers.attempt)
+
+    asyncio.run(run())
+
+
+def test_open_breaker_fails_over_to_the_next_model():
+    async def run():
+        guard = ProviderGuard()
+        router = LLMRouter(lambda m: m, guard=guard)
+        for _ in range(llmguard.LLM_BREAKER_FAILURE_THRESHOLD):
+            guard._breaker("a").record(False)
+        providers = FakeProviders()
+        _, model, _ = await router.call("rag", ["a", "b"], providers.attempt)
+        assert model == "b" and providers.started == ["b"]
+
+    asyncio.run(run())
+
+
+def test_primary_and_hedge_failing_together():
+    async def run():
+        guard = ProviderGuard()
+        router = LLMRouter(lambda m: m, guard=guard)
+        gate = asyncio.Event()
+        errors = {"a": UpstreamError("a down"), "b": UpstreamError("b down")}
+        providers = FakeProviders(errors=errors, gate=gate)
+
+        async def release_gate():
+            while len(providers.started) < 2:
+                await asyncio.sleep(0.005)
+            gate.set()
+
+        opener = asyncio.ensure_future(release_gate())
+        with pytest.raises(UpstreamError):
+            await router.call("rag", ["a", "b"], providers.attempt)
+        await opener
+        assert router.hedges == 1 and router.failures == 1
+        assert all(s.closed for s in providers.streams)
+        assert in_flight(guard, "a") == 0 and in_flight(guard, "b") == 0
+        assert router.stats()["providers"]["a"]["errors"] == 1
+        assert router.stats()["providers"]["b"]["errors"] == 1
+
+        # With a third model in the chain, the call fails over to it instead.
+        gate.clear()
+        providers.started.clear()
+        opener = asyncio.ensure_future(release_gate())
+        _, model, _ = await router.call("rag", ["a", "b", "c"], providers.attempt)
+        await opener
+        assert model == "c" and router.failovers == 1
+
+    asyncio.run(run())
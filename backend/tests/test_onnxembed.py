@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+import pytest
+
+from onnxembed import EMBED_ONNX_FILE, EMBED_ONNX_PATH, PARITY_MIN_COSINE, check_parity, parity_corpus, parity_report
+
+PARITY_TEXTS = [
+    "บัตรแรบบิทมีกี่ประเภท",
+    "เติมเงินบัตรแรบบิทได้ที่ไหนบ้าง",
+    "แลกคะแนน Rabbit Rewards เป็นส่วนลดได้อย่างไร",
+    "How do I top up my Rabbit card?",
+    "What happens to my points if I lose my card?",
+    "สวัสดีค่ะ",
+]
+
+
+def test_parity_report():
+    rng = np.random.default_rng(0)
+    reference = rng.normal(size=(40, 64)).astype(np.float32)
+    same = parity_report(reference, reference.copy())
+    assert same["min_cosine"] == pytest.approx(1.0) and same["neighbour_overlap"] == 1.0
+
+    noisy = reference.copy()
+    noisy[7] = rng.normal(size=64)
+    report = parity_report(reference, noisy)
+    assert report["min_cosine"] < 0.5
+    assert report["worst"][0][0] == 7
+    assert report["neighbour_overlap"] < 1.0
+
+
+def test_onnx_matches_sentence_transformer():
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("transformers")
+    pytest.importorskip("sentence_transformers")
+    if not EMBED_ONNX_PATH or not os.path.exists(os.path.join(EMBED_ONNX_PATH, EMBED_ONNX_FILE)):
+        pytest.skip("No exported ONNX model (set EMBED_ONNX_PATH after `python onnxembed.py export`).")
+    texts = list(PARITY_TEXTS)
+    try:
+        from ragrouter import EVAL_CSV_PATH
+        texts += parity_corpus(EVAL_CSV_PATH, 0)
+    except (ImportError, OSError):
+        pass
+    report = check_parity(texts)
+    assert report["min_cosine"] >= PARITY_MIN_COSINE, report
@@ -0,0 +1,89 @@
+import random
+from typing import Dict
+
+import pytest
+
+from outputfilter import OutputFilter, load_rules
+
+
+def reference(text: str, rules: Dict[str, str]) -> str:
+    """Leftmost-longest rewriting by brute force."""
+    out, i = [], 0
+    patterns = sorted(rules, key=len, reverse=True)
+    while i < len(text):
+        match = next((p for p in patterns if text.startswith(p, i)), None)
+        if match is None:
+            out.append(text[i])
+            i += 1
+        else:
+            out.append(rules[match])
+            i += len(match)
+    return "".join(out)
+
+
+@pytest.fixture(scope="module")
+def rag():
+    rules = load_rules()
+    return OutputFilter(rules["rag"]["th"]), OutputFilter(rules["rag"]["en"])
+
+
+NESTED = OutputFilter({"ab": "1", "abcd": "2", "bc": "3", "d": "4"})
+
+
+def test_rules(rag):
+    th, en = rag
+    assert th.apply("ติดต่อเเอดมินได้เลย!") == "ติดต่อได้เลย"
+    assert en.apply("สวัสดีค่ะ! I am คนสวย") == "สวัสดีค่ะ I am "
+    assert en.apply("Hi!") == "Hi!"
+    assert th.apply("ข้อ•หนึ่ง•สอง") == "ข้อ\n•หนึ่ง\n•สอง"
+    assert OutputFilter({}).apply("unchanged!") == "unchanged!"
+
+
+def test_replacements_are_not_rescanned(rag):
+    # Unlike the former str.replace chain, removing one pattern does not create a match for another.
+    th, en = rag
+    assert en.apply("สวัสดีค่ะเซลล์!") == "สวัสดีค่ะ!"
+    assert th.apply("เเอดเซลล์มิน") == "เเอดมิน"
+
+
+@pytest.mark.parametrize("text", ["abcd", "abce", "xbcd", "ababcdd", "abc"])
+def test_overlapping_patterns_leftmost_then_longest(text):
+    assert NESTED.apply(text) == reference(text, NESTED.rules)
+
+
+@pytest.mark.parametrize("sample", [
+    ("ขอบคุณค่ะ พนักงานขายจะติดต่อกลับ! สวัสดีค่ะ!", "th"),
+    ("สวัสดีค่ะ! ติดต่อเซลล์หรือเเอดมิน • ข้อมูล", "en"),
+    ("เเเอดมินเเอดมินเซลล์เซลล!", "th"),
+])
+def test_stream_splits_match_whole_text(rag, sample):
+    text, lang = sample
+    f = rag[0] if lang == "th" else rag[1]
+    whole = f.apply(text)
+    assert whole == reference(text, f.rules)
+    for cut in range(len(text) + 1):
+        state = f.stream()
+        assert state.feed(text[:cut]) + state.feed(text[cut:]) + state.flush() == whole, cut
+    # Random multi-way splits, including empty chunks; the held-back tail stays bounded.
+    max_len = max(len(p) for p in f.rules)
+    rng = random.Random(66)
+    for _ in range(200):
+        cuts = sorted(rng.randint(0, len(text)) for _ in range(rng.randint(1, 8)))
+        pieces = [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+        state = f.stream()
+        out = []
+        for piece in pieces:
+            out.append(state.feed(piece))
+            assert len(state._tail) < max_len
+        out.append(state.flush())
+        assert "".join(out) == whole, pieces
+
+
+def test_random_texts_match_reference():
+    # A small alphabet stresses the automaton's failure links.
+    rng = random.Random(7)
+    for _ in range(2000):
+        text = "".join(rng.choice("abcdx") for _ in range(rng.randint(0, 12)))
+        cut = rng.randint(0, len(text))
+        state = NESTED.stream()
+        assert state.feed(text[:cut]) + state.feed(text[cut:]) + state.flush() == reference(text, NESTED.rules), text
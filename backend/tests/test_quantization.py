@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from quantization import Codebook
+
+
+def _unit(x: np.ndarray) -> np.ndarray:
+    return x / np.linalg.norm(x, axis=-1, keepdims=True)
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    # Like sentence embeddings: most variance in a low-rank subspace, plus a large common direction
+    # (the centering bias only shows up with a non-zero mean).
+    rng = np.random.default_rng(0)
+    dim, rank = 128, 48
+    common = _unit(rng.normal(size=dim))
+    basis = np.linalg.qr(rng.normal(size=(dim, rank)))[0].T
+
+    def sample(n: int) -> np.ndarray:
+        latent = rng.normal(size=(n, rank)) @ basis * 0.6 + rng.normal(size=(n, dim)) * 0.02
+        return _unit(latent + common * rng.uniform(0.5, 1.5, size=(n, 1))).astype(np.float32)
+
+    return sample(5000), sample(50)
+
+
+def _recall(codebook: Codebook, vectors: np.ndarray, queries: np.ndarray, k: int, candidates: int) -> float:
+    codes = codebook.int8_codes(vectors)
+    hits = 0
+    for q in queries:
+        exact = set(np.argsort(-(vectors @ q))[:k])
+        approx = set(np.argsort(-codebook.int8_scores(codes, q))[:candidates])
+        hits += len(exact & approx)
+    return hits / (k * len(queries))
+
+
+@pytest.mark.parametrize("pca_dim", [0, 64])
+def test_int8_first_pass_recall(corpus, pca_dim):
+    vectors, queries = corpus
+    codebook = Codebook.fit(vectors, pca_dim=pca_dim)
+    assert _recall(codebook, vectors, queries, k=10, candidates=50) >= 0.95
+
+
+def test_int8_scores_track_exact_scores(corpus):
+    vectors, queries = corpus
+    codebook = Codebook.fit(vectors)
+    codes = codebook.int8_codes(vectors)
+    for q in queries[:10]:
+        # Equal up to a per-query constant, so the differences from the exact scores barely vary across rows.
+        diff = codebook.int8_scores(codes, q) - vectors @ q
+        assert np.std(diff) < 0.01
@@ -0,0 +1,24 @@
+from semanticcache import SEMANTIC_CACHE_CONTEXT_MESSAGES, SEMANTIC_CACHE_KEY_CHARS, cache_key_text
+
+
+def test_cache_key_uses_recent_user_messages_only():
+    conversation = []
+    for i in range(10):
+        conversation += [{"role": "user", "content": f"  Question {i} "}, {"role": "assistant", "content": "long answer " * 500}]
+    conversation.append({"role": "user", "content": "Latest   QUESTION"})
+    key = cache_key_text(conversation)
+    assert key.split("\n") == [f"question {i}" for i in range(10 - SEMANTIC_CACHE_CONTEXT_MESSAGES, 10)] + ["latest question"]
+    assert "answer" not in key
+
+
+def test_cache_key_is_capped_and_keeps_the_latest_message():
+    conversation = [{"role": "user", "content": "x" * 5000}, {"role": "user", "content": "the latest one"}]
+    key = cache_key_text(conversation)
+    assert len(key) == SEMANTIC_CACHE_KEY_CHARS
+    assert key.endswith("\nthe latest one")
+
+
+def test_same_question_gives_the_same_key_text():
+    first = cache_key_text([{"role": "user", "content": "How do I earn points?"}])
+    again = cache_key_text([{"role": "user", "content": "how do I  earn points?"}])
+    assert first == again
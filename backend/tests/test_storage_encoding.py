@@ -0,0 +1,38 @@
+import ast
+import os
+
+import numpy as np
+import pytest
+from bson.binary import Binary, BinaryVectorDtype
+
+from quantization import atlas_int8, decode_vector, encode_for_storage
+
+TODB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "preprocess", "todb.py")
+
+
+@pytest.fixture(scope="module")
+def vectors():
+    rng = np.random.default_rng(3)
+    return (rng.normal(size=(20, 1024)) * rng.uniform(0.1, 5.0, size=(20, 1))).astype(np.float32)
+
+
+def test_stored_int8_codes_match_the_query_codes(vectors):
+    # functions.vector_search queries Atlas with atlas_int8 of the query embedding; ingestion stores
+    # encode_for_storage(..., "int8"). Byte-identical codes for the same vector keep the two scales aligned.
+    for v in vectors:
+        stored = encode_for_storage(v, "int8")
+        query = Binary.from_vector(atlas_int8(v).tolist(), BinaryVectorDtype.INT8)
+        assert bytes(stored["embedding"]) == bytes(query)
+        np.testing.assert_array_equal(decode_vector(stored["embedding_full"]), v)
+
+
+def test_ingestion_uses_the_backend_encoder():
+    # preprocess/todb.py cannot be imported here (ingestion-only dependencies), so check its source:
+    # it must import the shared encoder and not carry its own copy.
+    with open(TODB, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    imported = {alias.name for node in ast.walk(tree) if isinstance(node, ast.ImportFrom) and node.module == "quantization"
+                for alias in node.names}
+    assert {"EMBEDDING_STORAGE", "encode_for_storage"} <= imported
+    defined = {node.name for node in ast.walk(tree) if isinstance(node, ast.FunctionDef)}
+    assert not defined & {"encode_embedding", "encode_for_storage", "atlas_int8"}
@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+import pytest
+
+from streaming import coalesce
+
+
+class FakeStream:
+    """Async iterator of (delay seconds, delta) pairs that records whether it was closed."""
+
+    def __init__(self, deltas, error: Exception = None):
+        self.deltas = deltas
+        self.error = error
+        self.closed = False
+
+    def __aiter__(self):
+        return self._gen()
+
+    async def _gen(self):
+        try:
+            for delay, delta in self.deltas:
+                await asyncio.sleep(delay)
+                yield delta
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.closed = True
+
+
+async def collect(stream, **kwargs):
+    start = time.perf_counter()
+    writes = []
+    async for chunk in coalesce(stream, **kwargs):
+        writes.append((time.perf_counter() - start, chunk))
+    return writes
+
+
+def test_first_delta_is_forwarded_immediately():
+    async def run():
+        stream = FakeStream([(0, "first ")] + [(0.2, "late")])
+        gen = coalesce(stream, flush_bytes=1024, flush_interval_ms=1000)
+        start = time.perf_counter()
+        first = await gen.__anext__()
+        assert first == "first "
+        assert time.perf_counter() - start < 0.1
+        await gen.aclose()
+
+    asyncio.run(run())
+
+
+def test_burst_is_flushed_by_size():
+    writes = asyncio.run(collect(FakeStream([(0, "a")] + [(0, "0123456789")] * 10), flush_bytes=25, flush_interval_ms=10_000))
+    chunks = [chunk for _, chunk in writes]
+    assert chunks[0] == "a"
+    assert chunks[1:] == ["0123456789" * 3, "0123456789" * 3, "0123456789" * 3, "0123456789"]
+
+
+def test_slow_tail_is_flushed_by_age():
+    # One buffered delta, then a source that stalls: it must come out after the interval, not at the end.
+    writes = asyncio.run(collect(FakeStream([(0, "a"), (0, "b"), (0.5, "c")]), flush_bytes=1024, flush_interval_ms=50))
+    assert [chunk for _, chunk in writes] == ["a", "b", "c"]
+    assert 0.04 <= writes[1][0] < 0.3
+
+
+def test_error_mid_stream_flushes_buffer_then_raises():
+    async def run():
+        stream = FakeStream([(0, "a"), (0, "b"), (0, "c")], error=RuntimeError("upstream broke"))
+        received = []
+        with pytest.raises(RuntimeError, match="upstream broke"):
+            async for chunk in coalesce(stream, flush_bytes=1024, flush_interval_ms=1000):
+                received.append(chunk)
+        assert received == ["a", "bc"]
+        assert stream.closed
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("flush_bytes", [0, 1024])
+def test_consumer_stopping_early_closes_the_source(flush_bytes):
+    async def run():
+        stream = FakeStream([(0, "a")] + [(0.05, "x")] * 100)
+        gen = coalesce(stream, flush_bytes=flush_bytes, flush_interval_ms=10)
+        assert await gen.__anext__() == "a"
+        await gen.__anext__()
+        await gen.aclose()
+        assert stream.closed
+
+    asyncio.run(run())
+
+
+def test_cancelled_consumer_closes_the_source():
+    async def run():
+        stream = FakeStream([(0, "a")] + [(10, "never")])
+
+        async def consume():
+            async for _ in coalesce(stream, flush_bytes=1024, flush_interval_ms=10):
+                pass
+
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.05)  # Parked on the pending read
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert stream.closed
+
+    asyncio.run(run())
@@ -0,0 +1,49 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from vectorindex import CURRENT_FILE, LocalVectorIndex
+
+
+def _docs(n: int = 64, dim: int = 16, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return [{"_id": f"doc{i}", "content": f"content {i}", "embedding": v.tolist()}
+            for i, v in enumerate(rng.normal(size=(n, dim)).astype(np.float32))]
+
+
+def _builds(index_dir: str):
+    return sorted(name for name in os.listdir(index_dir) if os.path.isdir(os.path.join(index_dir, name)))
+
+
+def _current(index_dir: str) -> str:
+    with open(os.path.join(index_dir, CURRENT_FILE), encoding="utf-8") as f:
+        return f.read().strip()
+
+
+def test_concurrent_builds_of_one_version_share_a_build(tmp_path):
+    index_dir = str(tmp_path)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        build_ids = list(pool.map(lambda _: LocalVectorIndex.build_files(_docs(), index_dir, kb_version="v1"), range(4)))
+    assert len(set(build_ids)) == 1
+    assert _builds(index_dir) == [build_ids[0]]
+    index = LocalVectorIndex(index_dir)
+    assert index.load() and index.kb_version == "v1" and len(index) == 64
+
+
+def test_publishing_keeps_the_replaced_build(tmp_path):
+    index_dir = str(tmp_path)
+    first = LocalVectorIndex.build_files(_docs(), index_dir, kb_version="v1")
+    second = LocalVectorIndex.build_files(_docs(seed=1), index_dir, kb_version="v2")
+    assert _current(index_dir) == second
+    assert _builds(index_dir) == sorted([first, second])  # Workers still on v1 can keep loading it
+
+    third = LocalVectorIndex.build_files(_docs(seed=2), index_dir, kb_version="v3")
+    assert _builds(index_dir) == sorted([second, third])
+
+
+def test_force_rebuilds_the_same_version(tmp_path):
+    index_dir = str(tmp_path)
+    first = LocalVectorIndex.build_files(_docs(), index_dir, kb_version="v1")
+    assert LocalVectorIndex.build_files(_docs(), index_dir, kb_version="v1") == first
+    assert LocalVectorIndex.build_files(_docs(), index_dir, kb_version="v1", force=True) != first
@@ -0,0 +1,166 @@
+# tokenizer.py
+"""
+Thai tokenization service for the query path.
+
+PyThaiNLP's newmm tokenizer is pure Python, so running it on the event loop (or
+in a thread, where it still holds the GIL) stalls every other request while a
+long message is being segmented. Queries are tokenized in a small process pool
+instead; each worker builds the dictionary trie (PyThaiNLP words plus the
+domain vocabulary in `domain_words.txt`) once when it starts. Results are
+memoized on the normalized query.
+
+Workers come from a "forkserver" (or "spawn") context, never a plain fork of the
+API process: by the time the search engine starts, Langfuse, httpx and Motor
+already run threads, and a forked child can deadlock on a lock one of them held.
+If a worker dies, the pool is replaced and the affected query is tokenized in a
+thread instead. Non-fork workers import the parent's __main__ module, so the
+pool is never started at import time: the app starts it from its startup task
+(`start()`), otherwise the first query does.
+
+`preprocess/todb.py` loads the same word list, so query tokens and the
+`content_tokenized` field of ingested documents agree.
+"""
+
+import os
+import asyncio
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Any, Optional, Set
+
+from dotenv import load_dotenv
+from pythainlp.corpus.common import thai_words
+from pythainlp.tokenize import word_tokenize
+from pythainlp.util import dict_trie
+
+from cache import LRUCache, normalize_query
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+DOMAIN_WORDS_PATH = os.getenv("DOMAIN_WORDS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "domain_words.txt"))
+TOKENIZER_POOL = os.getenv("TOKENIZER_POOL", "process") # "process" (no GIL contention with the event loop) or "thread"
+TOKENIZER_WORKERS = int(os.getenv("TOKENIZER_WORKERS", "2"))
+TOKENIZER_START_METHOD = os.getenv("TOKENIZER_START_METHOD", "forkserver") # "forkserver" or "spawn"; never "fork" (see above)
+TOKENIZER_CACHE_SIZE = int(os.getenv("TOKENIZER_CACHE_SIZE", "4096")) # 0 disables memoization
+TOKENIZER_ENGINE = "newmm"
+
+
+def load_domain_words(path: str = DOMAIN_WORDS_PATH) -> Set[str]:
+    """Reads one word per line, skipping blank lines and `#` comments. A missing file yields no words."""
+    if not os.path.exists(path):
+        logger.warning(f"Domain word list not found at {path}; using the PyThaiNLP dictionary only.")
+        return set()
+    with open(path, "r", encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")}
+
+
+def build_trie(path: str = DOMAIN_WORDS_PATH):
+    """Builds the newmm dictionary trie from PyThaiNLP's Thai words plus the domain vocabulary."""
+    return dict_trie(set(thai_words()) | load_domain_words(path))
+
+
+# One per process: built by the pool initializer in workers, and in the parent for the thread pool and fallback.
+_TRIE = None
+
+
+def _init_worker(path: str = DOMAIN_WORDS_PATH) -> None:
+    global _TRIE
+    _TRIE = build_trie(path)
+
+
+def _tokenize(text: str, path: str = DOMAIN_WORDS_PATH) -> List[str]:
+    """Runs in a pool worker (or a thread of the parent)."""
+    if _TRIE is None:
+        _init_worker(path)
+    return word_tokenize(text, custom_dict=_TRIE, engine=TOKENIZER_ENGINE, keep_whitespace=False)
+
+
+class ThaiTokenizer:
+    def __init__(self, pool: str = TOKENIZER_POOL, workers: int = TOKENIZER_WORKERS,
+                 cache_size: int = TOKENIZER_CACHE_SIZE, words_path: str = DOMAIN_WORDS_PATH,
+                 start_method: str = TOKENIZER_START_METHOD):
+        """Configures the tokenizer; the trie and the worker pool are built by `start()`."""
+        if pool not in ("process", "thread"):
+            raise ValueError(f"Unknown tokenizer pool '{pool}'. Use 'process' or 'thread'.")
+        if start_method not in ("forkserver", "spawn"):
+            raise ValueError(f"Unknown tokenizer start method '{start_method}'. Use 'forkserver' or 'spawn'.")
+        self.pool = pool
+        self.workers = workers
+        self.words_path = words_path
+        self.start_method = start_method
+        self.cache = LRUCache(cache_size, name="tokenizer")
+        self.executor: Optional[Executor] = None
+        self._start_lock = threading.Lock()
+        self.calls = 0
+        self.total_chars = 0
+        self.pool_restarts = 0
+        self.fallbacks = 0
+
+    def start(self) -> None:
+        """
+        Builds the dictionary trie and starts the worker pool, so the first user query does
+        not pay for dictionary construction or process start-up. Blocking; idempotent.
+        """
+        with self._start_lock:
+            if self.executor is not None:
+                return
+            _init_worker(self.words_path)  # For the thread pool and the fallback after a worker crash
+            executor = self._make_executor()
+            executor.submit(_tokenize, "", self.words_path).result()
+            self.executor = executor
+        logger.info(f"ThaiTokenizer started ({self.pool} pool, {self.workers} workers, domain words from {self.words_path}).")
+
+    def _make_executor(self) -> Executor:
+        if self.pool == "process":
+            return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(self.start_method),
+                                       initializer=_init_worker, initargs=(self.words_path,))
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tokenize")
+
+    def _replace_broken_pool(self, broken: Executor) -> None:
+        """Swaps in a fresh pool once, however many in-flight queries saw the broken one."""
+        if self.executor is not broken:
+            return
+        self.pool_restarts += 1
+        self.executor = self._make_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    async def tokenize(self, text: str) -> List[str]:
+        """Tokenizes text with newmm in the worker pool. Repeated queries are served from the cache."""
+        key = normalize_query(text)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return list(cached)
+        loop = asyncio.get_running_loop()
+        if self.executor is None:
+            await loop.run_in_executor(None, self.start)
+        executor = self.executor
+        try:
+            tokens = await loop.run_in_executor(executor, _tokenize, key, self.words_path)
+        except BrokenProcessPool:
+            logger.error("A tokenizer worker died; restarting the pool and tokenizing this query in a thread.")
+            self._replace_broken_pool(executor)
+            self.fallbacks += 1
+            tokens = await loop.run_in_executor(None, _tokenize, key, self.words_path)
+        self.calls += 1
+        self.total_chars += len(key)
+        self.cache.set(key, tuple(tokens))
+        return tokens
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pool": self.pool,
+            "start_method": self.start_method if self.pool == "process" else None,
+            "calls": self.calls,
+            "pool_restarts": self.pool_restarts,
+            "fallbacks": self.fallbacks,
+            "total_chars": self.total_chars,
+            "cache": self.cache.stats(),
+        }
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
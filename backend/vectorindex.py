@@ -0,0 +1,421 @@
+# vectorindex.py
+"""
+In-process dense vector index over the `embedding` field of the knowledge base.
+
+The index is written once to disk as a contiguous float32 matrix (`vectors.npy`)
+plus a small JSON sidecar with document ids and contents. Every uvicorn worker
+memory-maps the same file read-only, so the OS page cache holds a single copy
+of the vectors no matter how many workers are running.
+
+Two search modes are supported:
+- "exact": brute-force cosine similarity with one NumPy matrix-vector product.
+- "ivf":   rows are clustered with spherical k-means at build time and stored
+           grouped by cluster; a query only scores the `nprobe` closest clusters.
+
+Each build also stores compact int8 and binary codes (optionally after a learned
+PCA reduction, see quantization.py). With VECTOR_INDEX_QUANTIZATION set, the first
+pass scores only the in-memory codes and the best `top_k * VECTOR_INDEX_RESCORE`
+rows are rescored against the memory-mapped float32 vectors, so the full matrix
+no longer needs to stay resident in the page cache.
+
+Builds are serialized across workers by a file lock in the index directory and
+normally happen at startup (MongoHybridSearch.prepare_indexes) or offline with
+`python vectorindex.py build`; publishing a build only prunes builds older than
+the one it replaced.
+"""
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import Iterator, List, Dict, Any, Optional, Iterable
+
+import numpy as np
+from dotenv import load_dotenv
+
+from quantization import Codebook, decode_vector
+
+load_dotenv(override=True)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "index", "vector"))
+VECTOR_INDEX_MODE = os.getenv("VECTOR_INDEX_MODE", "exact")  # "exact" or "ivf"
+VECTOR_INDEX_NLIST = int(os.getenv("VECTOR_INDEX_NLIST", "0"))  # 0 = sqrt(number of documents)
+VECTOR_INDEX_NPROBE = int(os.getenv("VECTOR_INDEX_NPROBE", "8"))
+VECTOR_INDEX_QUANTIZATION = os.getenv("VECTOR_INDEX_QUANTIZATION", "none")  # "none", "int8" or "binary" first pass
+VECTOR_INDEX_PCA_DIM = int(os.getenv("VECTOR_INDEX_PCA_DIM", "0"))  # Build time; 0 keeps every dimension for the codes
+VECTOR_INDEX_RESCORE = int(os.getenv("VECTOR_INDEX_RESCORE", "4"))  # Candidates rescored in float32 = top_k * this
+QUANTIZATION_MODES = ("none", "int8", "binary")
+
+CURRENT_FILE = "CURRENT"
+BUILD_LOCK_FILE = ".build.lock"
+KB_VERSION_FILE = "kb_version"  # Per build, so reusing a build does not parse meta.json
+VECTORS_FILE = "vectors.npy"
+CENTROIDS_FILE = "centroids.npy"
+OFFSETS_FILE = "offsets.npy"
+META_FILE = "meta.json"
+CODEBOOK_FILE = "codebook.npz"
+CODES_FILES = {"int8": "codes_int8.npy", "binary": "codes_binary.npy"}
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalizes each row in place and returns the matrix."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def _top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Returns indices of the k highest scores, best first."""
+    if k <= 0 or scores.size == 0:
+        return np.empty(0, dtype=np.int64)
+    if k >= scores.size:
+        return np.argsort(-scores, kind="stable")
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def _spherical_kmeans(vectors: np.ndarray, nlist: int, iterations: int = 20, seed: int = 66) -> np.ndarray:
+    """Clusters L2-normalized rows by cosine similarity. Returns (nlist, dim) unit centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        new_centroids = np.zeros_like(centroids)
+        np.add.at(new_centroids, assignments, vectors)
+        empty = ~new_centroids.any(axis=1)
+        if empty.any():
+            # Re-seed empty clusters with random rows so nlist stays fixed.
+            new_centroids[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()), replace=False)]
+        centroids = _normalize_rows(new_centroids)
+    return centroids
+
+
+def _build_time(name: str) -> Optional[int]:
+    """Creation time encoded in a build id ("<unix time>-<random>", in seconds or nanoseconds), or None for anything else."""
+    prefix = name.split("-", 1)[0]
+    return int(prefix) if prefix.isdigit() and "-" in name else None
+
+
+def _read_pointer(index_dir: str) -> Optional[str]:
+    try:
+        with open(os.path.join(index_dir, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _read_build_kb_version(index_dir: str, build_id: str) -> Optional[str]:
+    try:
+        with open(os.path.join(index_dir, build_id, KB_VERSION_FILE), "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def _build_lock(index_dir: str) -> Iterator[None]:
+    """Exclusive across processes: one build (and prune) at a time per index directory."""
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, BUILD_LOCK_FILE), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class LocalVectorIndex:
+    def __init__(self, index_dir: str = VECTOR_INDEX_DIR, mode: str = VECTOR_INDEX_MODE, nprobe: int = VECTOR_INDEX_NPROBE,
+                 quantization: str = VECTOR_INDEX_QUANTIZATION, rescore: int = VECTOR_INDEX_RESCORE):
+        """Initializes an empty index handle. Call `load()` or `build_from_collection()` before searching."""
+        if mode not in ("exact", "ivf"):
+            raise ValueError(f"Unknown vector index mode '{mode}'. Use 'exact' or 'ivf'.")
+        if quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown vector index quantization '{quantization}'. Use one of {QUANTIZATION_MODES}.")
+        self.index_dir = index_dir
+        self.mode = mode
+        self.nprobe = nprobe
+        self.quantization = quantization
+        self.rescore = max(1, rescore)
+        self.vectors: Optional[np.ndarray] = None
+        self.codes: Optional[np.ndarray] = None
+        self.codebook: Optional[Codebook] = None
+        self.centroids: Optional[np.ndarray] = None
+        self.offsets: Optional[np.ndarray] = None
+        self.ids: List[str] = []
+        self.contents: List[str] = []
+        self.build_id: Optional[str] = None
+        self.kb_version: Optional[str] = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.vectors is not None
+
+    def __len__(self) -> int:
+        return 0 if self.vectors is None else int(self.vectors.shape[0])
+
+    # --- Build ---
+    @staticmethod
+    def build_files(docs: Iterable[Dict[str, Any]], index_dir: str = VECTOR_INDEX_DIR, nlist: int = VECTOR_INDEX_NLIST,
+                    kb_version: Optional[str] = None, pca_dim: int = VECTOR_INDEX_PCA_DIM, force: bool = False) -> Optional[str]:
+        """
+        Writes a new index build from documents with `_id`, `content` and `embedding`
+        (or `embedding_full` when the stored `embedding` is int8, see quantization.py).
+        The build goes to its own sub-directory and is published by atomically
+        replacing the CURRENT pointer, so workers never see a half-written index.
+        Builds are serialized across processes by a file lock; unless `force`, a
+        worker that waited for another one's build of the same kb_version reuses it.
+        Returns the build id, or None if there was nothing to index.
+        """
+        with _build_lock(index_dir):
+            current = _read_pointer(index_dir)
+            if not force and kb_version is not None and current is not None \
+                    and _read_build_kb_version(index_dir, current) == kb_version:
+                logger.info(f"Vector index build {current} already covers knowledge base version {kb_version}.")
+                return current
+            build_id = LocalVectorIndex._write_build(docs, index_dir, nlist, kb_version, pca_dim)
+            if build_id is not None:
+                LocalVectorIndex._prune_old_builds(index_dir, replaced=current)
+            return build_id
+
+    @staticmethod
+    def _write_build(docs: Iterable[Dict[str, Any]], index_dir: str, nlist: int, kb_version: Optional[str], pca_dim: int) -> Optional[str]:
+        ids, contents, rows = [], [], []
+        for doc in docs:
+            embedding = decode_vector(doc.get("embedding_full", doc.get("embedding")))
+            if embedding is None:
+                continue
+            ids.append(str(doc["_id"]))
+            contents.append(str(doc.get("content", "")))
+            rows.append(embedding)
+
+        if not rows:
+            logger.warning("No documents with embeddings found; vector index not built.")
+            return None
+
+        vectors = _normalize_rows(np.ascontiguousarray(np.vstack(rows), dtype=np.float32))
+        build_id = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"  # Sorts by creation time, see _prune_old_builds
+        build_dir = os.path.join(index_dir, build_id)
+        os.makedirs(build_dir, exist_ok=True)
+
+        # IVF layout: rows are stored grouped by cluster so each inverted list is a contiguous slice.
+        if nlist <= 0:
+            nlist = max(1, int(np.sqrt(len(vectors))))
+        nlist = min(nlist, len(vectors))
+        centroids = _spherical_kmeans(vectors, nlist)
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=nlist), out=offsets[1:])
+
+        vectors = vectors[order]
+        np.save(os.path.join(build_dir, VECTORS_FILE), vectors)
+        np.save(os.path.join(build_dir, CENTROIDS_FILE), centroids.astype(np.float32))
+        np.save(os.path.join(build_dir, OFFSETS_FILE), offsets)
+
+        # Compact codes for the first pass; both kinds are cheap, so every build carries them.
+        codebook = Codebook.fit(vectors, pca_dim)
+        np.savez(os.path.join(build_dir, CODEBOOK_FILE), **codebook.to_arrays())
+        code_bytes = {}
+        for kind, encode in (("int8", codebook.int8_codes), ("binary", codebook.binary_codes)):
+            codes = encode(vectors)
+            np.save(os.path.join(build_dir, CODES_FILES[kind]), codes)
+            code_bytes[kind] = int(codes.nbytes)
+        with open(os.path.join(build_dir, META_FILE), "w", encoding="utf-8") as f:
+            json.dump({
+                "build_id": build_id,
+                "kb_version": kb_version,
+                "count": len(ids),
+                "dim": int(vectors.shape[1]),
+                "nlist": nlist,
+                "pca_dim": codebook.dim,
+                "float32_bytes": int(vectors.nbytes),
+                "code_bytes": code_bytes,
+                "ids": [ids[i] for i in order],
+                "contents": [contents[i] for i in order],
+            }, f, ensure_ascii=False)
+        if kb_version is not None:
+            with open(os.path.join(build_dir, KB_VERSION_FILE), "w", encoding="utf-8") as f:
+                f.write(kb_version)
+
+        tmp_pointer = os.path.join(index_dir, f".{CURRENT_FILE}.{build_id}")
+        with open(tmp_pointer, "w", encoding="utf-8") as f:
+            f.write(build_id)
+        os.replace(tmp_pointer, os.path.join(index_dir, CURRENT_FILE))
+        logger.info(f"Vector index build {build_id} written: {len(ids)} vectors, dim={vectors.shape[1]}, nlist={nlist}, "
+                    f"float32={vectors.nbytes / 2**20:.1f} MiB, int8={code_bytes['int8'] / 2**20:.1f} MiB, "
+                    f"binary={code_bytes['binary'] / 2**20:.1f} MiB (code dim {codebook.dim}).")
+        return build_id
+
+    @staticmethod
+    def _prune_old_builds(index_dir: str, replaced: Optional[str]) -> None:
+        """
+        Removes builds older than the one CURRENT just replaced; that one stays for workers
+        that have not switched yet. Runs under the build lock, so no build is in progress, and
+        workers still mapping a removed build keep their open file handles.
+        """
+        if replaced is None or _build_time(replaced) is None:
+            return
+        cutoff = (_build_time(replaced), replaced)
+        for name in os.listdir(index_dir):
+            path = os.path.join(index_dir, name)
+            if _build_time(name) is not None and (_build_time(name), name) < cutoff and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    async def build_from_collection(self, collection, kb_version: Optional[str] = None) -> bool:
+        """Reads all embeddings from a Motor collection, writes a new build tagged with kb_version and loads it."""
+        if self.load() and kb_version is not None and self.kb_version == kb_version:
+            return True  # Another worker published it meanwhile
+        cursor = collection.find({"embedding": {"$exists": True}}, {"_id": 1, "content": 1, "embedding": 1, "embedding_full": 1})
+        docs = await cursor.to_list(length=None)
+        loop = asyncio.get_running_loop()
+        build_id = await loop.run_in_executor(None, self.build_files, docs, self.index_dir, VECTOR_INDEX_NLIST, kb_version)
+        return build_id is not None and self.load()
+
+    # --- Load ---
+    def load(self) -> bool:
+        """Memory-maps the current build from disk. Returns False if no build exists."""
+        pointer = os.path.join(self.index_dir, CURRENT_FILE)
+        if not os.path.exists(pointer):
+            return False
+        try:
+            with open(pointer, "r", encoding="utf-8") as f:
+                build_id = f.read().strip()
+            build_dir = os.path.join(self.index_dir, build_id)
+            with open(os.path.join(build_dir, META_FILE), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            self.vectors = np.load(os.path.join(build_dir, VECTORS_FILE), mmap_mode="r")
+            self.centroids = np.load(os.path.join(build_dir, CENTROIDS_FILE))
+            self.offsets = np.load(os.path.join(build_dir, OFFSETS_FILE))
+            self.codes, self.codebook = None, None
+            if self.quantization != "none":
+                codes_path = os.path.join(build_dir, CODES_FILES[self.quantization])
+                if os.path.exists(codes_path):
+                    # Codes are the hot data in this mode, so read them fully into memory.
+                    self.codes = np.load(codes_path)
+                    with np.load(os.path.join(build_dir, CODEBOOK_FILE)) as arrays:
+                        self.codebook = Codebook.from_arrays(arrays)
+                else:
+                    logger.warning(f"Build {build_id} has no {self.quantization} codes; searching float32 vectors directly.")
+            self.ids = meta["ids"]
+            self.contents = meta["contents"]
+            self.build_id = build_id
+            self.kb_version = meta.get("kb_version")
+            logger.info(f"Loaded vector index build {build_id} ({len(self.ids)} vectors, mode={self.mode}, quantization={self.quantization}).")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to load vector index from {self.index_dir}: {e}", exc_info=True)
+            self.vectors = None
+            return False
+
+    # --- Search ---
+    def _candidate_rows(self, query: np.ndarray) -> Optional[np.ndarray]:
+        """Row indices to score in IVF mode, or None to score every row."""
+        if self.mode != "ivf" or self.centroids is None or self.nprobe >= len(self.centroids):
+            return None
+        probe = _top_k_indices(self.centroids @ query, self.nprobe)
+        ranges = [np.arange(self.offsets[c], self.offsets[c + 1]) for c in probe]
+        return np.concatenate(ranges) if ranges else np.empty(0, dtype=np.int64)
+
+    def search(self, query_vector: List[float], top_k: int) -> List[Dict[str, Any]]:
+        """
+        Returns up to top_k documents as {_id, content, score}, best first.
+        Scores use the same (1 + cosine) / 2 scale as Atlas `vectorSearchScore`.
+        """
+        if self.vectors is None:
+            raise RuntimeError("Vector index is not loaded.")
+        query = np.asarray(query_vector, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+
+        rows = self._candidate_rows(query)
+        if self.codes is not None:
+            # First pass over the compact codes, then exact rescoring of the shortlist.
+            codes = self.codes if rows is None else self.codes[rows]
+            if self.quantization == "int8":
+                approx = self.codebook.int8_scores(codes, query)
+            else:
+                approx = self.codebook.binary_scores(codes, query)
+            shortlist = _top_k_indices(approx, top_k * self.rescore)
+            rows = np.sort(shortlist if rows is None else rows[shortlist])
+
+        if rows is None:
+            scores = self.vectors @ query
+            best = _top_k_indices(scores, top_k)
+            best_rows, best_scores = best, scores[best]
+        else:
+            scores = self.vectors[rows] @ query
+            best = _top_k_indices(scores, top_k)
+            best_rows, best_scores = rows[best], scores[best]
+
+        return [
+            {"_id": self.ids[row], "content": self.contents[row], "score": float((1.0 + score) / 2.0)}
+            for row, score in zip(best_rows.tolist(), best_scores.tolist())
+        ]
+
+
+# Build the index offline (recommended before starting workers) or benchmark it.
+if __name__ == "__main__":
+    import sys
+    from pymongo import MongoClient
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "build"
+    if command == "build":
+        logging.basicConfig(level=logging.INFO)
+        client = MongoClient(os.getenv("MONGO_URL"))
+        database = client["rabbit-reward"]
+        meta = database["kb_meta"].find_one({"_id": "rabbit-reward"})
+        docs = database["rabbit-reward"].find({"embedding": {"$exists": True}}, {"_id": 1, "content": 1, "embedding": 1, "embedding_full": 1})
+        LocalVectorIndex.build_files(docs, kb_version=str(meta["version"]) if meta and meta.get("version") else "unversioned", force=True)
+        client.close()
+    elif command == "bench":
+        for mode in ("exact", "ivf"):
+            index = LocalVectorIndex(mode=mode)
+            if not index.load():
+                print("No index build found. Run `python vectorindex.py build` first.")
+                break
+            rng = np.random.default_rng(0)
+            queries = rng.standard_normal((200, index.vectors.shape[1])).astype(np.float32)
+            index.search(queries[0], 100)  # touch pages
+            start = time.perf_counter()
+            for q in queries:
+                index.search(q, 100)
+            elapsed_ms = (time.perf_counter() - start) * 1000 / len(queries)
+            print(f"mode={mode} n={len(index)} top_k=100: {elapsed_ms:.3f} ms/query")
+    elif command == "quantbench":
+        # Memory per vector for each stored format and recall@k of the quantized first pass vs exact search.
+        from quantization import bson_list_bytes
+        exact = LocalVectorIndex(mode="exact")
+        if not exact.load():
+            print("No index build found. Run `python vectorindex.py build` first.")
+            sys.exit(1)
+        n, dim = exact.vectors.shape
+        print(f"n={n} dim={dim}")
+        print(f"  bson list of doubles : {bson_list_bytes(dim):>6} B/vector")
+        print(f"  float32              : {dim * 4:>6} B/vector")
+        for kind in ("int8", "binary"):
+            index = LocalVectorIndex(mode="exact", quantization=kind)
+            index.load()
+            print(f"  {kind:<6} codes         : {index.codes.nbytes // n:>6} B/vector (code dim {index.codebook.dim})")
+
+        # Queries: perturbed copies of stored vectors, so neighbourhoods are realistic but not trivial.
+        rng = np.random.default_rng(0)
+        picks = rng.choice(n, size=min(200, n), replace=False)
+        queries = np.asarray(exact.vectors[picks]) + rng.standard_normal((len(picks), dim)).astype(np.float32) * 0.02
+        for k in (10, 100):
+            truth = [{d["_id"] for d in exact.search(q, k)} for q in queries]
+            for kind in ("int8", "binary"):
+                for rescore in (1, 4, 10):
+                    index = LocalVectorIndex(mode="exact", quantization=kind, rescore=rescore)
+                    index.load()
+                    recall = np.mean([len(t & {d["_id"] for d in index.search(q, k)}) / k for q, t in zip(queries, truth)])
+                    print(f"recall@{k:<3} {kind:<6} rescore x{rescore:<2}: {recall:.4f}")
@@ -7,6 +7,7 @@ import re
 import logging
 import json
 import traceback
+import uuid
 
 # --- Streamlit Page Setup ---
 st.set_page_config(page_title="Rabbit Reward Chatbot", layout="wide")
@@ -15,6 +16,8 @@ st.set_page_config(page_title="Rabbit Reward Chatbot", layout="wide")
 BACKEND_URL = os.getenv("BACKEND_API_URL", "http://127.0.0.1:8000/chat")
 USER_ID = "streamlit_user_01"
 REQUEST_TIMEOUT = 180
+USE_SERVER_SESSION = os.getenv("USE_SERVER_SESSION", "false").lower() == "true" # Send only the new message; the backend keeps the history
+USE_EVENT_STREAM = os.getenv("USE_EVENT_STREAM", "false").lower() == "true" # Use /chat/stream (Server-Sent Events) to show progress before the answer
 CAPTION_FONT_SIZE_PX = 16
 # imogi from picture
 BOT_AVATAR_EMOJI = "asset/rabbit-logo.png"
@@ -33,6 +36,9 @@ if "messages" not in st.session_state:
     st.session_state.messages = []
 if "last_debug_info" not in st.session_state:
     st.session_state.last_debug_info = None
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+    st.session_state.session_synced = False # Whether the backend session already holds our history
 def detect_thai_or_english(text: str) -> str:
     """
     Detects if a string is primarily Thai, English, or a mix of both.
@@ -126,6 +132,8 @@ with st.sidebar:
     if st.button("🧹 Clear Chat History"):
         st.session_state.messages = []
         st.session_state.last_debug_info = None
+        st.session_state.session_id = uuid.uuid4().hex
+        st.session_state.session_synced = False
         logger.info("Chat history cleared.")
         st.rerun()
 
@@ -168,6 +176,12 @@ if prompt := st.chat_input("Ask about Rabbit Rewards..."):
         "history": history_for_api,
         "message": prompt,
     }
+    if USE_SERVER_SESSION:
+        payload["session_id"] = st.session_state.session_id
+        if st.session_state.session_synced:
+            # The backend already has the conversation; the history is only resent to seed a lost session.
+            payload["history"] = []
+    session_status = None
     logger.info("Sending payload to backend.")
 
     with st.chat_message("assistant", avatar=BOT_AVATAR_EMOJI):
@@ -178,16 +192,49 @@ if prompt := st.chat_input("Ask about Rabbit Rewards..."):
         final_debug_info = {}
 
         try:
-            with requests.post(BACKEND_URL, json=payload, timeout=REQUEST_TIMEOUT, stream=True) as response:
+            url = BACKEND_URL.rstrip("/") + "/stream" if USE_EVENT_STREAM else BACKEND_URL
+            with requests.post(url, json=payload, timeout=REQUEST_TIMEOUT, stream=True) as response:
                 response.raise_for_status()
                 content_type = response.headers.get("content-type", "").lower()
 
-                if "text/plain" in content_type:
+                if "text/event-stream" in content_type:
+                    final_debug_info = {"response_type": "event_stream", "stages": []}
+                    session_status = response.headers.get("X-Session-Status")
+                    buffer = ""
+                    event_type, data_lines = "message", []
+                    # chunk_size=None hands over data as it arrives, so small events are not held back.
+                    for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                        if line.startswith("event:"):
+                            event_type = line[len("event:"):].strip()
+                        elif line.startswith("data:"):
+                            data_lines.append(line[len("data:"):].strip())
+                        elif not line and data_lines:
+                            # A blank line ends the event.
+                            data = json.loads("\n".join(data_lines))
+                            if event_type == "stage":
+                                final_debug_info["stages"].append(data)
+                                if not buffer:
+                                    response_placeholder.markdown(f"{think_message} ({data['name']})")
+                            elif event_type == "retrieval":
+                                final_debug_info["retrieval"] = data
+                            elif event_type == "token":
+                                buffer += data["text"]
+                                response_placeholder.markdown(buffer + "▌")
+                            elif event_type == "done":
+                                final_debug_info.update(done=data)
+                            elif event_type == "error":
+                                final_debug_info["error"] = data
+                                buffer += ("\n\n" if buffer else "") + data["message"]
+                            event_type, data_lines = "message", []
+                    assistant_reply_content = buffer
+
+                elif "text/plain" in content_type:
                     final_debug_info = {
                         "response_type": "streaming",
                         "rag_decision_from_header": response.headers.get("X-RAG-Decision"),
                         "final_stage_from_header": response.headers.get("X-Final-Stage"),
                     }
+                    session_status = response.headers.get("X-Session-Status")
                     buffer = ""
                     for chunk in response.iter_content(chunk_size=512, decode_unicode=True):
                         if chunk:
@@ -200,6 +247,7 @@ if prompt := st.chat_input("Ask about Rabbit Rewards..."):
                     assistant_reply_content = api_response_json.get("reply", "Error: No reply in JSON.")
                     final_debug_info = api_response_json.get("debug_info", {})
                     final_debug_info["response_type"] = "json"
+                    session_status = final_debug_info.get("session", {}).get("status")
                 
                 else:
                     raise ValueError(f"Unexpected Content-Type from server: {content_type}")
@@ -217,6 +265,9 @@ if prompt := st.chat_input("Ask about Rabbit Rewards..."):
              final_debug_info = {"error": "Frontend Error", "details": traceback.format_exc()}
         
         finally:
+            if USE_SERVER_SESSION and session_status:
+                # "new" with history omitted means the backend lost the session (restart or eviction): resend next time.
+                st.session_state.session_synced = not (session_status == "new" and history_for_api and not payload["history"])
             st.session_state.last_debug_info = final_debug_info
             st.session_state.messages.append({"role": "assistant", "content": assistant_reply_content})
             st.rerun()
\ No newline at end of file
@@ -7,10 +7,19 @@ import numpy as np
 import pandas as pd
 import re
 from pythainlp.tokenize import word_tokenize
+from pythainlp.corpus.common import thai_words
+from pythainlp.util import dict_trie
 from openai import OpenAI
 import ast
 import json
+import uuid
+from datetime import datetime, timezone
 from sentence_transformers import SentenceTransformer
+import sys
+# Stored embedding format (EMBEDDING_STORAGE: "list", "float32" or "int8") and its encoding come from the backend,
+# so the int8 codes written here always match the codes the backend builds for the query.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from quantization import EMBEDDING_STORAGE, encode_for_storage
 load_dotenv(override=True)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
@@ -21,6 +30,9 @@ logger = logging.getLogger(__name__)
 client_JTS = OpenAI(base_url=os.getenv("JAI_BASE_URL"), api_key=os.getenv("JAI_API_KEY"))
 DATABASE_URL = os.getenv("MONGO_URL")
 DB_NAME = "rabbit-reward"
+KB_META_COLLECTION = "kb_meta"
+# Same domain vocabulary as the backend query tokenizer, so query and document tokens agree.
+DOMAIN_WORDS_PATH = os.getenv("DOMAIN_WORDS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend", "domain_words.txt"))
 
 from FlagEmbedding import BGEM3FlagModel
 
@@ -91,13 +103,50 @@ def to_db(database_url: str, db_name: str, collection_name: str, insert_type: st
         logger.error(f"Error connecting to MongoDB or inserting data: {e}")
     finally:
         client.close()
+def stamp_kb_version(database_url: str, db_name: str, collection_name: str) -> str:
+    """
+    Writes a new version stamp for the collection after ingestion.
+    The backend invalidates its answer and retrieval caches when the stamp changes.
+
+    Returns:
+        str: The new version id.
+    """
+    version = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}-{uuid.uuid4().hex[:8]}"
+    client = MongoClient(database_url)
+    try:
+        client[db_name][KB_META_COLLECTION].update_one(
+            {"_id": collection_name},
+            {"$set": {"version": version, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+        logger.info(f"Knowledge base version for '{collection_name}' set to {version}.")
+    finally:
+        client.close()
+    return version
+
+def load_domain_trie(path=DOMAIN_WORDS_PATH):
+    """
+    Build the newmm dictionary trie from PyThaiNLP's Thai words plus the domain word list.
+    :param path: One word per line; blank lines and '#' comments are skipped
+    :return: Trie for word_tokenize(custom_dict=...)
+    """
+    words = set(thai_words())
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            words |= {line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")}
+    else:
+        logger.warning(f"Domain word list not found at {path}; using the PyThaiNLP dictionary only.")
+    return dict_trie(words)
+
+DOMAIN_TRIE = load_domain_trie()
+
 def tokenize(text):
     """
     Tokenize the input text using PyThaiNLP.
     :param text: Text to tokenize
     :return: List of tokens
     """
-    return word_tokenize(text, engine="newmm",keep_whitespace=True)
+    return word_tokenize(text, custom_dict=DOMAIN_TRIE, engine="newmm",keep_whitespace=True)
 
 BGE =  SentenceTransformer("BAAI/bge-m3")
 
@@ -165,7 +214,7 @@ def preprocess(path: str, collection_name: str):
                                     embeddings = embed(data_to_embed, "document")
                                     
                                     if embeddings:
-                                        data["embedding"] = embeddings[0]
+                                        data.update(encode_for_storage(embeddings[0]))
                                         to_db(DATABASE_URL, DB_NAME, collection_name, "one", data, metadata=None)
                                         print(f"Successfully processed file: {file_name}")
                                 elif line.keys() == {"text"}:
@@ -185,7 +234,7 @@ def preprocess(path: str, collection_name: str):
                                     embeddings = embed(data_to_embed, "document")
                                     
                                     if embeddings:
-                                        data["embedding"] = embeddings[0]
+                                        data.update(encode_for_storage(embeddings[0]))
                                         to_db(DATABASE_URL, DB_NAME, collection_name, "one", data, metadata=None)
                                         print(f"Successfully processed file: {file_name}")
                                 else:
@@ -195,6 +244,7 @@ def preprocess(path: str, collection_name: str):
                                 logger.error(f"JSON decode error in {file_name}: {e}")
                                 print(line)
                     
+        stamp_kb_version(DATABASE_URL, DB_NAME, collection_name)
     except ValueError as ve:
         logger.error(ve)
     except Exception as e: